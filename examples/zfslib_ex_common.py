@@ -19,32 +19,24 @@ def print_diffs_test(ds, snapshots):
     for i, snap in enumerate(snapshots):
         
         if i > 0:
-            diffs = ds.get_diffs(snap_last, snap, file_type='F', chg_type='M', include=['*.vb', '*.py', '*.js', '*.aspx'], exclude=['*.vscod*', '*_pycache_*', '*/_other/db/*'])
-            for diff in diffs:
-                try:
-                    if file_is_text(diff.snap_path_left): # Get diff of any text files
-                        print('{} - {}'.format(snap.name, diff))
-                        p_left = diff.snap_path_left
-                        p_right = diff.snap_path_right
-
-                        # print('. path left: {}'.format(p_left))
-                        # print('. path right: {}'.format(p_right))
-                        (adds, rems, err) = get_file_diff(diff)
-                        if not err is None:
-                            print("Had Error: {}".format(err))
-                        else:
-                            if adds == 0 and rems == 0:
-                                print("  . (No changes)")
-                            else:
-                                print("  . file changed. Lines changed: -{} +{}".format(rems, adds))
-                                print('''  . meld diff: % meld "{}" "{}"'''.format(p_left, p_right))
-                except PermissionError as ex:
-                    print("Had error: {}".format(ex))
+            diffs = ds.iter_diffs(snap_last, snap, file_type='F', chg_type='M', include=['*.vb', '*.py', '*.js', '*.aspx'], exclude=['*.vscod*', '*_pycache_*', '*/_other/db/*'])
+            # Files are compared in parallel in a process pool
+            for res in zfs.compare_diff_contents(diffs):
+                if not res.error is None:
+                    print("Had Error: {}".format(res.error))
+                elif res.is_text is not False:
+                    print('{} - {}'.format(snap.name, res.diff))
+                    if not res.changed or (res.adds == 0 and res.rems == 0):
+                        print("  . (No changes)")
+                    else:
+                        print("  . file changed. Lines changed: -{} +{}".format(res.rems, res.adds))
+                        print('''  . meld diff: % meld "{}" "{}"'''.format(res.diff.snap_path_left, res.diff.snap_path_right))
                 
         snap_last = snap
 
 
 
+# Runs external `diff` for a single Diff. See zfs.compare_diff_contents() for the in-library version
 def get_file_diff(diff):
     if not diff.file_type == 'F':
         raise Exception('get_file_diff() is only available for files (file_type = F).')
@@ -12,11 +12,29 @@
 #########################################
 
 import subprocess
+import sys
+import errno
 import os
+import io
+import csv
+import json
+import re
 import fnmatch
 import pathlib
 import inspect
-from collections import OrderedDict
+import tempfile
+import shlex
+import struct
+import threading
+import warnings
+import itertools
+import heapq
+import mmap
+import marshal
+import zlib
+import time
+from collections import OrderedDict, deque, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as futures_wait, FIRST_COMPLETED
 from datetime import datetime, timedelta, date as dt_date
 
 class __DEFAULT__(object):pass
@@ -27,6 +45,7 @@ class Connection:
     _dirty = True
     _trust = False
     _props_last = None
+    _fs = None
 
     def __init__(self, host="localhost", trust=False, sshcipher=None, identityfile=None, knownhostsfile=None, verbose=False):
         self.host = host
@@ -52,24 +71,55 @@ class Connection:
 
     
     # See PoolSet._load for parameters
+    # cache - Path of a catalog file used for a warm start and rewritten after loading
+    # max_age - Seconds within which the catalog is used without asking the host. None always revalidates
+    # Note: When the PoolSet is loaded and only zfs properties are added, just the new columns are
+    #       listed and merged into the loaded items (see PoolSet._load_delta). Use force=True for a full reload
 
-    def load_poolset(self, zfs_props=None, zpool_props=None, get_mounts=True, force=False, _test_data_zfs=None, _test_data_zpool=None):
+    def load_poolset(self, zfs_props=None, zpool_props=None, get_mounts=True, get_resume_tokens=False, force=False, cache:str=None, max_age:float=None, _test_data_zfs=None, _test_data_zpool=None):
         zfs_props = [] if zfs_props is None else zfs_props
-        if force or not self._props_last == zfs_props:
-            self._poolset._load(zfs_props=zfs_props, zpool_props=zpool_props, get_mounts=get_mounts, _test_data_zfs=_test_data_zfs, _test_data_zpool=_test_data_zpool)
-            self._props_last = zfs_props
+        props_key = (zfs_props, zpool_props, get_mounts, get_resume_tokens)
+        if force or not self._props_last == props_key:
+            if force or self._props_last is None or not _test_data_zfs is None \
+                or not self._poolset._load_delta(zfs_props=zfs_props, zpool_props=zpool_props, get_mounts=get_mounts, get_resume_tokens=get_resume_tokens, cache=cache):
+                self._poolset._load(zfs_props=zfs_props, zpool_props=zpool_props, get_mounts=get_mounts, get_resume_tokens=get_resume_tokens, cache=cache, max_age=max_age, _test_data_zfs=_test_data_zfs, _test_data_zpool=_test_data_zpool)
+            self._props_last = props_key
 
         return self._poolset
 
 
+    # Filesystem probe for path queries on the host of this connection
+    # . LocalProbe for localhost, RemoteProbe (helper agent over ssh) otherwise
+    def _get_fs(self):
+        if self._fs is None:
+            self._fs = RemoteProbe(self.command) if self.command else LocalProbe()
+        return self._fs
+    fs = property(_get_fs)
+
+
+    # Run a command on the connection's host
+    # cmd - list(of str) without the connection prefix
+    # input - bytes for stdin or None
+    # Returns: bytes - stdout
+    # Raises subprocess.CalledProcessError (with stderr) if the command exits non-zero
+    # Note: Tests replace this to avoid running zfs
+    def run(self, cmd:list, input:bytes=None) -> bytes:
+        return subprocess.run(self.command + cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+
 class PoolSet(object):
     _pools = None
     items = property(lambda self: [self._pools[p] for p in self._pools if True])
     have_mounts = False
+    _mount_index = None
+    _zfs_props = None
+    _zpool_props = None
+    _index = None # full name -> Pool, Dataset or Snapshot. Maintained by ZFSItem._add_child / remove
 
     def __init__(self, conn):
         self.connection=conn
         self._pools = {}
+        self._index = {}
 
     def get_pool(self, name):
         p = self.lookup(name)
@@ -78,7 +128,11 @@ class PoolSet(object):
 
     # Lookup any type in poolset including: Pool, Dataset, Snapshot
     # Eg. for snapshots: <pool>/<dataset_path>@<snapshot>
+    # . A single probe of the full name index. Misses walk the tree to say which part is missing
     def lookup(self, name):
+        ret = None if self._index is None else self._index.get(name)
+        if not ret is None: return ret
+
         if "@" in name:
             path, snapshot = name.split("@")
         else:
@@ -103,9 +157,58 @@ class PoolSet(object):
     # [zfs_props] properties from % zfs list -o <properties>
     # [zpool_props] properties from % zpool list -o <properties>
     # [get_mounts] Append  mountpoint and mounted zfs_props and store flag for downstream code to know that these flags are available
+    # [get_resume_tokens] Append receive_resume_token to zfs_props. Used by recursive_replicate() to resume interrupted receives
     # [_test_data_zfs] testing only
     # [_test_data_zpool] testing only
-    def _load(self, get_mounts=True, zfs_props=None, zpool_props=None, _test_data_zfs=None, _test_data_zpool=None):
+    # cache - Path of a catalog file. See _fetchCached()
+    # max_age - Seconds a catalog is trusted without asking the host. None always revalidates
+    def _load(self, get_mounts=True, zfs_props=None, zpool_props=None, get_resume_tokens=False, cache=None, max_age=None, _test_data_zfs=None, _test_data_zpool=None):
+        (zfs_props, zpool_props) = self._load_props(get_mounts, zfs_props, zpool_props, get_resume_tokens)
+
+        self._mount_index = None
+        if self._index is None: self._index = {}
+
+        if cache is None:
+            zfs_rows = self._fetch_zfs(zfs_props, _test_data=_test_data_zfs)
+            zpool_rows = self._fetch_zpool(zpool_props, _test_data=_test_data_zpool)
+        else:
+            (zfs_rows, zpool_rows) = self._fetch_cached(cache, max_age, zfs_props, zpool_props)
+
+        self._zfs_props = zfs_props
+        self._zpool_props = zpool_props
+        self._build(zfs_props, zpool_props, zfs_rows, zpool_rows)
+
+
+    # Adds zfs properties to a loaded PoolSet with one narrow zfs list -o name,<new props>
+    # Returns: False if a full load is needed instead: not loaded yet, zfs properties removed or zpool properties changed
+    # Note: Items created since the last load are not added. Use a full load for that
+    def _load_delta(self, get_mounts=True, zfs_props=None, zpool_props=None, get_resume_tokens=False, cache=None) -> bool:
+        if self._zfs_props is None: return False
+        have_mounts = self.have_mounts
+        (zfs_props, zpool_props) = self._load_props(get_mounts, zfs_props, zpool_props, get_resume_tokens)
+        if not set(self._zfs_props) <= set(zfs_props) or not zpool_props == self._zpool_props:
+            self.have_mounts = have_mounts
+            return False
+
+        added = [ p for p in zfs_props if not p in self._zfs_props ]
+        if added:
+            out = self.connection.run(["zfs", "list", "-Hpr", "-o", ",".join( ['name'] + added ), "-t", "all"])
+            for (name, values) in _extractRows(out, ['name'] + added):
+                item = self._index.get(name)
+                if item is None: continue
+                item._properties.update( zip(added, values) )
+                if not item._props_missing is None: item._props_missing.difference_update(added)
+
+        self._zfs_props = zfs_props
+        if not have_mounts == self.have_mounts:
+            self._mount_index = None
+            for pool in self: pool.have_mounts = self.have_mounts
+        if not cache is None: self.save_catalog(cache)
+        return True
+
+
+    # Resolves the zfs and zpool list columns for a load. Sets have_mounts
+    def _load_props(self, get_mounts, zfs_props, zpool_props, get_resume_tokens):
 
         # setup zfs list properties (zfs list -o <props>)
         _zfs_pdef=['name', 'creation']
@@ -129,6 +232,8 @@ class PoolSet(object):
 
             zfs_props = _zfs_pdef + [s for s in zfs_props if not s in _zfs_pdef]
 
+        if get_resume_tokens and not 'receive_resume_token' in zfs_props:
+            zfs_props = zfs_props + ['receive_resume_token']
 
 
         # setup zpool list properties (zpool list -o <props>)
@@ -138,51 +243,128 @@ class PoolSet(object):
         else:
             zpool_props = _zpool_pdef + [s for s in zpool_props if not s in _zpool_pdef]
 
+        return (zfs_props, zpool_props)
 
-        _base_cmd = self.connection.command
-
-        def extract_properties(s, zpool:bool=False):
-            props = zpool_props if zpool else zfs_props
-            if isinstance(s, bytes): s = s.decode('utf-8')
-            items = s.strip().split( '\t' )
-            assert len( items ) == len( props ), (props, items)
-            for i in range(1,len(props)):
-                v = items[i]
-                if v == '-':
-                    items[i] = None
-                elif props[i] in ZFS_INT_PROPS:
-                    try:
-                        items[i] = int(v)
-                    except:
-                        pass
-                        
-            return [ items[ 0 ], zip( props[ 1: ], items[ 1: ] ) ]
-
-        # Gather zfs list data
-        if _test_data_zfs is None:
-            zfs_list_output = subprocess.check_output(self.connection.command + ["zfs", "list", "-Hpr", "-o", ",".join( zfs_props ), "-t", "all"])
 
+    # Gathers zfs list data
+    # pools - Limit to these pools. None for all
+    # Returns: OrderedDict(of name -> list(of values in zfs_props[1:] order))
+    def _fetch_zfs(self, zfs_props, pools:list=None, _test_data=None):
+        if _test_data is None:
+            out = self.connection.run(["zfs", "list", "-Hpr", "-o", ",".join( zfs_props ), "-t", "all"] + (pools or []))
         else: # Use test data
-            zfs_list_output = _test_data_zfs
-
-        zfs_list_items = OrderedDict([ extract_properties(s) for s in zfs_list_output.splitlines() if s.strip() ])
-
+            out = _test_data
+        return OrderedDict(_extractRows(out, zfs_props))
 
-        # Gather zpool list data
-        if _test_data_zpool is None:
-            zpool_list_output = subprocess.check_output(self.connection.command + ["zpool", "list", "-Hp", "-o", ",".join( zpool_props )])
 
+    # Gathers zpool list data. Returns: OrderedDict(of name -> list(of values in zpool_props[1:] order))
+    def _fetch_zpool(self, zpool_props, _test_data=None):
+        if _test_data is None:
+            out = self.connection.run(["zpool", "list", "-Hp", "-o", ",".join( zpool_props )])
         else: # Use test data
-            zpool_list_output = _test_data_zpool
-
-        zpool_list_items = OrderedDict([ extract_properties(s, zpool=True) for s in zpool_list_output.splitlines() if s.strip() ])
+            out = _test_data
+        return OrderedDict(_extractRows(out, zpool_props))
+
+
+    # Gathers zfs and zpool list data through the catalog file at path
+    # . A catalog younger than max_age seconds is used as is without contacting the host
+    # . Otherwise zpool list is run and each pool's fingerprint (allocated, free) is compared with
+    #   the catalog. Pools that changed, or are new, are listed again with zfs list
+    # . The filesystems and volumes of the other pools are checked with one narrow zfs list -o name,<volatile columns>.
+    #   A pool whose dataset names differ (create, destroy, rename) is listed again, otherwise only the
+    #   volatile columns (mounted) are refreshed. Snapshots are not listed: that is the expensive part of a load
+    # . A missing, corrupt or mismatched catalog (other host or properties) falls back to a full load
+    # . The catalog is rewritten when anything changed, otherwise only its mtime is updated
+    # Note: Snapshot renames and property changes (zfs set) that leave dataset names and space unchanged
+    #       are not detected. Load without cache to pick those up
+    def _fetch_cached(self, path, max_age, zfs_props, zpool_props):
+        meta = _catalogMeta(self.connection.host, zfs_props, zpool_props, self.have_mounts)
+        cat = _readCatalog(path)
+        if not cat is None and not cat['meta'] == meta: cat = None
+
+        if not cat is None and not max_age is None and time.time() - cat['created'] <= max_age:
+            return (OrderedDict(cat['zfs']), OrderedDict(cat['zpool']))
+
+        zpool_rows = self._fetch_zpool(zpool_props)
+        if cat is None:
+            zfs_rows = self._fetch_zfs(zfs_props)
 
+        else:
+            zpool_old = dict(cat['zpool'])
+            fp = _poolFingerprint(zpool_props)
+            stale = [ p for p in zpool_rows if not p in zpool_old or not fp(zpool_rows[p]) == fp(zpool_old[p]) ]
+
+            # Group rows by pool so each pool keeps its parents-first order
+            by_pool = {}
+            for (name, values) in cat['zfs']:
+                by_pool.setdefault(_poolOf(name), []).append((name, values))
+
+            changed = False
+            keep = [ p for p in zpool_rows if not p in stale ]
+            if keep:
+                vcols = [ c for c in zfs_props[1:] if c in _CATALOG_VOLATILE ]
+                vidx = [ zfs_props.index(c) - 1 for c in vcols ]
+                out = self.connection.run(["zfs", "list", "-Hpr", "-o", ",".join( ['name'] + vcols ), "-t", "filesystem,volume"] + keep)
+                current = {}
+                for (name, values) in _extractRows(out, ['name'] + vcols):
+                    current.setdefault(_poolOf(name), []).append((name, values))
+                for p in keep:
+                    rows = by_pool.get(p, [])
+                    ds_idx = [ i for (i, (name, _)) in enumerate(rows) if not '@' in name ]
+                    now = current.get(p, [])
+                    if not [ rows[i][0] for i in ds_idx ] == [ r[0] for r in now ]:
+                        stale.append(p)
+                        continue
+                    for (i, (_, vvalues)) in zip(ds_idx, now):
+                        (name, values) = rows[i]
+                        if all( values[j] == v for (j, v) in zip(vidx, vvalues) ): continue
+                        values = list(values)
+                        for (j, v) in zip(vidx, vvalues): values[j] = v
+                        rows[i] = (name, values)
+                        changed = True
+
+            if not stale and not changed and list(zpool_rows.items()) == [ (p, v) for (p, v) in cat['zpool'] ]:
+                os.utime(path) # Still current
+                return (OrderedDict(cat['zfs']), zpool_rows)
+            for p in stale: by_pool[p] = []
+            if stale:
+                for (name, values) in self._fetch_zfs(zfs_props, stale).items():
+                    by_pool.setdefault(_poolOf(name), []).append((name, values))
+
+            zfs_rows = OrderedDict()
+            for p in zpool_rows:
+                zfs_rows.update( by_pool.get(p, []) )
+
+        _writeCatalog(path, meta, zfs_rows, zpool_rows)
+        return (zfs_rows, zpool_rows)
+
+
+    # save_catalog() - Writes this PoolSet (tree, properties and load settings) to a catalog file
+    # The file can be passed as Connection.load_poolset(cache=path) for a warm start
+    def save_catalog(self, path:str):
+        assert not self._zfs_props is None, "PoolSet not loaded"
+        zfs_cols = self._zfs_props[1:]
+        zpool_cols = self._zpool_props[1:]
+        zfs_rows = []
+        zpool_rows = []
+        for item in self.walk():
+            props = item._properties
+            zfs_rows.append( (item.path, [ props.get(c) for c in zfs_cols ]) )
+            if isinstance(item, Pool):
+                zpool_rows.append( (item.path, [ props.get(c) for c in zpool_cols ]) )
+        meta = _catalogMeta(self.connection.host, self._zfs_props, self._zpool_props, self.have_mounts)
+        _writeCatalog(path, meta, zfs_rows, zpool_rows)
+
+
+    # Builds or updates the tree from zfs and zpool rows. Items not in zfs_rows are removed
+    def _build(self, zfs_props, zpool_props, zfs_rows, zpool_rows):
+        zfs_cols = zfs_props[1:]
+        zpool_cols = zpool_props[1:]
 
         # names of pools
         old_items = [ x.path for x in self.walk() ]
         old_items.reverse()
-        new_items = zfs_list_items.keys()
-        pool_cur = None
+        new_items = zfs_rows.keys()
 
         for name in new_items:
             is_zpool = False
@@ -191,34 +373,33 @@ class PoolSet(object):
             else:
                 snapshot = None
             if "/" not in name:  # zpool
+                is_zpool = snapshot is None
                 if name not in self._pools:
-                    is_zpool = True
-                    pool_cur = Pool(name, self.connection, self.have_mounts)
-                    self._pools[name] = pool_cur
-                    fs = self._pools[name]
-
-            poolname, pathcomponents = name.split("/")[0], name.split("/")[1:]
-            fs = self._pools[poolname]
-            for pcomp in pathcomponents:
-                # traverse the child hierarchy or create if that fails
-                try: fs = fs.get_child(pcomp)
-                except KeyError:
-                    fs = Dataset(pool_cur, pcomp, fs)
+                    pool = Pool(name, self.connection, self.have_mounts, poolset=self)
+                    self._pools[name] = pool
+                    self._index[name] = pool
+
+            # parents are listed before their children so the parent is found with one probe
+            i = name.rfind("/")
+            fs = self._index.get(name)
+            if fs is None:
+                parent = self._index[name[:i]]
+                fs = Dataset(parent.pool, name[i+1:], parent)
 
             if snapshot:
-                if snapshot not in [ x.name for x in fs.children ]:
-                    fs = Snapshot(pool_cur, snapshot, fs)
+                try: fs = fs.get_snapshot(snapshot)
+                except KeyError:
+                    fs = Snapshot(fs.pool, snapshot, fs)
 
-            fs._properties.update( zfs_list_items[fs.path] )
+            fs._properties.update( zip(zfs_cols, zfs_rows[fs.path]) )
+            fs._props_missing = None
 
             if is_zpool:
                 # Update with zpool properties
-                _zpool_props = zpool_list_items.get(name, __DEFAULT__)
+                _zpool_props = zpool_rows.get(name, __DEFAULT__)
                 assert _zpool_props != __DEFAULT__, f"ERROR - zpool '{name}' not found in zpool_list_items"
-                fs._properties.update( _zpool_props )
+                fs._properties.update( zip(zpool_cols, _zpool_props) )
 
-            noop()
-            
             # std_avail is avail, std_ref is usedds
 
 
@@ -232,31 +413,166 @@ class PoolSet(object):
 
 
     def remove(self, name):  # takes a NAME, unlike the child that is taken in the remove of the dataset method
-        for c in self._pools[name].children:
-            self._pools[name].remove(c)
-        self._pools[name].invalidated = True
+        pool = self._pools[name]
+        for c in list(pool.children):
+            pool.remove(c)
+        pool.invalidated = True
         del self._pools[name]
+        if not self._index is None: self._index.pop(name, None)
+
+
+    # create_snapshots() - Snapshot many datasets at once
+    # datasets - list(of Pool / Dataset or name)
+    # name - name of the snapshot
+    # recursive - Use zfs snapshot -r for selected datasets whose whole subtree is selected
+    # Returns: list(of Snapshot) - the new snapshots. They are added to this PoolSet without a reload
+    # Notes:
+    # . All snapshots of one zfs snapshot command are taken in the same transaction group (atomic)
+    # . Commands are kept under ZFS_ARG_MAX. Selections that do not fit in one command are split
+    #   into several commands, which are not atomic with each other
+    def create_snapshots(self, datasets, name:str, recursive:bool=True) -> list:
+        assert isinstance(name, str) and name and not '@' in name and not '/' in name, f"Invalid snapshot name '{name}'"
+        items = []
+        for ds in datasets:
+            if isinstance(ds, str): ds = self.lookup(ds)
+            assert isinstance(ds, Snapable), f"Not a Pool or Dataset: {ds}"
+            items.append(ds)
+        items = uniq(items)
+        if not items: return []
+
+        (cmds, targets) = _snapshotCommands(items, name, recursive)
+        for cmd in cmds:
+            self.connection.run(cmd)
+
+        # Narrow zfs list of just the new snapshots
+        props = self._zfs_props or ['name', 'creation']
+        created = []
+        for cmd in _chunkArgs(["zfs", "list", "-Hp", "-o", ",".join(props), "-t", "snapshot"], [ ds.path + '@' + name for ds in targets ]):
+            out = self.connection.run(cmd)
+            for (snap_name, props_snap) in _extractRows(out, props):
+                (ds_path, snapshot) = snap_name.split('@')
+                ds = self.lookup(ds_path)
+                snap = Snapshot(ds.pool, snapshot, ds)
+                snap._properties.update(zip(props[1:], props_snap))
+                created.append(snap)
+        return created
+
+
+    # fetch_properties() - Fetch properties that were not loaded and merge them into the items
+    # items - list(of ZFSItem or name)
+    # props - list(of property names)
+    # recursive - also fetch for everything below items (zfs get -r)
+    # snapshots - fetch for the snapshots of items (Pools / Datasets) instead of the items (zfs get -d 1 -t snapshot)
+    # Returns: int - number of values merged
+    # Notes:
+    # . All items and props go in one zfs get -Hp -o name,property,value command, split only to stay under ZFS_ARG_MAX
+    # . Values are decoded with the property schema (see ZFS_PROPERTY_TYPES)
+    # . Raises KeyError if zfs get fails (eg. an invalid property name). Properties zfs does not
+    #   report for an item are remembered so get_property() does not ask again
+    def fetch_properties(self, items, props:list, recursive:bool=False, snapshots:bool=False) -> int:
+        assert isinstance(props, list) and props, "props must be a non-empty list"
+        assert not (recursive and snapshots), "recursive and snapshots cannot be combined"
+        items = uniq([ self.lookup(i) if isinstance(i, str) else i for i in items ])
+        if not items: return 0
+
+        # Items whose values are expected. Used for the negative cache
+        if recursive:
+            expected = [ c for i in items for c in i.walk() ]
+        elif snapshots:
+            expected = [ c for i in items for c in i.get_snapshots() ]
+        else:
+            expected = items
+
+        base = ["zfs", "get", "-Hp", "-o", "name,property,value"]
+        if recursive: base = base + ["-r"]
+        if snapshots: base = base + ["-d", "1", "-t", "snapshot"]
+        base = base + [",".join(props)]
+
+        raw = {} # prop -> list(of tuple(item, value))
+        try:
+            for cmd in _chunkArgs(base, [ i.path for i in items ]):
+                out = self.connection.run(cmd)
+                if isinstance(out, bytes): out = out.decode('utf-8')
+                for line in out.splitlines():
+                    if not line: continue
+                    (name, prop, value) = line.split('\t', 2)
+                    item = self._index.get(name)
+                    if not item is None: raw.setdefault(prop, []).append((item, value))
+        except (subprocess.CalledProcessError, OSError) as ex:
+            stderr = getattr(ex, 'stderr', None)
+            if isinstance(stderr, bytes): stderr = stderr.decode('utf-8', 'replace')
+            # Only properties zfs rejected are remembered as missing. Other failures (ssh, dataset destroyed meanwhile, ...) may not last
+            rejected = [ p for p in re.findall(r"invalid property '([^']+)'", stderr or '') if p in props ]
+            if not rejected and 'bad property list' in (stderr or ''): rejected = props
+            if rejected: _markPropsMissing(expected, rejected)
+            raise KeyError(f"zfs get {','.join(props)} failed: {(stderr or str(ex)).strip()}") from None
+
+        count = 0
+        for (prop, pairs) in raw.items():
+            values = _decodeColumn(prop, [ v for (_, v) in pairs ])
+            for ((item, _), v) in zip(pairs, values):
+                item._properties[prop] = v
+            count += len(pairs)
+        _markPropsMissing(expected, props)
+        return count
 
 
     # resolve Pool and Dataset for a path on local filesystem using the mountpoint
     # Note: Ignores any dataset with root mountpoint (/)
+    # Returns the dataset with the longest mountpoint containing path
     # eg: (dataset, real_path, rel_path) = find_dataset_for_path('/dpool/foo/bar/baz.sh')
     def find_dataset_for_path(self, path):
         assert self.have_mounts, "Mount information not loaded. Please use Connection.load_poolset(get_mounts=True)."
-        p_real = os.path.abspath( expand_user(path) )
-        p_real = os.path.realpath(p_real)
-        mp=None
-        for pool_c in self:
-            datasets = pool_c.get_all_datasets()
-            for ds_c in datasets:
-                if not ds_c.has_mount \
-                    or ds_c.mountpoint is None \
-                    or ds_c.mountpoint == '/': continue
-                if p_real.find(ds_c.mountpoint) == 0:
-                    if mp is None or len(ds_c.mountpoint) > len(mp):
-                        return (ds_c, p_real, p_real.replace(ds_c.mountpoint, ''))
-                        
-        return (None, None, None)
+        p_real = self.connection.fs.realpath([path])[0]
+        return self._find_mount(p_real)
+
+
+    # Batch version of find_dataset_for_path()
+    # paths - iterable of paths
+    # resolve_links - Resolve symlinks (realpath). Set to False for paths that are already canonical
+    # Yields: tuple(of dataset, real_path, rel_path) for each path in order
+    # Note: Paths are resolved on the connection's host in batches of PROBE_BATCH
+    def resolve_paths(self, paths, resolve_links:bool=True):
+        assert self.have_mounts, "Mount information not loaded. Please use Connection.load_poolset(get_mounts=True)."
+        fs = self.connection.fs
+        for chunk in _chunks(paths, PROBE_BATCH):
+            if resolve_links:
+                reals = fs.realpath(chunk)
+            else:
+                reals = [ os.path.abspath( expand_user(p) ) for p in chunk ]
+            for p_real in reals:
+                yield self._find_mount(p_real)
+
+
+    # Walks up the components of p_real probing the mountpoint index
+    # . Costs one dict lookup per path component
+    def _find_mount(self, p_real):
+        idx = self._get_mount_index()
+        p = p_real
+        while True:
+            ds = idx.get(p)
+            if not ds is None:
+                return (ds, p_real, p_real[len(p):])
+            i = p.rfind('/')
+            if i <= 0: return (None, None, None)
+            p = p[:i]
+
+
+    # Index of mountpoint -> Dataset. Built once per load
+    def _get_mount_index(self):
+        if self._mount_index is None:
+            idx = {}
+            for pool_c in self:
+                for ds_c in pool_c.walk(only=Dataset, include_snapshots=False):
+                    if not ds_c.has_mount \
+                        or ds_c.mountpoint is None \
+                        or ds_c.mountpoint == '/': continue
+                    # On duplicate mountpoints, prefer the dataset that is mounted
+                    ds_cur = idx.get(ds_c.mountpoint)
+                    if ds_cur is None or (ds_c.mounted and not ds_cur.mounted):
+                        idx[ds_c.mountpoint] = ds_c
+            self._mount_index = idx
+        return self._mount_index
 
 
     def __getitem__(self, name):
@@ -268,10 +584,10 @@ class PoolSet(object):
     __repr__ = __str__
 
 
-    def walk(self):
+    # walk() - Iterates all pools and their contents. See ZFSItem.walk() for arguments
+    def walk(self, **kwargs):
         for item in self._pools.values():
-            for dset in item.walk():
-                yield dset
+            yield from item.walk(**kwargs)
 
     def __iter__(self):
         for pool in self._pools:
@@ -281,6 +597,127 @@ class PoolSet(object):
 
 
 
+''' Filesystem Probes
+
+ Path queries (exists, stat, realpath) against the host of a Connection.
+ All calls are batched: they take a list of paths and return a list of results in the same order.
+ - stat results are tuple(of inode, size, mtime_ns, mode) or None if the path does not exist or cannot be stat'ed
+'''
+
+PROBE_BATCH = 500
+
+class LocalProbe(object):
+
+    def exists(self, paths, max_workers:int=None):
+        return _probeMany(os.path.exists, paths, max_workers)
+
+    def stat(self, paths, max_workers:int=None):
+        return _probeMany(_statPath, paths, max_workers)
+
+    def realpath(self, paths, max_workers:int=None):
+        return [ os.path.realpath( os.path.abspath( expand_user(p) ) ) for p in paths ]
+
+    def close(self):
+        pass
+
+
+# Small helper that RemoteProbe runs on the remote host with python3 over the ssh command
+# . Reads requests and writes responses as frames of: uint32 (big endian) length + json
+# . Kept compatible with python 3.5 as it runs on whatever python3 the remote has
+_PROBE_AGENT = r'''
+import sys, os, json, struct
+from concurrent.futures import ThreadPoolExecutor
+def _stat(p):
+    try:
+        st = os.stat(p)
+        return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode]
+    except OSError:
+        return None
+def _real(p):
+    return os.path.realpath(os.path.abspath(os.path.expanduser(p)))
+OPS = {'exists': os.path.exists, 'stat': _stat, 'realpath': _real}
+f_in = sys.stdin.buffer
+f_out = sys.stdout.buffer
+while True:
+    head = f_in.read(4)
+    if len(head) < 4: break
+    req = json.loads(f_in.read(struct.unpack('>I', head)[0]).decode('ascii'))
+    try:
+        fn = OPS[req['op']]
+        workers = req.get('workers') or 1
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool: res = list(pool.map(fn, req['paths']))
+        else:
+            res = [fn(p) for p in req['paths']]
+        resp = {'ok': True, 'res': res}
+    except Exception as ex:
+        resp = {'ok': False, 'error': repr(ex)}
+    data = json.dumps(resp).encode('ascii')
+    f_out.write(struct.pack('>I', len(data)) + data)
+    f_out.flush()
+'''
+
+# Runs _PROBE_AGENT on the remote side of the ssh command and sends it batched requests
+# . The agent is started on first use and kept for the life of the probe (one ssh session)
+# . Each call costs one round trip per PROBE_BATCH paths
+class RemoteProbe(object):
+
+    def __init__(self, command, python:str='python3'):
+        self._command = list(command) + ["{} -c {}".format(python, shlex.quote(_PROBE_AGENT))]
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def exists(self, paths, max_workers:int=None):
+        return self._call('exists', paths, max_workers)
+
+    def stat(self, paths, max_workers:int=None):
+        return [ None if st is None else tuple(st) for st in self._call('stat', paths, max_workers) ]
+
+    def realpath(self, paths, max_workers:int=None):
+        return self._call('realpath', paths, max_workers)
+
+    def close(self):
+        with self._lock:
+            if not self._proc is None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc = None
+
+    def _call(self, op, paths, max_workers):
+        res = []
+        with self._lock:
+            if self._proc is None or not self._proc.poll() is None:
+                self._proc = subprocess.Popen(self._command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=False)
+            for chunk in _chunks(paths, PROBE_BATCH):
+                data = json.dumps({'op': op, 'paths': chunk, 'workers': max_workers}).encode('ascii')
+                try:
+                    self._proc.stdin.write(struct.pack('>I', len(data)) + data)
+                    self._proc.stdin.flush()
+                    head = self._proc.stdout.read(4)
+                    if len(head) < 4: raise EOFError()
+                    resp = json.loads(self._proc.stdout.read(struct.unpack('>I', head)[0]).decode('ascii'))
+                except (OSError, EOFError):
+                    self._proc.kill()
+                    self._proc = None
+                    raise RuntimeError(f"Remote probe failed. Is python3 available on the remote host? Command: {self._command[:-1]}")
+                if not resp['ok']:
+                    raise RuntimeError(f"Remote probe '{op}' failed: {resp['error']}")
+                res.extend(resp['res'])
+        return res
+
+
+def _statPath(p):
+    try:
+        st = os.stat(p)
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+    except OSError: # Same as the remote agent and os.path.exists(): unreadable counts as absent
+        return None
+
+''' END Filesystem Probes '''
+
+
+
+
 ''' ZFS Entities
 
  Model:
@@ -298,29 +735,102 @@ class PoolSet(object):
 
 # ZFSItem is an 'abstract' class for Pool, Dataset and Snapshot
 class ZFSItem(object):
-    name = None
+    _name = None
+    _parent = None
+    path = None # full name. Kept up to date by _repath()
     children = None
     _properties = None
-    parent = None
+    _props_missing = None # set(of property names) zfs get did not report. See get_property()
     invalidated = False
 
-    creation = property(lambda self: datetime.fromtimestamp(int(self._properties["creation"])))
+    creation = property(lambda self: datetime.fromtimestamp(self._properties["creation"]))
 
     def __init__(self, pool, name, parent=None):
         self.pool = pool
-        self.name = name
+        self._name = name
         self.children = []
         self._properties = {}
+        self._parent = parent if parent else None
+        self._set_path()
         if parent:
-            self.parent = parent
             self.parent._add_child(self)
 
+
+    def _get_name(self):
+        return self._name
+    def _set_name(self, name):
+        self._name = name
+        self._repath()
+    name = property(_get_name, _set_name)
+
+
+    # Setting parent moves the item (and its subtree) under the new parent
+    def _get_parent(self):
+        return self._parent
+    # . The subtree takes the pool of the new parent. A moved Snapshot takes the new parent as its dataset
+    # . Setting None detaches the item: it and its subtree are dropped from the index
+    def _set_parent(self, parent):
+        old = self._parent
+        if old is parent: return
+        assert not isinstance(self, Pool), "A Pool cannot be moved"
+        items = list(_walkItems(self, None, None, None, False, False))
+        index = self._get_index()
+        if not index is None:
+            for c in items:
+                if index.get(c.path) is c: del index[c.path]
+        if not old is None and self in old.children: old.children.remove(self)
+        self._parent = parent
+        if not parent is None:
+            parent.children.append(self)
+            for c in items: c.pool = parent.pool
+            if isinstance(self, Snapshot):
+                self.dataset = parent if isinstance(parent, Dataset) else None
+        for c in items: c._set_path() # parents come first
+        index = None if parent is None else parent._get_index()
+        if not index is None:
+            for c in items: index[c.path] = c
+    parent = property(_get_parent, _set_parent)
+
+
+    # Computes path (and derived paths in subclasses) from the parent's
+    def _set_path(self):
+        self.path = self._name
+
+
+    # Recomputes the paths of this item and all items below it and re-keys them in the index
+    def _repath(self):
+        index = self._get_index()
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            old = item.path
+            item._set_path()
+            if not index is None and index.get(old) is item:
+                del index[old]
+                index[item.path] = item
+            stack.extend(item.children)
+
     def _add_child(self, child):
         self.children.append(child)
+        index = self._get_index()
+        if not index is None: index[child.path] = child
         return child
 
 
+    # Full name index of the PoolSet this item is registered in or None (eg. for a detached item)
+    def _get_index(self):
+        poolset = None if self.pool is None else self.pool.poolset
+        index = None if poolset is None else poolset._index
+        if index is None or not index.get(self.path) is self: return None
+        return index
+
+
     def get_child(self, name):
+        index = self._get_index()
+        if not index is None and not self.invalidated:
+            child = index.get(f"{self.path}/{name}") or index.get(f"{self.path}@{name}")
+            if child is None: raise KeyError(name)
+            return child
         child = [ c for c in self.children if c.name == name ]
         assert len(child) < 2
         if not child: raise KeyError(name)
@@ -329,25 +839,58 @@ class ZFSItem(object):
 
     def remove(self, child):
         if child not in self.children: raise KeyError(child.name)
-        child.invalidated = True
-        child.parent = None
+        items = list(child.walk())
+        index = self._get_index()
+        if not index is None:
+            for c in items: index.pop(c.path, None)
         self.children.remove(child)
-        for c in child.children:
-            child.remove(c)
-
-
-    def walk(self):
+        for c in items:
+            c.invalidated = True
+            c._parent = None
+            c.children = []
+            c._set_path()
+
+
+    # walk() - Iterates this item and everything below it without recursion
+    # only - type or tuple(of types) to yield (eg. Dataset). Other items are still traversed
+    # include_snapshots - When False, Snapshots are neither yielded nor visited
+    # max_depth - Do not descend below this depth. This item is depth 0
+    # order - 'pre' (parents before children) or 'post' (children before parents)
+    # with_depth - yield tuple(of depth, item) instead of item
+    def walk(self, only=None, include_snapshots:bool=True, max_depth:int=None, order:str='pre', with_depth:bool=False):
         assert not self.invalidated, "%s invalidated" % self
-        yield self
-        for c in self.children:
-            for element in c.walk():
-                yield element
+        assert order in ('pre', 'post'), f"order must be 'pre' or 'post'. Got: {order}"
+        assert max_depth is None or (isinstance(max_depth, int) and max_depth >= 0), f"max_depth must be a non-negative int. Got: {max_depth}"
+        # Snapshots are leaves so they can be skipped when they would not be yielded
+        skip = None
+        if not include_snapshots or (not only is None and not issubclass(Snapshot, only)):
+            skip = Snapshot
+        return _walkItems(self, only, skip, max_depth, order == 'post', with_depth)
 
     def __iter__(self):
         return self.walk()
 
+    # get_property() - Value of a property
+    # Properties that were not loaded are fetched with zfs get and kept (see PoolSet.fetch_properties()):
+    # . for a Snapshot, for all snapshots of its dataset in one call
+    # . for a Pool or Dataset, for the item only
+    # Raises KeyError if the property does not exist or cannot be fetched. Such properties are not asked for again
     def get_property(self, name):
-        return self._properties[ name ]
+        try:
+            return self._properties[ name ]
+        except KeyError:
+            pass
+        poolset = None if self.pool is None else self.pool.poolset
+        if poolset is None or self.invalidated or (not self._props_missing is None and name in self._props_missing):
+            raise KeyError(name)
+        if isinstance(self, Snapshot):
+            poolset.fetch_properties([self.parent], [name], snapshots=True)
+        else:
+            poolset.fetch_properties([self], [name])
+        try:
+            return self._properties[ name ]
+        except KeyError:
+            raise KeyError(name) from None
 
     def has_property(self, name):
         return (name in self._properties)
@@ -363,6 +906,11 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
     # Lookup for Datasets or Snapshot by dataset relative path
     # Eg. for snapshots: <dataset_path>@<snapshot>
     def lookup(self, name):
+        index = self._get_index()
+        if not index is None and not self.invalidated:
+            ret = index.get(f"{self.path}/{name}")
+            if not ret is None: return ret
+
         if "@" in name:
             path, snapshot = name.split("@")
         else:
@@ -385,11 +933,8 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
         return ret
         
 
-    def _get_path(self):
-        if not self.parent: return self.name
-        return "%s/%s" % (self.parent.path, self.name)
-
-    path = property(_get_path)
+    def _set_path(self):
+        self.path = self._name if self._parent is None else f"{self._parent.path}/{self._name}"
 
 
     # For name, use full dataset path
@@ -404,14 +949,11 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
             raise KeyError(f"Dataset '{name}' not found in Dataset '{self.path}'.")
         
 
-    # returns list(of str) or if with_depth == True then list(of tuple(of depth, Dataset))
+    # returns list(of Dataset) or if with_depth == True then list(of tuple(of depth, Dataset))
     def get_all_datasets(self, with_depth=False, depth=0):
-        a = []
-        for c in self.children:
-            if isinstance(c, Dataset):
-                a.append( (depth, c) if with_depth else c )
-                a = a + c.get_all_datasets(with_depth=with_depth, depth=depth+1)
-        return a
+        if with_depth:
+            return [ (depth + d - 1, c) for (d, c) in self.walk(only=Dataset, with_depth=True) if d > 0 ]
+        return [ c for c in self.walk(only=Dataset) if not c is self ]
 
 
     # if index is True return list(of tuple(int, Snapshot))
@@ -434,6 +976,11 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
 
 
     def get_snapshot(self, name):
+        index = self._get_index()
+        if not index is None and not self.invalidated:
+            snap = index.get(f"{self.path}@{name}")
+            if snap is None: raise KeyError(name)
+            return snap
         children = [ c for c in self.get_snapshots() if c.name == name ]
         assert len(children) < 2
         if not children: raise KeyError(name)
@@ -448,6 +995,8 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
     #  - tdelta: timedelta -or- string of nC where: n is an integer > 0 and C is one of y,m,d,H,M,S. Eg 5H = 5 Hours
     #  - dt_to: datetime to stop 
     #  - index: (bool) 
+    #  - max_workers: (int) Check 'contains' for this many snapshots at once in a thread pool.
+    #                 Checking a snapshot that is not yet mounted triggers a (slow) automount
     #  Return: 
     #  -  list(tuple(of int, snapshot)) where int is the index in current snaphot listing for dataset
     #  Notes:
@@ -474,6 +1023,7 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
         tdelta = __assert('tdelta', (str, timedelta))
         index = __assert('index', (bool), False)
         contains = __assert('contains', (str))
+        max_workers = __assert('max_workers', (int))
 
         if not contains is None:
             # Removing - Path may no longer exists in regular FS but does exist in snapshot
@@ -483,10 +1033,6 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
         
         f = dt_f = dt_t = None
         def __fil_n(snap):
-            if not contains is None:
-                _check = f'{snap.snap_path}{contains}'
-                # print(f"Checking: {_check}")
-                if not os.path.exists(_check): return False
             if not name is None and not fnmatch.fnmatch(snap.name, name): return False
             return True
 
@@ -526,18 +1072,26 @@ class Snapable(ZFSItem): # Abstract class for Pools and Datasets
             else:
                 (dt_f, dt_t) = calcDateRange(tdelta=tdelta, dt_from=dt_from, dt_to=dt_to)
         
+        if contains is None:
+            return self.get_snapshots(flt=f, index=index)
 
-        return self.get_snapshots(flt=f, index=index)
+        # Cheap name and date filters run first. Only the survivors have their snapshot dir checked
+        snaps = self.get_snapshots(flt=f, index=True)
+        found = self.pool.connection.fs.exists([f'{snap.snap_path}{contains}' for (_, snap) in snaps], max_workers=max_workers)
+        return [ (rec if index else rec[1]) for (rec, ok) in zip(snaps, found) if ok ]
 
 
 
 
 class Pool(Snapable):
-    def __init__(self, name, conn, have_mounts):
+    poolset = None
+
+    def __init__(self, name, conn, have_mounts, poolset=None):
         super(Pool, self).__init__(self, name)
         self.connection = conn
         self.have_mounts = have_mounts
         self.pool = self
+        self.poolset = poolset
 
         
     def __str__(self):
@@ -555,7 +1109,11 @@ class Dataset(Snapable):
     
     def __init__(self, pool, name, parent=None):
         super(Dataset, self).__init__(pool, name, parent)
-        self.dspath = self.path[len(pool.name)+1:]
+
+
+    def _set_path(self):
+        super(Dataset, self)._set_path()
+        self.dspath = self.path[len(self.pool.name)+1:]
 
 
     # get_diffs() - Gets Diffs in snapshot or between snapshots (if snap_to is specified)
@@ -580,7 +1138,23 @@ class Dataset(Snapable):
     #  - R       The path has been renamed
     #  - V       The path has been moved
     # ign_xattrdir - Filter out <xattrdir> entries
-    def get_diffs(self, snap_from, snap_to=None, include=None, exclude=None, file_type=None, chg_type=None, get_move:bool=False, ign_xattrdir:bool=False):
+    def get_diffs(self, snap_from, snap_to=None, include=None, exclude=None, file_type=None, chg_type=None, get_move:bool=False, ign_xattrdir:bool=False, _test_data_diff=None):
+        diffs = self.iter_diffs(snap_from, snap_to=snap_to, include=include, exclude=exclude
+                               ,file_type=file_type, chg_type=chg_type, get_move=get_move
+                               ,ign_xattrdir=ign_xattrdir, _test_data_diff=_test_data_diff)
+        try:
+            return list(diffs)
+        except subprocess.CalledProcessError as ex:
+            print(f"get_diffs() failed executing command '{ex.cmd}': {ex.stderr} ({ex.returncode})")
+            return []
+
+
+    # iter_diffs() - Streaming version of get_diffs()
+    #  - Yields Diff objects as `zfs diff` emits rows so memory use does not grow with the diff
+    #  - Takes the same arguments as get_diffs()
+    #  - Raises subprocess.CalledProcessError if zfs diff fails
+    # [_test_data_diff] testing only
+    def iter_diffs(self, snap_from, snap_to=None, include=None, exclude=None, file_type=None, chg_type=None, get_move:bool=False, ign_xattrdir:bool=False, _test_data_diff=None):
         self.assertHaveMounts()
         assert self.mounted, "Cannot get diffs for Unmounted Dataset. Verify mounted flag on Dataset before calling"
 
@@ -613,32 +1187,29 @@ class Dataset(Snapable):
             snap_left = snap_from
             snap_right = '(present)'
 
-        try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-            stdout, stderr = p.communicate()
-            stdout=stdout.decode('utf-8')
-            stderr=stderr.decode('utf-8')
-            if not p.returncode == 0:
-                print(f"get_diffs() failed executing command '{cmd}': {stderr} ({p.returncode})")
-                return []
-        except Exception as exc:
-            raise exc
+        if _test_data_diff is None:
+            lines = _streamCommand(cmd)
+        else: # Use test data
+            lines = iter(_test_data_diff.splitlines())
 
+        return self._iter_diff_rows(lines, snap_left, snap_right, include, exclude, file_type, chg_type, get_move, ign_xattrdir)
 
-        def __row(s):
-            if isinstance(s, bytes): s = s.decode('utf-8')
-            return s.strip().split( '\t' )
 
-        rows = list(map(lambda s: __row(s), stdout.splitlines()))
-        diffs = []
-        for i, row in enumerate(rows):
+    def _iter_diff_rows(self, lines, snap_left, snap_right, include, exclude, file_type, chg_type, get_move, ign_xattrdir):
+        for s in lines:
+            if isinstance(s, str): s = s.encode('utf-8')
+            s = s.strip()
+            if not s: continue
+            # Fast path: only rows containing an escape need unescaping
+            if b'\\' in s:
+                row = [unescapeDiffPath(c) for c in s.split(b'\t')]
+            else:
+                row = s.decode('utf-8').split( '\t' )
 
             if ign_xattrdir and row[3].find('/<xattrdir>') > -1: 
                 continue
 
-            # if i == 429:
-            #     print("HERE")
-            d = Diff(row, snap_left, snap_right, get_move=get_move)
+            d = Diff(row, snap_left, snap_right, get_move=get_move, unescape=False)
             if d.path_full.find('(on_delete_queue)') > 0:
                 # It looks to be an artefact of ZFS that does not actually exist in FS
                 # https://github.com/openzfs/zfs/blob/master/lib/libzfs/libzfs_diff.c
@@ -665,9 +1236,89 @@ class Dataset(Snapable):
                         break
                 if bIgn: continue
 
-            diffs.append(d)
+            yield d
+
+
+    # file_history() - Distinct versions of a file across the snapshots of this Dataset
+    # path - path to file on the system being analyzed (need not exist in working copy)
+    # Returns: list(of FileVersion) oldest first
+    # Notes:
+    # - Assumes the file is present in one contiguous run of snapshots. The edges of the run
+    #   are found by bisection, so snapshots outside of it are mostly never touched
+    # - Versions are told apart by (inode, size, mtime). If the first and last snapshot of a range
+    #   have the same identity, every snapshot in between is assumed to be that version
+    # - Touches O(log n + versions) snapshots instead of all n
+    def file_history(self, path):
+        rel = self.get_rel_path(path)
+        snaps = sorted(self.get_snapshots(), key=lambda snap: snap.get_property('creation'))
+        n = len(snaps)
+        if n == 0: return []
+
+        fs = self.pool.connection.fs
+        stats = {}
+        def __stat(i):
+            if not i in stats:
+                st = fs.stat([f'{snaps[i].snap_path}{rel}'])[0]
+                stats[i] = None if st is None else st[:3]
+            return stats[i]
+
+        # Probe newest and oldest first then progressively finer midpoints until the file is found
+        def __probe_order():
+            yield n - 1
+            yield 0
+            q = deque([(0, n - 1)])
+            while q:
+                (lo, hi) = q.popleft()
+                if hi - lo < 2: continue
+                mid = (lo + hi) // 2
+                yield mid
+                q.append((lo, mid))
+                q.append((mid, hi))
+
+        found = None
+        for i in __probe_order():
+            if not __stat(i) is None:
+                found = i
+                break
+        if found is None: return []
+
+        # Bisect for the first and last snapshot containing the file
+        (lo, hi) = (0, found)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if __stat(mid) is None: lo = mid + 1
+            else: hi = mid
+        first = lo
+
+        (lo, hi) = (found, n - 1)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if __stat(mid) is None: hi = mid - 1
+            else: lo = mid
+        last = lo
+
+        # Split [lo, hi] until both ends of each range have the same identity
+        def __split(lo, hi):
+            if __stat(lo) == __stat(hi): return [(lo, hi)]
+            if hi - lo == 1: return [(lo, lo), (hi, hi)]
+            mid = (lo + hi) // 2
+            left = __split(lo, mid)
+            right = __split(mid, hi)
+            # mid is in both halves
+            (l_lo, _) = left.pop()
+            (_, r_hi) = right[0]
+            right[0] = (l_lo, r_hi)
+            return left + right
 
-        return diffs
+        res = []
+        for (lo, hi) in __split(first, last):
+            st = __stat(lo)
+            if st is None: continue
+            if res and res[-1]._stat == st and res[-1]._hi == lo - 1:
+                res[-1]._extend(snaps, hi)
+            else:
+                res.append(FileVersion(snaps, lo, hi, rel, st))
+        return res
 
 
     def _get_mountpoint(self):
@@ -681,7 +1332,7 @@ class Dataset(Snapable):
     def _get_mounted(self):
         if self._mounted is None:
             self.assertHaveMounts()
-            self._mounted = True if self.get_property('mounted') == 'yes' else False
+            self._mounted = self.get_property('mounted') is True
         return self._mounted
     mounted = property(_get_mounted)
 
@@ -693,8 +1344,7 @@ class Dataset(Snapable):
     def get_rel_path(self, path):
         self.assertHaveMounts()
         assert isinstance(path, str), f"argument passed is not a string. Got: {type(path)}"
-        p_real = os.path.abspath( expand_user(path) )
-        p_real = os.path.realpath(p_real)
+        p_real = self.pool.connection.fs.realpath([path])[0]
         mp = self.mountpoint
         if not p_real.find(mp) == 0:
             raise KeyError(f'path given is not in current dataset mountpoint {mp}. Path: {path}')
@@ -724,24 +1374,29 @@ class Snapshot(ZFSItem):
         self.dataset = parent if isinstance(parent, Dataset) else None
 
 
-    def _get_path(self):
-        if not self.parent: return self.name
-        return "%s@%s" % (self.parent.path, self.name)
-    path = property(_get_path)
-
+    name_full = None # <dataset path without pool>@<name>. None for snapshots of pools
+    _snap_path = None # tuple(of mountpoint, snap_path) - cache of snap_path
 
-    def _get_name_full(self):
-        if not self.parent: return self.name
-        return "%s@%s" % (self.parent.dspath, self.name)
-    name_full = property(_get_name_full)
+    def _set_path(self):
+        parent = self._parent
+        if parent is None:
+            self.path = self.name_full = self._name
+        else:
+            self.path = f"{parent.path}@{self._name}"
+            self.name_full = f"{parent.dspath}@{self._name}" if isinstance(parent, Dataset) else None
+        self._snap_path = None
 
 
     # Resolves the path to .zfs/snapshot directory
+    # . Cached until the snapshot is renamed or moved or the mountpoint changes
     def _get_snap_path(self):
         assert isinstance(self.parent, Dataset), \
             "This function is only available for Snapshots of Datasets not Pools"
         self.parent.assertHaveMounts()
-        return str(pathlib.Path(self.parent.mountpoint) / f".zfs/snapshot/{self.name}")
+        mountpoint = self.parent.mountpoint
+        if self._snap_path is None or not self._snap_path[0] == mountpoint:
+            self._snap_path = (mountpoint, str(pathlib.Path(mountpoint) / f".zfs/snapshot/{self._name}"))
+        return self._snap_path[1]
     snap_path = property(_get_snap_path)
 
     
@@ -753,25 +1408,42 @@ class Snapshot(ZFSItem):
     # - str = Path to item if found else path to .zfs/snapshot directory
     # eg: (found, rel_path) = snap.resolve_snap_path('<some_path_on_system>')
     def resolve_snap_path(self, path):
-        assert isinstance(self.parent, Dataset), \
-            "This function is only available for Snapshots of Datasets not Pools"
-        self.parent.assertHaveMounts()
-        assert self.parent.mounted, \
-            f"Parent Dataset {self.parent} is not mounted. Please verify datsset.mounted before calling this function"
+        return Snapshot.resolve_snap_paths([self], path)[0]
+
+
+    # Batch version of resolve_snap_path() for one path across many snapshots
+    # max_workers - Check this many snapshot dirs at once in a thread pool. Default is serial
+    # Returns: list(of tuple(of bool, str)) in the order of snapshots
+    # eg: res = Snapshot.resolve_snap_paths(ds.get_snapshots(), '<some_path_on_system>', max_workers=16)
+    @staticmethod
+    def resolve_snap_paths(snapshots, path, max_workers:int=None):
+        for snap in snapshots:
+            assert isinstance(snap.parent, Dataset), \
+                "This function is only available for Snapshots of Datasets not Pools"
+            snap.parent.assertHaveMounts()
+            assert snap.parent.mounted, \
+                f"Parent Dataset {snap.parent} is not mounted. Please verify datsset.mounted before calling this function"
 
         if path is None or not isinstance(path, str) or path.strip() == '':
             assert 0, "path must be a non-blank string"
-        path = os.path.abspath( expand_user(path) )
-        path_neweal = os.path.realpath(path)
-        snap_path_base = self.snap_path
-        ds_mp = self.dataset.mountpoint
-        if path_neweal.find(ds_mp) == -1:
-            raise KeyError(f"Path given is not within the dataset's mountpoint of {ds_mp}. Path passed: {path}")
-        snap_path = "{}{}".format(snap_path_base, path_neweal.replace(ds_mp, ''))
-        if os.path.exists(snap_path):
-            return (True, snap_path)
-        else:
-            return (False, snap_path_base)
+        if not snapshots: return []
+        fs = snapshots[0].pool.connection.fs
+        path_neweal = fs.realpath([path])[0]
+
+        # Relative path is the same for all snapshots of a dataset
+        rel_paths = {}
+        checks = []
+        for snap in snapshots:
+            ds = snap.dataset
+            if not ds in rel_paths:
+                ds_mp = ds.mountpoint
+                if path_neweal.find(ds_mp) == -1:
+                    raise KeyError(f"Path given is not within the dataset's mountpoint of {ds_mp}. Path passed: {path}")
+                rel_paths[ds] = path_neweal.replace(ds_mp, '')
+            checks.append("{}{}".format(snap.snap_path, rel_paths[ds]))
+
+        found = fs.exists(checks, max_workers=max_workers)
+        return [ ((True, snap_path) if ok else (False, snap.snap_path)) for (snap, snap_path, ok) in zip(snapshots, checks, found) ]
 
 
     def __str__(self):
@@ -781,13 +1453,42 @@ class Snapshot(ZFSItem):
 
     # Legacy Shims
     def get_path(self):
-        return self._get_path()
+        return self.path
 
 # END Snapshot
 
 
 
 
+class FileVersion():
+    # snapshots - list(of Snapshot) containing this version, oldest first
+    # first / last - first and last Snapshot containing this version
+    # inode, size, mtime (datetime) - identity of the version
+    # snap_path - path to the file in the first snapshot
+    def __init__(self, snaps, lo, hi, rel_path, st):
+        self._stat = st
+        self._lo = lo
+        (self.inode, self.size, mtime_ns) = st
+        self.mtime = datetime.fromtimestamp(mtime_ns / 1e9)
+        self.rel_path = rel_path
+        self._extend(snaps, hi)
+
+    def _extend(self, snaps, hi):
+        self._hi = hi
+        self.snapshots = snaps[self._lo:hi+1]
+        self.first = self.snapshots[0]
+        self.last = self.snapshots[-1]
+
+    snap_path = property(lambda self: f'{self.first.snap_path}{self.rel_path}')
+
+    def __str__(self):
+        return "<FileVersion> {0} size: {1} mtime: {2} snapshots: {3} -> {4} ({5})".format(
+            self.rel_path, self.size, self.mtime.strftime("%Y-%m-%d %H:%M:%S")
+            ,self.first.name, self.last.name, len(self.snapshots))
+    __repr__ = __str__
+
+
+
 class Diff():
     FILE_TYPES={
          'B': 'Block device'
@@ -807,7 +1508,8 @@ class Diff():
        ,'R': 'The path has been renamed'
        ,'V': 'The path has been moved'
     }
-    def __init__(self, row, snap_left, snap_right, get_move:bool=False):
+    # unescape - Decode `zfs diff` octal escapes in paths. Pass False if row is already unescaped
+    def __init__(self, row, snap_left, snap_right, get_move:bool=False, unescape:bool=True):
         self.no_from_snap=False
         self.to_present=False
         if isinstance(snap_left, str) and snap_left == '(na-first)':
@@ -837,10 +1539,11 @@ class Diff():
         else:
             raise Exception(f"Unexpected len: {len(row)}. Row = {row}")
 
-        # Fix issue related to https://github.com/openzfs/zfs/issues/6318
-        path = path.replace("\\0040", " ")
-        if path_new: 
-            path_new = path_new.replace("\\0040", " ")
+        # zfs diff escapes special characters (see https://github.com/openzfs/zfs/issues/6318)
+        if unescape:
+            path = unescapeDiffPath(path)
+            if path_new: 
+                path_new = unescapeDiffPath(path_new)
 
         # Derrive Move change type
         if get_move and file_type == 'F' and chg_type == 'R':
@@ -912,9 +1615,168 @@ class Diff():
             ,self.path_full, ('' if not self.path_full_new else ' --> '+self.path_new))
     __repr__ = __str__
 
+
+# Remembers props that items do not have after a fetch
+def _markPropsMissing(items, props):
+    for item in items:
+        for p in props:
+            if not p in item._properties:
+                if item._props_missing is None: item._props_missing = set()
+                item._props_missing.add(p)
+
+
+# Explicit stack walk used by ZFSItem.walk(). Children are pushed in reverse so siblings come out in order
+# . In post-order an item is pushed back once (marked expanded) beneath its children
+def _walkItems(root, only, skip, max_depth, post, with_depth):
+    if not post and not with_depth and max_depth is None:
+        # Common case: no depth bookkeeping needed
+        stack = [root]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            item = pop()
+            if only is None or isinstance(item, only):
+                yield item
+            children = item.children
+            if children:
+                if skip is None:
+                    extend(reversed(children))
+                else:
+                    extend([c for c in reversed(children) if not isinstance(c, skip)])
+        return
+
+    stack = [(root, 0, False)]
+    while stack:
+        (item, d, expanded) = stack.pop()
+        descend = not expanded and item.children and (max_depth is None or d < max_depth)
+        if post and descend:
+            stack.append((item, d, True))
+        if not (post and descend) and (only is None or isinstance(item, only)):
+            yield (d, item) if with_depth else item
+        if descend:
+            d1 = d + 1
+            for c in reversed(item.children):
+                if skip is None or not isinstance(c, skip):
+                    stack.append((c, d1, False))
+
+
 ''' END ZFS Entities '''
 
-ZFS_INT_PROPS =  set("allocated,available,capacity,checkpoint,createtxg,expandsize,filesystem_count,filesystem_limit,fragmentation,free,freeing,leaked,logicalreferenced,logicalused,objsetid,quota,referenced,refquota,refreservation,reservation,size,snapshot_count,snapshot_limit,used,usedbychildren,usedbydataset,usedbyrefreservation,usedbysnapshots,userrefs,volsize,written".split(','))
+''' Property Schema
+
+ Types of zfs / zpool properties. Values are decoded once per column when a PoolSet is loaded
+ so get_property() returns ready to use values:
+   int        int                       eg. createtxg, guid, snapshot_count
+   size       int bytes. Also accepts human readable sizes (eg. 1.5G) which user properties may hold
+   bool       True / False from on / off, yes / no, true / false
+   ratio      float from 1.50x or 1.50
+   timestamp  int seconds since the epoch (eg. creation). See ZFSItem.creation for a datetime
+   enum       interned str
+ Undeclared properties are kept as str. Values that do not decode are kept as str. '-' is None
+ User properties can be declared with declare_property_type()
+'''
+
+ZFS_PROPERTY_TYPES = {}
+for (_ptype, _names) in [
+     ('size',      "allocated,available,checkpoint,expandsize,free,freeing,leaked,logicalreferenced,logicalused,quota,recordsize,referenced,refquota,refreservation,reservation,size,special_small_blocks,used,usedbychildren,usedbydataset,usedbyrefreservation,usedbysnapshots,volblocksize,volsize,written")
+    ,('int',       "capacity,copies,createtxg,filesystem_count,filesystem_limit,fragmentation,guid,load_guid,objsetid,snapshot_count,snapshot_limit,userrefs,version")
+    ,('bool',      "atime,autoexpand,autoreplace,autotrim,defer_destroy,delegation,devices,exec,listsnapshots,mounted,multihost,nbmand,overlay,readonly,relatime,setuid,utf8only,vscan,zoned")
+    ,('ratio',     "compressratio,dedupratio,refcompressratio")
+    ,('timestamp', "creation")
+    ,('enum',      "aclinherit,aclmode,acltype,canmount,casesensitivity,checksum,compression,dedup,dnodesize,encryption,failmode,health,keyformat,keystatus,logbias,normalization,primarycache,redundant_metadata,secondarycache,snapdir,sync,type,volmode,xattr")
+]:
+    ZFS_PROPERTY_TYPES.update( (p, _ptype) for p in _names.split(',') )
+
+# Kept for compatibility. Properties decoded as int
+ZFS_INT_PROPS = set( p for (p, t) in ZFS_PROPERTY_TYPES.items() if t in ('int', 'size') )
+
+_SIZE_SUFFIXES = {'B': 0, 'K': 10, 'M': 20, 'G': 30, 'T': 40, 'P': 50, 'E': 60}
+_BOOL_VALUES = {'on': True, 'yes': True, 'true': True, 'off': False, 'no': False, 'false': False}
+
+def _decodeSize(v):
+    try:
+        return int(v)
+    except ValueError:
+        # 1.5K, 1.5KB and 1.5KiB are the same. A plain B (512B) is a shift of 0
+        s = v.upper()
+        if s.endswith('IB'): s = s[:-2]
+        elif s.endswith('B') and s[-2:-1] in _SIZE_SUFFIXES: s = s[:-1]
+        shift = _SIZE_SUFFIXES.get(s[-1:])
+        if shift is None: raise
+        return int(float(s[:-1]) * (1 << shift))
+
+PROPERTY_DECODERS = {
+     'int':       int
+    ,'size':      _decodeSize
+    ,'bool':      _BOOL_VALUES.__getitem__
+    ,'ratio':     lambda v: float(v[:-1] if v.endswith('x') else v)
+    ,'timestamp': int
+    ,'enum':      sys.intern
+}
+
+
+# declare_property_type() - Declare the type of a (user) property so loads decode it
+# name - property name (eg. com.sun:auto-snapshot)
+# ptype - one of PROPERTY_DECODERS (int, size, bool, ratio, timestamp, enum) or None to keep str
+# Note: Applies to subsequent loads
+def declare_property_type(name:str, ptype:str):
+    assert isinstance(name, str) and name, "name must be a non-empty string"
+    if ptype is None:
+        ZFS_PROPERTY_TYPES.pop(name, None)
+        ZFS_INT_PROPS.discard(name)
+        return
+    assert ptype in PROPERTY_DECODERS, f"ptype must be one of {list(PROPERTY_DECODERS)}. Got: {ptype}"
+    ZFS_PROPERTY_TYPES[name] = ptype
+    if ptype in ('int', 'size'): ZFS_INT_PROPS.add(name)
+    else: ZFS_INT_PROPS.discard(name)
+
+
+# Decodes a column of raw values of property prop. Returns: list
+# . One pass with a builtin (eg. int) where the type has one. Columns with '-' or odd values
+#   are redone value by value with the full decoder
+def _decodeColumn(prop, col):
+    ptype = ZFS_PROPERTY_TYPES.get(prop)
+    has_none = '-' in col
+    if ptype is None:
+        return [ None if v == '-' else v for v in col ] if has_none else col
+    fn = PROPERTY_DECODERS[ptype]
+    if not has_none:
+        try:
+            return list(map(_FAST_DECODERS.get(ptype, fn), col))
+        except (ValueError, KeyError, IndexError):
+            pass
+    return [ None if v == '-' else _decodeValue(fn, v) for v in col ]
+
+_FAST_DECODERS = {'size': int}
+
+def _decodeValue(fn, v):
+    try:
+        return fn(v)
+    except (ValueError, KeyError, IndexError):
+        return v
+
+
+# Parses zfs list -Hp -o <props> / zpool list -Hp -o <props> output
+# Returns: list(of tuple(of name, tuple(of values in props[1:] order)))
+# . All lines are split at once and each column is a slice of the result
+def _extractRows(out, props):
+    if isinstance(out, bytes): out = out.decode('utf-8')
+    lines = [ s for s in map(str.strip, out.splitlines()) if s ]
+    if not lines: return []
+    n = len(props)
+    for s in lines:
+        assert s.count('\t') == n - 1, (props, s.split('\t'))
+    flat = '\t'.join(lines).split('\t')
+    values = [ _decodeColumn(props[i], flat[i::n]) for i in range(1, n) ]
+    return list(zip(flat[0::n], zip(*values) if values else [()] * len(lines)))
+
+
+# Parses a line of zfs list -Hp -o <props> / zpool list -Hp -o <props> output
+# Returns: list(of name, tuple(of values in props[1:] order)). '-' values are None
+def _extractProperties(s, props):
+    return list(_extractRows(s, props)[0])
+
+''' END Property Schema '''
 
 ''' General Utilities '''
 
@@ -1004,18 +1866,132 @@ def simplify(x):
     (6,8,"blah"),
     ]
     simplify(x) -> [[1, 5, 'one'], [6, 9, 'blah']]
+    See coalesceChains()
     '''
-    y = list(x)
-    if len(x) < 2: return y
-    for idx,o in enumerate(list(y)):
-        for idx2,p in enumerate(list(y)):
-            if idx == idx2: continue
-            if o and p and o[0] == p[1]:
-                y[idx] = None
-                y[idx2] = list(p)
-                y[idx2][0] = p[0]
-                y[idx2][1] = o[1]
-    return [ n for n in y if n is not None ]
+    return coalesceChains(x)
+
+
+def coalesceChains(x):
+    '''Linear time coalescing of (from, to, ...) links into chains.
+    Links are joined when the 'to' of one equals the 'from' of another. Each chain
+    is returned as a list of [first from, last to, payload of first link...] at the
+    position of its first link. Links that are not joined are returned unchanged.
+    - Branches: a link is joined to the first (lowest index) link that starts where it
+      ends and that is not already joined to another link. Other branches start new chains
+    - Cycles: a chain is started at the lowest index link of the cycle and ends when it
+      gets back to a link that is already used
+    coalesceChains([(1,2,"one"), (2,3,"two"), (6,9,"x")]) -> [[1, 3, 'one'], (6, 9, 'x')]
+    '''
+    n = len(x)
+    if n < 2: return list(x)
+
+    # start -> index of link. Starts shared by several links (branches) also go in multi
+    by_start = {}
+    multi = {}
+    for i, o in enumerate(x):
+        k = o[0]
+        if k in by_start:
+            multi.setdefault(k, [by_start[k]]).append(i)
+        else:
+            by_start[k] = i
+
+    # succ[i] is the link that continues link i
+    succ = [None] * n
+    has_pred = [False] * n
+    cursor = dict.fromkeys(multi, 0)
+    for i, o in enumerate(x):
+        k = o[1]
+        j = by_start.get(k)
+        if j is None: continue
+        if k in multi:
+            # first link for this start that is not already joined and is not link i (eg. (3,3))
+            # Joined links never become candidates again so the cursor moves past them for good
+            cands = multi[k]
+            p = cursor[k]
+            while p < len(cands) and has_pred[cands[p]]: p += 1
+            if p < len(cands) and cands[p] == i:
+                q = p + 1
+                while q < len(cands) and has_pred[cands[q]]: q += 1
+                if q < len(cands):
+                    # Links between p and q are all joined. Link i takes the place of q to stay first in line
+                    (j, cands[q], p) = (cands[q], i, q)
+                else:
+                    j = None
+            else:
+                j = cands[p] if p < len(cands) else None
+            cursor[k] = p
+            if j is None: continue
+        elif j == i or has_pred[j]:
+            continue
+        succ[i] = j
+        has_pred[j] = True
+
+    heads = {}
+    visited = [False] * n
+    def __walk(i):
+        visited[i] = True
+        end = x[i][1]
+        j = succ[i]
+        joined = False
+        while not j is None and not visited[j]:
+            visited[j] = True
+            end = x[j][1]
+            joined = True
+            j = succ[j]
+        if not joined:
+            heads[i] = x[i]
+        else:
+            o = list(x[i])
+            o[1] = end
+            heads[i] = o
+
+    for i in range(n):
+        if not has_pred[i]: __walk(i)
+    # Anything left is part of a cycle
+    for i in range(n):
+        if not visited[i]: __walk(i)
+
+    return [ heads[i] for i in sorted(heads) ]
+
+
+# unescapeDiffPath()
+# Decodes the octal escapes that `zfs diff` writes for paths
+# . zfs diff writes every byte that is not printable ASCII, plus space and backslash, as \NNNN
+#   eg. 'new\0040file' -> 'new file' and '\0303\0251' -> 'e' with acute accent
+# . Accepts str or bytes. Returns str (undecodable bytes are kept using surrogateescape)
+def unescapeDiffPath(s):
+    if isinstance(s, str):
+        if not '\\' in s: return s
+        s = s.encode('utf-8', 'surrogateescape')
+    elif not b'\\' in s:
+        return s.decode('utf-8', 'surrogateescape')
+    return _RE_DIFF_ESC.sub(_unescapeDiffMatch, s).decode('utf-8', 'surrogateescape')
+
+_RE_DIFF_ESC = re.compile(rb'\\0[0-3][0-7][0-7]')
+_DIFF_ESC_MAP = {('\\%04o' % i).encode('ascii'): bytes((i,)) for i in range(256)}
+_unescapeDiffMatch = lambda m: _DIFF_ESC_MAP[m.group(0)]
+
+
+# Applies fn to each path. Returns list of results in the order of paths
+# . With max_workers > 1, calls run concurrently in a thread pool. Checks in .zfs/snapshot
+#   can block on automount so latency drops to about one automount per batch of max_workers
+def _probeMany(fn, paths, max_workers:int=None):
+    if max_workers is None or max_workers < 2 or len(paths) < 2:
+        return [ fn(p) for p in paths ]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as pool:
+        return list(pool.map(fn, paths))
+
+
+# Splits an iterable into lists of at most size items
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
 
 def uniq(seq, idfun=None):
     '''Makes a sequence 'unique' in the style of UNIX command uniq'''
@@ -1059,9 +2035,1836 @@ def removeDuplicateSnapshotsByDate(snapshots):
     return _ret
 
 
+# Runs a command and yields its stdout line by line (bytes) without buffering the whole output
+# . stderr is spooled to a temp file so a chatty process cannot block on a full pipe
+# . Raises subprocess.CalledProcessError (with stderr) if the command exits non-zero
+# . The process is killed if the consumer stops iterating early
+def _streamCommand(cmd):
+    with tempfile.TemporaryFile() as f_err:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=f_err, shell=False)
+        try:
+            for line in p.stdout:
+                yield line
+            p.stdout.close()
+            rc = p.wait()
+            if not rc == 0:
+                f_err.seek(0)
+                raise subprocess.CalledProcessError(rc, cmd, stderr=f_err.read().decode('utf-8', 'replace').strip())
+        finally:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+
 ''' END Utilities '''
 
 
+''' Catalog
+
+ On-disk copy of a PoolSet load for warm starts (Connection.load_poolset(cache=path)).
+ Layout: header (magic, payload length, crc32) followed by a marshal payload:
+   dict(meta=[host, zfs_props, zpool_props, have_mounts, property types], zfs=list(of [name, values]), zpool=list(of [name, values]))
+ The file is memory mapped on read and replaced atomically on write. Its mtime is the time of the last validation
+'''
+
+CATALOG_MAGIC = b'ZFSLIBC2'
+_CATALOG_HEADER = struct.Struct('<8sQI')
+
+# Returns: dict(of meta, zfs, zpool, created) or None if the file is missing, corrupt or of another version
+def _readCatalog(path):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if size < _CATALOG_HEADER.size: return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            (magic, length, crc) = _CATALOG_HEADER.unpack_from(mm, 0)
+            if not magic == CATALOG_MAGIC or not length == size - _CATALOG_HEADER.size: return None
+            view = memoryview(mm)[_CATALOG_HEADER.size:]
+            try:
+                if not zlib.crc32(view) == crc: return None
+                data = marshal.loads(view)
+            except (ValueError, EOFError, TypeError):
+                return None
+            finally:
+                view.release()
+    if not isinstance(data, dict) or not {'meta', 'zfs', 'zpool'} <= data.keys(): return None
+    data['created'] = st.st_mtime
+    return data
+
+
+# rows - OrderedDict(of name -> values) or iterable(of tuple(name, values))
+def _writeCatalog(path, meta, zfs_rows, zpool_rows):
+    _list = lambda rows: [ [name, list(values)] for (name, values) in (rows.items() if isinstance(rows, dict) else rows) ]
+    payload = marshal.dumps({'meta': meta, 'zfs': _list(zfs_rows), 'zpool': _list(zpool_rows)})
+    header = _CATALOG_HEADER.pack(CATALOG_MAGIC, len(payload), zlib.crc32(payload))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.unlink(tmp)
+        raise
+
+
+# Load settings a catalog must match to be used. Includes the property types the values were decoded with
+def _catalogMeta(host, zfs_props, zpool_props, have_mounts):
+    types = [ ZFS_PROPERTY_TYPES.get(p) for p in zfs_props + zpool_props ]
+    return [host, zfs_props, zpool_props, have_mounts, types]
+
+
+# zfs list columns that change without touching a pool's space accounting. Refreshed on every revalidation
+_CATALOG_VOLATILE = ('mounted',)
+
+# Returns a function giving the fingerprint of a zpool list row: (allocated, free)
+# Note: Writes and snapshot create/destroy change it once the transaction group is synced
+#       (zfs_txg_timeout, 5s by default). Mounts, renames and property changes may not
+def _poolFingerprint(zpool_props):
+    idx = [ zpool_props.index(p) - 1 for p in ('allocated', 'free') ]
+    return lambda values: tuple( values[i] for i in idx )
+
+
+# Pool name of a dataset or snapshot name
+def _poolOf(name):
+    return re.split('[/@]', name, 1)[0]
+
+''' END Catalog '''
+
+
+''' Diff Export '''
+
+DIFF_EXPORT_FIELDS = ('dataset', 'snap_left', 'snap_left_creation', 'snap_right', 'snap_right_creation'
+                     ,'chg_ts', 'chg_type', 'file_type', 'path_full', 'path_full_new')
+
+DIFF_EXPORT_CHUNK = 8192
+
+
+# export_diffs() - Write a stream of Diff objects to a file in bounded-size chunks
+# diffs - any iterable of Diff. Pass Dataset.iter_diffs() to keep memory constant
+# dest - file path (str), file descriptor (int) or binary file object
+# fmt - one of:
+#  - ndjson  One JSON object per line
+#  - csv     Header row followed by one row per Diff
+#  - arrow   Arrow IPC stream of record batches (requires pyarrow)
+# chunk_size - number of rows buffered before each write / record batch
+# Returns: int - number of rows written
+# Fields written are DIFF_EXPORT_FIELDS. Paths are the unescaped Diff paths and chg_type
+# reflects move detection when the diffs were read with get_move=True
+def export_diffs(diffs, dest, fmt:str='ndjson', chunk_size:int=DIFF_EXPORT_CHUNK) -> int:
+    assert fmt in _DIFF_EXPORTERS, f"fmt must be one of {list(_DIFF_EXPORTERS)}. Got: {fmt}"
+    assert isinstance(chunk_size, int) and chunk_size > 0, f"chunk_size must be an int > 0. Got: {chunk_size}"
+    (f, close) = _openExportDest(dest)
+    try:
+        return _DIFF_EXPORTERS[fmt](_diffRecords(diffs), f, chunk_size)
+    finally:
+        if close:
+            f.close()
+        else:
+            f.flush()
+
+
+def _openExportDest(dest):
+    if isinstance(dest, (str, pathlib.PurePath)):
+        return (open(dest, 'wb'), True)
+    if isinstance(dest, int):
+        return (open(dest, 'wb', closefd=False), True)
+    if isinstance(dest, io.TextIOBase):
+        dest.flush()
+        return (dest.buffer, False)
+    assert hasattr(dest, 'write'), f"dest must be a path, file descriptor or file object. Got: {type(dest)}"
+    return (dest, False)
+
+
+# Yields one tuple per Diff in DIFF_EXPORT_FIELDS order
+# Snapshot metadata is resolved once per snapshot rather than once per row
+def _diffRecords(diffs):
+    snap_meta = {}
+    def __meta(snap, default):
+        if snap is None: return default
+        meta = snap_meta.get(snap)
+        if meta is None:
+            creation = snap.get_property('creation') if snap.has_property('creation') else None
+            meta = snap_meta[snap] = (snap.path, None if creation is None else int(creation))
+        return meta
+
+    for d in diffs:
+        (left, left_creation) = __meta(d.snap_left, (None, None))
+        (right, right_creation) = __meta(d.snap_right, ('(present)', None))
+        snap = d.snap_right if d.snap_left is None else d.snap_left
+        yield (snap.parent.path, left, left_creation, right, right_creation
+              ,d.chg_ts, d.chg_type, d.file_type, d.path_full, d.path_full_new)
+
+
+def _exportNdjson(records, f, chunk_size):
+    fields = DIFF_EXPORT_FIELDS
+    dumps = json.dumps
+    count = 0
+    buf = []
+    for rec in records:
+        buf.append(dumps(dict(zip(fields, rec))))
+        if len(buf) == chunk_size:
+            f.write(('\n'.join(buf) + '\n').encode('utf-8'))
+            count += len(buf)
+            buf = []
+    if buf:
+        f.write(('\n'.join(buf) + '\n').encode('utf-8'))
+        count += len(buf)
+    return count
+
+
+def _exportCsv(records, f, chunk_size):
+    sbuf = io.StringIO()
+    writer = csv.writer(sbuf, lineterminator='\n')
+    writer.writerow(DIFF_EXPORT_FIELDS)
+    count = n = 0
+    for rec in records:
+        writer.writerow(rec)
+        n += 1
+        if n == chunk_size:
+            f.write(sbuf.getvalue().encode('utf-8', 'surrogateescape'))
+            sbuf.seek(0)
+            sbuf.truncate()
+            count += n
+            n = 0
+    f.write(sbuf.getvalue().encode('utf-8', 'surrogateescape'))
+    return count + n
+
+
+def _exportArrow(records, f, chunk_size):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("export_diffs(fmt='arrow') requires pyarrow. Install with: python3 -m pip install pyarrow")
+
+    schema = pa.schema([
+         ('dataset', pa.string())
+        ,('snap_left', pa.string())
+        ,('snap_left_creation', pa.int64())
+        ,('snap_right', pa.string())
+        ,('snap_right_creation', pa.int64())
+        ,('chg_ts', pa.string())
+        ,('chg_type', pa.string())
+        ,('file_type', pa.string())
+        ,('path_full', pa.string())
+        ,('path_full_new', pa.string())
+    ])
+    ncols = len(DIFF_EXPORT_FIELDS)
+    count = 0
+    with pa.ipc.new_stream(f, schema) as writer:
+        def __array(c, i):
+            try:
+                return pa.array(c, type=schema.field(i).type)
+            except UnicodeEncodeError: # Path with bytes that are not utf-8 (see unescapeDiffPath)
+                return pa.array([v if v is None else v.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace') for v in c]
+                               ,type=schema.field(i).type)
+
+        def __flush(cols):
+            writer.write_batch(pa.record_batch([__array(c, i) for i, c in enumerate(cols)], schema=schema))
+
+        cols = [[] for _ in range(ncols)]
+        n = 0
+        for rec in records:
+            for i in range(ncols):
+                cols[i].append(rec[i])
+            n += 1
+            if n == chunk_size:
+                __flush(cols)
+                count += n
+                cols = [[] for _ in range(ncols)]
+                n = 0
+        if n:
+            __flush(cols)
+            count += n
+    return count
+
+
+_DIFF_EXPORTERS = {
+     'ndjson': _exportNdjson
+    ,'csv': _exportCsv
+    ,'arrow': _exportArrow
+}
+
+''' END Diff Export '''
+
+
+
+''' Diff Content Comparison '''
+
+# Result of comparing the left and right side of a modified file
+# . changed - True if content differs. None if the comparison failed (see error)
+# . method - how the result was decided:
+#   - stat     size and mtime are equal, content was not read
+#   - size     sizes differ
+#   - content  content was compared
+# . is_text - True if neither side contains a NUL byte in its first block. None if not checked
+# . adds / rems - lines added / removed for text files (line multiset, not a positional diff)
+class ContentDiff():
+    def __init__(self, diff, size_left=None, size_right=None, changed=None, method=None, is_text=None, adds=0, rems=0, error=None):
+        self.diff = diff
+        self.size_left = size_left
+        self.size_right = size_right
+        self.changed = changed
+        self.method = method
+        self.is_text = is_text
+        self.adds = adds
+        self.rems = rems
+        self.error = error
+
+    def __str__(self):
+        if self.error:
+            return "<ContentDiff> {0} error: {1}".format(self.diff.path_full, self.error)
+        return "<ContentDiff> {0} changed: {1} ({2}) lines: -{3} +{4}".format(
+            self.diff.path_full, self.changed, self.method, self.rems, self.adds)
+    __repr__ = __str__
+
+
+# compare_diff_contents() - Compare file content for modified files in a diff
+# diffs - iterable of Diff with file_type == 'F' and chg_type == 'M' (eg. from Dataset.iter_diffs())
+# max_workers - size of the process pool. 0 or 1 runs in the current process. Default: os.cpu_count()
+# quick - Treat files with equal size and mtime as unchanged without reading them
+# count_lines - Count added / removed lines for text files that changed
+# ignore_ws - When counting lines, ignore whitespace and blank lines (like diff -bwB)
+# Yields: ContentDiff for each diff in input order
+# Note: At most max_workers * 4 comparisons are in flight so memory stays bounded for large diffs
+def compare_diff_contents(diffs, max_workers:int=None, quick:bool=True, count_lines:bool=True, ignore_ws:bool=True):
+    if max_workers is None: max_workers = os.cpu_count() or 1
+    assert isinstance(max_workers, int) and max_workers >= 0, f"max_workers must be an int >= 0. Got: {max_workers}"
+
+    def __args(d):
+        assert isinstance(d, Diff), f"Diff expected. Got: {type(d)}"
+        if not d.file_type == 'F' or not d.chg_type == 'M':
+            raise AssertionError(f"compare_diff_contents() only supports modified files (file_type = F, chg_type = M). Got: {d}")
+        return (d.snap_path_left, d.snap_path_right, quick, count_lines, ignore_ws)
+
+    if max_workers < 2:
+        for d in diffs:
+            yield ContentDiff(d, *_compareFiles(*__args(d)))
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for d in diffs:
+            pending.append((d, pool.submit(_compareFiles, *__args(d))))
+            if len(pending) >= max_workers * 4:
+                (d, fut) = pending.popleft()
+                yield ContentDiff(d, *fut.result())
+        while pending:
+            (d, fut) = pending.popleft()
+            yield ContentDiff(d, *fut.result())
+
+
+_CMP_BLOCK = 1024 * 1024
+
+# Runs in worker processes. Returns args for ContentDiff after the diff argument
+def _compareFiles(p_left, p_right, quick, count_lines, ignore_ws):
+    try:
+        st_l = os.stat(p_left)
+        st_r = os.stat(p_right)
+        (size_l, size_r) = (st_l.st_size, st_r.st_size)
+        if quick and size_l == size_r and st_l.st_mtime_ns == st_r.st_mtime_ns:
+            return (size_l, size_r, False, 'stat', None, 0, 0, None)
+
+        with open(p_left, 'rb') as f_l, open(p_right, 'rb') as f_r:
+            is_text = not b'\0' in f_l.read(8192) and not b'\0' in f_r.read(8192)
+            if size_l == size_r:
+                if size_l == 0 or _mmapEqual(f_l, f_r, size_l):
+                    return (size_l, size_r, False, 'content', is_text, 0, 0, None)
+                method = 'content'
+            else:
+                method = 'size'
+
+            (adds, rems) = (0, 0)
+            if count_lines and is_text:
+                f_l.seek(0)
+                f_r.seek(0)
+                (adds, rems) = _countLineChanges(f_l, f_r, ignore_ws)
+
+        return (size_l, size_r, True, method, is_text, adds, rems, None)
+
+    except OSError as ex:
+        return (None, None, None, None, None, 0, 0, str(ex))
+
+
+def _mmapEqual(f_l, f_r, size):
+    with mmap.mmap(f_l.fileno(), 0, access=mmap.ACCESS_READ) as m_l, \
+         mmap.mmap(f_r.fileno(), 0, access=mmap.ACCESS_READ) as m_r:
+        v_l = memoryview(m_l)
+        v_r = memoryview(m_r)
+        try:
+            for i in range(0, size, _CMP_BLOCK):
+                if v_l[i:i+_CMP_BLOCK] != v_r[i:i+_CMP_BLOCK]: return False
+            return True
+        finally:
+            v_l.release()
+            v_r.release()
+
+
+# Lines removed and added between two files using a multiset of lines
+# . This is a single streaming pass over each file rather than a positional (LCS) diff,
+#   so moved lines are not counted as changes
+def _countLineChanges(f_l, f_r, ignore_ws):
+    def __lines(f):
+        if not ignore_ws: return Counter(f)
+        c = Counter()
+        for line in f:
+            line = b''.join(line.split())
+            if line: c[line] += 1
+        return c
+
+    c_l = __lines(f_l)
+    c_r = __lines(f_r)
+    return (sum((c_r - c_l).values()), sum((c_l - c_r).values()))
+
+''' END Diff Content Comparison '''
+
+
+
+''' Stream Relay
+
+ Moves a byte stream from one file descriptor to another (eg. zfs send stdout -> zfs recv stdin)
+ without copying it through Python where the kernel allows it:
+ - os.splice when either side is a pipe (Linux)
+ - os.sendfile otherwise
+ - os.read / os.write as a fallback
+'''
+
+RELAY_CHUNK = 1 << 20
+
+# Byte counter that can be read while relays running in other threads add to it
+class ByteCounter():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    value = property(lambda self: self._value)
+
+    def add(self, n:int):
+        with self._lock:
+            self._value += n
+
+
+# relay_stream() - Copy fd_in to fd_out until EOF
+# fd_in / fd_out - file descriptors or objects with fileno()
+# rate_limit - maximum bytes per second or None
+# counter - ByteCounter to add to as data is moved or None
+# Returns: int - bytes moved
+def relay_stream(fd_in, fd_out, rate_limit:int=None, counter:ByteCounter=None, chunk_size:int=RELAY_CHUNK) -> int:
+    assert rate_limit is None or (isinstance(rate_limit, int) and rate_limit > 0), "rate_limit must be a positive int or None"
+    fd_in = fd_in if isinstance(fd_in, int) else fd_in.fileno()
+    fd_out = fd_out if isinstance(fd_out, int) else fd_out.fileno()
+
+    methods = [ m for (m, a) in ((_relaySplice, 'splice'), (_relaySendfile, 'sendfile')) if hasattr(os, a) ]
+    methods.append(_relayBuffered)
+    if methods[0] is _relaySplice:
+        for fd in (fd_in, fd_out): _growPipe(fd)
+    if not rate_limit is None:
+        # keep bursts to ~50ms worth of data
+        chunk_size = min(chunk_size, max(4096, rate_limit // 20))
+
+    total = 0
+    t_start = time.monotonic()
+    while True:
+        try:
+            n = methods[0](fd_in, fd_out, chunk_size)
+        except OSError as ex:
+            # Nothing is moved when a method is not supported for these descriptors
+            if len(methods) > 1 and ex.errno in _RELAY_UNSUPPORTED:
+                methods.pop(0)
+                continue
+            raise
+        if n == 0: break
+        total += n
+        if not counter is None: counter.add(n)
+        if not rate_limit is None:
+            ahead = total / rate_limit - (time.monotonic() - t_start)
+            if ahead > 0: time.sleep(ahead)
+    return total
+
+_RELAY_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ESPIPE)
+
+
+def _relaySplice(fd_in, fd_out, n):
+    return os.splice(fd_in, fd_out, n, flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+
+
+def _relaySendfile(fd_in, fd_out, n):
+    return os.sendfile(fd_out, fd_in, None, n)
+
+
+def _relayBuffered(fd_in, fd_out, n):
+    buf = os.read(fd_in, n)
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd_out, view):]
+    return len(buf)
+
+
+# Larger pipe buffers mean fewer splice calls. Best effort only
+def _growPipe(fd):
+    try:
+        import fcntl
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, RELAY_CHUNK)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+''' END Stream Relay '''
+
+
+
+''' Replication
+
+ Planning of zfs send / recv operations between a source and a destination tree.
+ A schedule is a list(of tuple(of op, src, dst, snap_from, snap_to)) where:
+ - op is one of full, incremental, create_stub, resume (see recursive_replicate())
+ - src is the source Dataset (or Pool) and dst is the destination or None if it does not exist yet
+'''
+
+# recursive_replicate() - Plan the operations needed to bring dst in sync with src, recursively
+# src - source Snapable
+# dst - destination Snapable or None if it does not exist yet
+# Returns: schedule - list(of tuple(of op, src, dst, snap_from, snap_to)) where op is one of:
+#  - full         Send snap_to in full
+#  - incremental  Send snap_from -> snap_to
+#  - create_stub  Source has no snapshots and dst does not exist. Create an empty dataset
+#  - resume       Finish the interrupted receive of snap_to on dst (see decode_resume_token())
+# Notes:
+# - Snapshots are paired by guid when the guid property is loaded on both sides, otherwise by name
+# - Pairing uses hash maps so planning is O(n log n) in the number of snapshots
+# - Interrupted receives are only detected if dst was loaded with get_resume_tokens=True
+def recursive_replicate(src, dst):
+    sched = []
+    stack = [(src, dst)]
+    while stack:
+        (s, d) = stack.pop()
+        sched.extend(_replicateDataset(s, d))
+        d_children = {} if d is None else { c.name: c for c in d.children if not isinstance(c, Snapshot) }
+        # Reversed so children are planned in order, depth first
+        for c in reversed([ x for x in s.children if not isinstance(x, Snapshot) ]):
+            stack.append((c, d_children.get(c.name)))
+    return sched
+
+
+# Key used to pair snapshots between source and destination
+def _snapPairKey(snaps_src, snaps_dst):
+    if snaps_src and snaps_dst \
+        and all(x.has_property('guid') for x in snaps_src) \
+        and all(x.has_property('guid') for x in snaps_dst):
+        return lambda x: x.get_property('guid')
+    return lambda x: x.name
+
+
+# Key used to order the snapshots of one pool chronologically
+# . createtxg when it is loaded for all of them. creation only has a one second resolution
+# . Otherwise (creation, name)
+def _snapOrderKey(snaps):
+    if snaps and all(x.has_property('createtxg') for x in snaps):
+        return lambda x: (x.get_property('createtxg'), x.name)
+    return lambda x: (x.get_property('creation'), x.name)
+
+
+def _replicateDataset(s, d):
+    sched = []
+    snaps_src = s.get_snapshots()
+    snaps_dst = [] if d is None else d.get_snapshots()
+
+    # An interrupted receive is finished first. Plan the rest as if it had completed
+    resumed = _resumeSnapshot(s, d)
+    if not resumed is None:
+        sched.append(("resume", s, d, None, resumed))
+        snaps_dst = snaps_dst + [resumed]
+    key = _snapPairKey(snaps_src, snaps_dst)
+    dst_by_key = { key(x): x for x in snaps_dst }
+
+    # Pair up source snapshots with their destination snapshot (or None) in chronological order
+    # . By the createtxg of the source side when loaded. txgs are per pool so the destination's are not comparable
+    # . Otherwise a pair sorts at the earliest creation of its two sides
+    order_key = _snapOrderKey(snaps_src)
+    by_txg = bool(snaps_src) and all(x.has_property('createtxg') for x in snaps_src)
+    seen = set()
+    snapshot_pairs = []
+    for ssnap in snaps_src:
+        k = key(ssnap)
+        if k in seen: continue
+        seen.add(k)
+        dsnap = dst_by_key.get(k)
+        order = order_key(ssnap) if dsnap is None or by_txg else min(order_key(ssnap), order_key(dsnap))
+        snapshot_pairs.append((order, ssnap, dsnap))
+    snapshot_pairs.sort(key=lambda x: x[0])
+
+    # Most recent snapshot that exists on both sides
+    found_common_pair = False
+    for idx, (_, m, n) in enumerate(snapshot_pairs):
+        if not n is None:
+            found_common_pair = idx
+
+    if not snaps_src:
+        if d is None:
+            # no snapshots in source, just create a stub in the target
+            sched.append(("create_stub", s, d, None, None))
+
+    elif found_common_pair is False:
+        # no snapshot is in common. Destroying the destination and resyncing would work
+        # but that is left to the caller
+        if d is not None and snaps_dst:
+            warnings.warn("Asked to replicate %s into %s but %s has snapshots and both have no snapshots in common!" % (s, d, d))
+        full_source_snapshots = sorted(snaps_src, key=order_key)
+        # send first snapshot as full snapshot and the others as one incremental
+        sched.append(("full", s, d, None, full_source_snapshots[0]))
+        if len(full_source_snapshots) > 1:
+            sched.append(("incremental", s, d, full_source_snapshots[0], full_source_snapshots[-1]))
+
+    elif found_common_pair == len(snapshot_pairs) - 1:
+        # latest common snapshot is the latest source snapshot. Datasets are in sync
+        pass
+
+    else:
+        # source has more recent snapshots than the destination. Transfer them one by one
+        snapshots_to_transfer = [ x[1] for x in snapshot_pairs[found_common_pair:] ]
+        for n in range(1, len(snapshots_to_transfer)):
+            sched.append(("incremental", s, d, snapshots_to_transfer[n - 1], snapshots_to_transfer[n]))
+
+    return sched
+
+# Source snapshot of an interrupted receive into d, or None
+def _resumeSnapshot(s, d):
+    if d is None or not d.has_property('receive_resume_token'): return None
+    token = d.get_property('receive_resume_token')
+    if token is None: return None
+    try:
+        info = decode_resume_token(token)
+        snap = s.get_snapshot(info['toname'].split('@')[-1])
+        if snap.has_property('guid') and not int(snap.get_property('guid')) == info.get('toguid'):
+            raise KeyError(f"guid of {snap.path} does not match")
+    except (ValueError, KeyError) as ex:
+        warnings.warn(f"Ignoring receive_resume_token of {d.path} ({ex}). It can be cleared with zfs recv -A {d.path}")
+        return None
+    return snap
+
+
+# decode_resume_token() - Decode a receive_resume_token property
+# Returns: dict - contents of the token, eg: toname, toguid, fromguid, object, offset, bytes
+# Raises ValueError if the token is malformed or its checksum does not match
+def decode_resume_token(token:str) -> dict:
+    try:
+        (version, checksum, packed_len, payload) = token.strip().split('-', 3)
+        (version, checksum, packed_len) = (int(version), int(checksum, 16), int(packed_len, 16))
+        compressed = bytes.fromhex(payload)
+    except ValueError:
+        raise ValueError("Malformed resume token")
+    if not version == 1:
+        raise ValueError(f"Unsupported resume token version {version}")
+
+    # checksum is the first word of a fletcher4 over the compressed data in native byte order
+    words = len(compressed) // 4
+    sums = [ sum(struct.unpack(f'{e}{words}I', compressed[:words * 4])) & 0xFFFFFFFFFFFFFFFF for e in '<>' ]
+    if not checksum in sums:
+        raise ValueError("Resume token checksum mismatch")
+
+    try:
+        packed = zlib.decompress(compressed)
+    except zlib.error as ex:
+        raise ValueError(f"Resume token cannot be decompressed: {ex}")
+    if not len(packed) == packed_len:
+        raise ValueError("Resume token length mismatch")
+    return unpackNvlist(packed)
+
+
+# unpackNvlist() - Decode a native encoded, packed nvlist (see nvlist_pack(3))
+# Returns: dict. Nested nvlists are dicts, booleans without value are True
+def unpackNvlist(buf:bytes) -> dict:
+    if len(buf) < 4 or not buf[0] == 0:
+        raise ValueError("Only native encoded nvlists are supported")
+    e = '<' if buf[1] == 1 else '>'
+    (nvl, _) = _unpackNvl(buf, 4, e)
+    return nvl
+
+# nvpair data types with a fixed size value: type -> struct format
+_NV_SCALAR = { 2: 'B', 3: 'h', 4: 'H', 5: 'i', 6: 'I', 7: 'q', 8: 'Q', 18: 'q', 22: 'b', 23: 'B', 27: 'd' }
+_NV_ARRAY = { 10: 'B', 11: 'h', 12: 'H', 13: 'i', 14: 'I', 15: 'q', 16: 'Q', 24: 'i', 25: 'b', 26: 'B' }
+
+def _unpackNvl(buf, off, e):
+    off += 8 # nvl_version, nvl_nvflag
+    nvl = {}
+    try:
+        while True:
+            (size,) = struct.unpack_from(e + 'i', buf, off)
+            if size == 0: return (nvl, off + 4)
+            (name_sz, _, nelem, dtype) = struct.unpack_from(e + 'hhii', buf, off + 4)
+            name = buf[off + 16:off + 16 + name_sz - 1].decode('utf-8', 'surrogateescape')
+            voff = off + ((16 + name_sz + 7) & ~7)
+            off_next = off + size
+            if dtype == 1:
+                value = True
+            elif dtype == 21:
+                value = bool(struct.unpack_from(e + 'i', buf, voff)[0])
+            elif dtype == 9:
+                value = buf[voff:buf.index(b'\0', voff)].decode('utf-8', 'surrogateescape')
+            elif dtype in _NV_SCALAR:
+                (value,) = struct.unpack_from(e + _NV_SCALAR[dtype], buf, voff)
+            elif dtype in _NV_ARRAY:
+                value = list(struct.unpack_from(f'{e}{nelem}{_NV_ARRAY[dtype]}', buf, voff))
+            elif dtype == 19:
+                # embedded nvlist is encoded after the pair
+                (value, off_next) = _unpackNvl(buf, off_next, e)
+            else:
+                value = buf[voff:off + size]
+            nvl[name] = value
+            off = off_next
+    except (struct.error, IndexError):
+        raise ValueError("Truncated nvlist")
+
+
+# optimize_coalesce() - Coalesce contiguous operations on the same file system
+# . incremental 1->2, 2->3, 3->4 become 1->4
+# . full, resume and create_stub operations are kept as is
+def optimize_coalesce(operation_schedule):
+    new = []
+    for _, opgroup in itertools.groupby(operation_schedule, lambda op: op[1]):
+        opgroup = list(opgroup)
+        if opgroup[0][0] in ('full', 'create_stub'):
+            new.extend(opgroup)
+        elif opgroup[0][0] in ('incremental', 'resume'):
+            if opgroup[0][0] == 'resume':
+                new.append(opgroup.pop(0))
+                if not opgroup: continue
+            assert all(op[0] == 'incremental' for op in opgroup), "not reached: unexpected operations in %s" % opgroup
+            new_ops = coalesceChains([ (srcs, dsts) for _, _, _, srcs, dsts in opgroup ])
+            for srcs, dsts in new_ops:
+                new.append(tuple(opgroup[0][:3] + (srcs, dsts)))
+        else:
+            assert 0, "not reached: unknown operation type in %s" % opgroup
+    return new
+
+# optimize_recursivize() - Replace operations on whole subtrees by one recursive operation
+# . If every dataset in a subtree has an equivalent schedule (same op types and same snapshot
+#   names in the same order), the subtree root gets the ops as <op>_recursive and the
+#   rest of the subtree is dropped
+# . Datasets whose whole subtree only has create_stub operations are dropped
+# . Subtrees with a resume operation are never recursivized
+# Subtree equivalence is computed bottom-up in one post-order pass using per-subtree
+# signatures. Dataset objects are not modified
+def optimize_recursivize(operation_schedule):
+    ops_by_src = OrderedDict()
+    for source, opgroup in itertools.groupby(operation_schedule, lambda op: op[1]):
+        ops_by_src.setdefault(source, []).extend(opgroup)
+
+    roots = OrderedDict()
+    for root in ops_by_src:
+        while root.parent is not None:
+            root = root.parent
+        roots[root] = True
+
+    def __children(dataset):
+        return [ c for c in dataset.children if not isinstance(c, Snapshot) ]
+
+    # Preorder listing of every dataset under the roots
+    preorder = []
+    stack = list(reversed(roots))
+    while stack:
+        dataset = stack.pop()
+        preorder.append(dataset)
+        stack.extend(reversed(__children(dataset)))
+
+    # Post-order pass: children are always done before their parent
+    ops_final = {}
+    state = {} # dataset -> (count, length, signature, all_stub, has_resume)
+    for dataset in reversed(preorder):
+        ops = ops_by_src.get(dataset, [])
+        children = [ state.pop(c) for c in __children(dataset) ]
+        has_resume = any(o[0] == 'resume' for o in ops) or any(c[4] for c in children)
+
+        # remove unnecessary stubs that stand in for only other stubs
+        all_stub = all(o[0] == 'create_stub' for o in ops) and all(c[3] for c in children)
+        if all_stub: ops = []
+
+        count = 1
+        length = len(ops)
+        sig = _schedSignature(ops)
+        for (c_count, c_length, c_sig, _, _) in children:
+            count += c_count
+            if length is None or not c_length == length:
+                length = None
+            else:
+                _mergeSchedSignature(sig, c_sig)
+        state[dataset] = (count, length, sig, all_stub, has_resume)
+        ops_final[dataset] = (ops, not has_resume and (count == 1 or (not length is None and _schedSignatureEquivalent(sig))))
+
+    # Preorder output. The first equivalent dataset on each path replaces its whole subtree
+    new_operation_schedule = []
+    stack = list(reversed(roots))
+    while stack:
+        dataset = stack.pop()
+        (ops, equivalent) = ops_final[dataset]
+        if equivalent:
+            new_operation_schedule.extend([ (op[0] + "_recursive",) + tuple(op[1:]) for op in ops ])
+        else:
+            new_operation_schedule.extend(ops)
+            stack.extend(reversed(__children(dataset)))
+
+    return new_operation_schedule
+
+
+# Signature of a schedule: one entry per op of
+# [op type, has create_stub, from has None, from name, from conflict, to has None, to name, to conflict]
+def _schedSignature(ops):
+    return [ [ o[0], 'create_stub' in o[0]
+              ,o[3] is None, None if o[3] is None else o[3].name, False
+              ,o[4] is None, None if o[4] is None else o[4].name, False ] for o in ops ]
+
+
+# Merges signature b into a. Both must have the same length
+def _mergeSchedSignature(a, b):
+    for (pa, pb) in zip(a, b):
+        if not pa[0] == pb[0]: pa[0] = _MIXED
+        pa[1] = pa[1] or pb[1]
+        for i in (2, 5):
+            pa[i] = pa[i] or pb[i]
+            pa[i+2] = pa[i+2] or pb[i+2]
+            if pa[i+1] is None:
+                pa[i+1] = pb[i+1]
+            elif not pb[i+1] is None and not pb[i+1] == pa[i+1]:
+                pa[i+2] = True
+
+
+# Schedules are equivalent when, at each position, the op type is the same, it is not a
+# create_stub and the from / to snapshot names are the same (or one of them is None)
+def _schedSignatureEquivalent(sig):
+    for p in sig:
+        if p[0] is _MIXED or p[1]: return False
+        if not p[2] and p[4]: return False
+        if not p[5] and p[7]: return False
+    return True
+
+class _MIXED(object):pass
+
+
+# optimize() - Coalesce and then optionally recursivize a schedule from recursive_replicate()
+def optimize(operation_schedule, allow_recursivize = True):
+    operation_schedule = optimize_coalesce(operation_schedule)
+    if allow_recursivize:
+        operation_schedule = optimize_recursivize(operation_schedule)
+    return operation_schedule
+
+
+# Execution of replication schedules
+# . Each op becomes a `zfs send | zfs recv` pipeline (or `zfs create -p` for stubs) using the
+#   command prefixes of the source and destination Connection
+# . Ops on the same dataset form a chain that is run in order. A chain starts only once the chain
+#   of its nearest scheduled ancestor has completed. Independent chains run in parallel
+# . At most max_per_host streams run at once against any one host
+
+class ReplicationError(Exception):
+    # results - list(of StreamResult) of every op that was started
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+
+class StreamResult():
+    def __init__(self, op, src, dst, snap_from, snap_to):
+        self.op = op
+        self.src = src
+        self.dst = dst
+        self.snap_from = snap_from
+        self.snap_to = snap_to
+        self.bytes = 0
+        self.seconds = 0.0
+        self.returncode = None
+        self.error = None
+
+    ok = property(lambda self: self.returncode == 0)
+
+    # Bytes per second
+    throughput = property(lambda self: self.bytes / self.seconds if self.seconds > 0 else 0.0)
+
+    def __str__(self):
+        return "<StreamResult: {} {} -> {} ({}{}) bytes={} {:.1f}s {}>".format(
+            self.op, self.src, self.dst
+            ,'' if self.snap_from is None else self.snap_from + ' -> '
+            ,self.snap_to, self.bytes, self.seconds
+            ,'ok' if self.ok else 'error: {}'.format(self.error))
+    def __repr__(self):
+        return self.__str__()
+
+
+# ReplicationExecutor - Run a schedule from recursive_replicate() / optimize()
+# src_conn - Connection of the source
+# dst_conn - Connection of the destination
+# src_root - name (or Snapable) of the replicated source
+# dst_root - name (or Snapable) it maps to on the destination
+# max_per_host - maximum concurrent streams per host
+# send_args / recv_args - extra arguments for zfs send / zfs recv (eg. ['-F'] for recv)
+# rate_limit - maximum bytes per second per stream or None
+# resumable - receive with zfs recv -s so an interrupted stream can be resumed (see recursive_replicate())
+# checkpoint - fn(StreamResult) called every checkpoint_interval seconds while a stream runs
+#              and once when it ends (returncode set). eg. to persist progress
+# Attributes: progress - ByteCounter of bytes sent so far by all streams
+# _test_command - fn(kind, cmd) -> cmd used by tests to replace commands. kind is send, recv or create
+class ReplicationExecutor():
+    def __init__(self, src_conn, dst_conn, src_root, dst_root, max_per_host:int=2
+                ,send_args:list=None, recv_args:list=None, rate_limit:int=None, resumable:bool=True
+                ,checkpoint=None, checkpoint_interval:float=10.0, _test_command=None):
+        assert isinstance(max_per_host, int) and max_per_host > 0, "max_per_host must be a positive int"
+        self.src_conn = src_conn
+        self.dst_conn = dst_conn
+        self.src_root = src_root.path if isinstance(src_root, ZFSItem) else src_root
+        self.dst_root = dst_root.path if isinstance(dst_root, ZFSItem) else dst_root
+        self.max_per_host = max_per_host
+        self.send_args = [] if send_args is None else list(send_args)
+        self.recv_args = [] if recv_args is None else list(recv_args)
+        self.rate_limit = rate_limit
+        self.resumable = resumable
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.progress = ByteCounter()
+        self._test_command = _test_command
+        self._stop = threading.Event()
+
+
+    # Maps a source item name to its destination name
+    def dst_name(self, src):
+        path = src.path if isinstance(src, ZFSItem) else src
+        if not (path == self.src_root or path.startswith(self.src_root + '/')):
+            raise KeyError(f"'{path}' is not under source root '{self.src_root}'")
+        return self.dst_root + path[len(self.src_root):]
+
+
+    # Returns: tuple(of send_cmd, recv_cmd). send_cmd is None for create_stub ops
+    def build_commands(self, op):
+        (send, recv) = self._zfs_commands(op)
+        return (None if send is None else self.src_conn.command + send, self.dst_conn.command + recv)
+
+
+    # zfs commands for op without the connection prefixes
+    def _zfs_commands(self, op):
+        (kind, src, d, snap_from, snap_to) = op[:5]
+        dst = self.dst_name(src)
+        base = kind[:-len('_recursive')] if kind.endswith('_recursive') else kind
+        recursive = ['-R'] if kind.endswith('_recursive') else []
+        recv = ['zfs', 'recv'] + (['-s'] if self.resumable else []) + self.recv_args + [dst]
+        if base == 'create_stub':
+            return (None, ['zfs', 'create', '-p', dst])
+        elif base == 'resume':
+            # stream options are encoded in the token
+            return (['zfs', 'send', '-t', d.get_property('receive_resume_token')]
+                   ,recv if self.resumable else recv[:2] + ['-s'] + recv[2:])
+        elif base == 'full':
+            send = ['zfs', 'send'] + recursive + self.send_args + [snap_to.path]
+        elif base == 'incremental':
+            send = ['zfs', 'send'] + recursive + self.send_args + ['-I', snap_from.path, snap_to.path]
+        else:
+            raise AssertionError(f"Unknown operation type '{kind}'")
+        return (send, recv)
+
+
+    # estimate() - Estimate the stream size of each op with zfs send -nvP
+    # . All estimates run from one shell on the source host (a single ssh session), max_workers at a time
+    # Returns: schedule with the estimate in bytes appended to each op
+    #          (0 for create_stub ops, None if zfs could not estimate it)
+    def estimate(self, operation_schedule, max_workers:int=8):
+        assert isinstance(max_workers, int) and max_workers > 0, "max_workers must be a positive int"
+        estimates = [ None ] * len(operation_schedule)
+        script = [_ESTIMATE_SH]
+        jobs = 0
+        for i, op in enumerate(operation_schedule):
+            (send, _) = self._zfs_commands(op)
+            if send is None:
+                estimates[i] = 0
+                continue
+            send = send[:2] + ['-nvP'] + send[2:]
+            script.append('_e {} {} &'.format(i, ' '.join(shlex.quote(a) for a in send)))
+            jobs += 1
+            if jobs % max_workers == 0: script.append('wait')
+        script.append('wait')
+
+        if jobs:
+            cmd = ['sh', '-s']
+            if self._test_command: cmd = self._test_command('estimate', cmd)
+            out = self.src_conn.run(cmd, input='\n'.join(script).encode('utf-8'))
+            for line in out.decode('utf-8', 'replace').splitlines():
+                (i, rc, size) = (line.split('\t') + ['', ''])[:3]
+                if rc == '0' and size.isdigit():
+                    estimates[int(i)] = int(size)
+
+        return [ tuple(op[:5]) + (est,) for (op, est) in zip(operation_schedule, estimates) ]
+
+
+    # run() - Execute the schedule
+    # . Among the chains that are ready, the one with the most estimated bytes ahead of it
+    #   (itself plus its heaviest line of dependents, see estimate()) is started first
+    # Returns: list(of StreamResult)
+    # Raises ReplicationError once running ops complete if any op fails. No new ops are started after a failure
+    def run(self, operation_schedule):
+        chains = _replicationChains(operation_schedule)
+        (_, priority) = _chainPriorities(chains)
+        self._stop.clear()
+        sems = {}
+        for conn in (self.src_conn, self.dst_conn):
+            sems.setdefault(conn.host, threading.Semaphore(self.max_per_host))
+        self._sems = [ sems[k] for k in sorted(sems, key=str) ]
+
+        results = []
+        ready = [ (-priority[i], i) for i, (parent, _, _) in enumerate(chains) if parent is None ]
+        heapq.heapify(ready)
+        # Every op holds a slot on both its source and destination host, so no more than max_per_host
+        # streams run at once. Chains are only submitted when they can start, keeping the largest-first order
+        with ThreadPoolExecutor(max_workers=self.max_per_host) as executor:
+            futures = {}
+            while ready or futures:
+                while ready and len(futures) < self.max_per_host and not self._stop.is_set():
+                    (_, i) = heapq.heappop(ready)
+                    futures[executor.submit(self._run_chain, chains[i][1])] = i
+                if not futures: break
+                done, _ = futures_wait(futures, return_when=FIRST_COMPLETED)
+                for f in done:
+                    i = futures.pop(f)
+                    chain_results = f.result()
+                    results.extend(chain_results)
+                    if all(r.ok for r in chain_results):
+                        for j in chains[i][2]: heapq.heappush(ready, (-priority[j], j))
+
+        failed = [ r for r in results if not r.ok ]
+        if failed:
+            raise ReplicationError("{} of {} replication ops failed. First: {}".format(len(failed), len(results), failed[0]), results)
+        return results
+
+
+    def _run_chain(self, ops):
+        results = []
+        for op in ops:
+            if self._stop.is_set(): break
+            for sem in self._sems: sem.acquire()
+            try:
+                r = self._run_op(op)
+            except Exception as ex:
+                # eg. KeyError from dst_name(). Reported like a failed stream so the run stops cleanly
+                r = StreamResult(op[0], op[1].path, None
+                                ,None if op[3] is None else op[3].name
+                                ,None if op[4] is None else op[4].name)
+                r.returncode = -1
+                r.error = f"{type(ex).__name__}: {ex}"
+            finally:
+                for sem in reversed(self._sems): sem.release()
+            results.append(r)
+            if not r.ok:
+                self._stop.set()
+                break
+        return results
+
+
+    def _run_op(self, op):
+        (send_cmd, recv_cmd) = self.build_commands(op)
+        r = StreamResult(op[0], op[1].path, self.dst_name(op[1])
+                        ,None if op[3] is None else op[3].name
+                        ,None if op[4] is None else op[4].name)
+        if self._test_command:
+            send_cmd = None if send_cmd is None else self._test_command('send', send_cmd)
+            recv_cmd = self._test_command('create' if send_cmd is None else 'recv', recv_cmd)
+        counter = _StreamCounter(self, r)
+        with tempfile.TemporaryFile() as f_err:
+            try:
+                if send_cmd is None:
+                    r.returncode = subprocess.call(recv_cmd, stdout=subprocess.DEVNULL, stderr=f_err)
+                else:
+                    (r.returncode, r.bytes) = _runPipeline(send_cmd, recv_cmd, f_err, rate_limit=self.rate_limit, counter=counter)
+            except OSError as ex:
+                r.returncode = -1
+                r.error = str(ex)
+            if not r.returncode == 0 and r.error is None:
+                f_err.seek(0)
+                r.error = f_err.read().decode('utf-8', 'replace').strip() or f"exit code {r.returncode}"
+        r.seconds = time.monotonic() - counter.t_start
+        if self.checkpoint: self.checkpoint(r)
+        return r
+
+
+# Counts the bytes of one stream into its StreamResult and the executor's progress and
+# calls the executor's checkpoint function at most every checkpoint_interval seconds
+class _StreamCounter():
+    def __init__(self, executor, result):
+        self.executor = executor
+        self.result = result
+        self.t_start = self.t_last = time.monotonic()
+
+    def add(self, n:int):
+        self.executor.progress.add(n)
+        self.result.bytes += n
+        if self.executor.checkpoint:
+            t = time.monotonic()
+            if t - self.t_last >= self.executor.checkpoint_interval:
+                self.t_last = t
+                self.result.seconds = t - self.t_start
+                self.executor.checkpoint(self.result)
+
+
+# Groups a schedule into per dataset chains
+# Returns: list(of tuple(of parent_index, ops, child_indexes)). parent is the chain of the nearest
+#          ancestor that has ops in the schedule (or None)
+def _replicationChains(operation_schedule):
+    chains = []
+    by_src = {}
+    for source, opgroup in itertools.groupby(operation_schedule, lambda op: op[1]):
+        if source in by_src:
+            chains[by_src[source]][1].extend(opgroup)
+        else:
+            by_src[source] = len(chains)
+            chains.append([None, list(opgroup), []])
+    for i, chain in enumerate(chains):
+        p = chain[1][0][1].parent
+        while p is not None and not p in by_src:
+            p = p.parent
+        if p is not None:
+            chain[0] = by_src[p]
+            chains[chain[0]][2].append(i)
+    return [ tuple(c) for c in chains ]
+
+
+# Shell function used by ReplicationExecutor.estimate(). Prints: index, exit code, size
+_ESTIMATE_SH = r"""_e() {
+    _i=$1; shift
+    _o=$("$@" 2>/dev/null); _r=$?
+    printf '%s\t%s\t%s\n' "$_i" "$_r" "$(printf '%s\n' "$_o" | sed -n 's/^size[[:space:]]*//p' | tail -n 1)"
+}"""
+
+
+# Estimated bytes of an op. See ReplicationExecutor.estimate()
+def _opEstimate(op):
+    return op[5] if len(op) > 5 and not op[5] is None else 0
+
+
+# Returns: tuple(of sizes, priorities) per chain where priority is the chain size plus the
+#          largest priority of the chains depending on it
+def _chainPriorities(chains):
+    sizes = [ sum(_opEstimate(op) for op in ops) for (_, ops, _) in chains ]
+    order = [ i for i, c in enumerate(chains) if c[0] is None ]
+    for i in order: order.extend(chains[i][2])
+    priority = list(sizes)
+    for i in reversed(order):
+        for j in chains[i][2]:
+            priority[i] = max(priority[i], sizes[i] + priority[j])
+    return (sizes, priority)
+
+
+# plan_lanes() - Pack a schedule onto parallel lanes, largest work first (LPT)
+# operation_schedule - schedule with estimates (see ReplicationExecutor.estimate())
+# lanes - number of parallel streams
+# Chains of ops on one dataset stay together and start after the chain of their nearest ancestor ends
+# Returns: tuple(of lanes, makespan) - lanes is list(of list(of op)) in run order,
+#          makespan is the estimated bytes through the busiest lane including waits
+def plan_lanes(operation_schedule, lanes:int):
+    assert isinstance(lanes, int) and lanes > 0, "lanes must be a positive int"
+    chains = _replicationChains(operation_schedule)
+    (sizes, priority) = _chainPriorities(chains)
+    out = [ [] for _ in range(lanes) ]
+    lane_free = [ (0, n) for n in range(lanes) ]
+    finish = {}
+    ready = [ (-priority[i], i) for i, c in enumerate(chains) if c[0] is None ]
+    heapq.heapify(ready)
+    while ready:
+        (_, i) = heapq.heappop(ready)
+        (free, n) = heapq.heappop(lane_free)
+        parent = chains[i][0]
+        start = free if parent is None else max(free, finish[parent])
+        finish[i] = start + sizes[i]
+        out[n].extend(chains[i][1])
+        heapq.heappush(lane_free, (finish[i], n))
+        for j in chains[i][2]: heapq.heappush(ready, (-priority[j], j))
+    return (out, max(finish.values()) if finish else 0)
+
+
+# Runs send_cmd | recv_cmd, relaying the stream with relay_stream()
+# Returns: tuple(of returncode, bytes). returncode is the first non zero of send / recv
+def _runPipeline(send_cmd, recv_cmd, f_err, rate_limit=None, counter=None):
+    p_send = subprocess.Popen(send_cmd, stdout=subprocess.PIPE, stderr=f_err, shell=False)
+    try:
+        p_recv = subprocess.Popen(recv_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=f_err, shell=False)
+    except BaseException:
+        p_send.kill()
+        p_send.wait()
+        raise
+    # Counted as it goes: relay_stream() has no total to return when the receiver exits early
+    moved = _TeeCounter(counter)
+    try:
+        relay_stream(p_send.stdout, p_recv.stdin, rate_limit=rate_limit, counter=moved)
+    except BrokenPipeError:
+        pass
+    finally:
+        p_send.stdout.close()
+        try:
+            p_recv.stdin.close()
+        except BrokenPipeError:
+            pass
+        if p_recv.wait() != 0 and p_send.poll() is None:
+            p_send.kill()
+        rc_send = p_send.wait()
+    rc_recv = p_recv.returncode
+    return (rc_send if not rc_send == 0 else rc_recv, moved.value)
+
+
+# ByteCounter that also adds to another counter (or None)
+class _TeeCounter(ByteCounter):
+    def __init__(self, other):
+        super().__init__()
+        self._other = other
+
+    def add(self, n:int):
+        super().add(n)
+        if not self._other is None: self._other.add(n)
+
+
+''' END Replication '''
+
+
+
+''' Snapshot Management
+
+ Batched zfs snapshot / zfs destroy commands. Commands for many datasets are run from one
+ shell on the host (a single ssh session) and arguments are kept under ZFS_ARG_MAX
+'''
+
+# Longest argument passed to zfs. Linux limits a single argument to 128KB (MAX_ARG_STRLEN)
+ZFS_ARG_MAX = 65536
+
+
+# Commands for PoolSet.create_snapshots()
+# Returns: tuple(of cmds, targets) - targets are all datasets that get the snapshot
+def _snapshotCommands(items, name, recursive):
+    selected = set(items)
+    # full[ds] - ds and every dataset below it is selected. Deepest first so children are known
+    full = {}
+    for ds in sorted(items, key=lambda ds: -ds.path.count('/')):
+        full[ds] = all(full.get(c, False) for c in ds.children if not isinstance(c, Snapshot))
+    # -r only pays off for datasets with children
+    roots = [ ds for ds in items if full[ds] and not full.get(ds.parent, False)
+                 and any(not isinstance(c, Snapshot) for c in ds.children) ] if recursive else []
+    explicit = [ ds.path + '@' + name for ds in items ]
+
+    if roots and all(full.values()) and all(full.get(ds.parent, False) or ds in roots for ds in items):
+        cmds = _chunkArgs(['zfs', 'snapshot', '-r'], [ ds.path + '@' + name for ds in roots ])
+        targets = []
+        for ds in roots:
+            targets.append(ds)
+            targets.extend(ds.get_all_datasets())
+        return (cmds, targets)
+
+    cmds = _chunkArgs(['zfs', 'snapshot'], explicit)
+    if len(cmds) == 1 or not roots:
+        return (cmds, items)
+
+    # Too large for one command: whole subtrees with -r, the rest listed
+    covered = set()
+    targets = []
+    for ds in roots:
+        for c in [ds] + ds.get_all_datasets():
+            covered.add(c)
+            targets.append(c)
+    rest = [ ds for ds in items if not ds in covered ]
+    targets.extend(rest)
+    cmds = _chunkArgs(['zfs', 'snapshot', '-r'], [ ds.path + '@' + name for ds in roots ])
+    cmds.extend(_chunkArgs(['zfs', 'snapshot'], [ ds.path + '@' + name for ds in rest ]))
+    return (cmds, targets)
+
+
+# Splits args over commands starting with base so that no command line (with separators)
+# is longer than max_len
+# Returns: list(of list(of str))
+def _chunkArgs(base, args, max_len:int=ZFS_ARG_MAX):
+    base_len = sum(len(a) + 1 for a in base)
+    cmds = []
+    chunk = []
+    size = base_len
+    for a in args:
+        if chunk and size + len(a) + 1 > max_len:
+            cmds.append(base + chunk)
+            chunk = []
+            size = base_len
+        chunk.append(a)
+        size += len(a) + 1
+    if chunk: cmds.append(base + chunk)
+    return cmds
+
+
+# recursive_clear_obsolete() - Plan the destruction of what is in dst but not in src, recursively
+# Returns: list(of tuple) - ("destroy", Snapshot) or ("destroy_recursively", Dataset)
+def recursive_clear_obsolete(s, d):
+    sched = []
+    # Explicit stack so deep trees do not hit the recursion limit. Entries are either
+    # a pair of datasets to compare or an operation to emit, in depth first order
+    stack = [(s, d)]
+    while stack:
+        entry = stack.pop()
+        if isinstance(entry[0], str):
+            sched.append(entry)
+            continue
+        (s, d) = entry
+        snapshots_in_src = set([ m.name for m in s.get_snapshots() ])
+        sched.extend([ ("destroy", m) for m in d.get_snapshots() if not m.name in snapshots_in_src ])
+
+        s_children = { c.name: c for c in s.children if not isinstance(c, Snapshot) }
+        for child_d in reversed([ x for x in d.children if not isinstance(x, Snapshot) ]):
+            child_s = s_children.get(child_d.name)
+            stack.append(("destroy_recursively", child_d) if child_s is None else (child_s, child_d))
+    return sched
+
+
+# plan_destroys() - Turn destroy operations into as few zfs destroy commands as possible
+# operations - list(of tuple) from recursive_clear_obsolete(), or list(of Snapshot / Dataset)
+# max_arg - maximum length of one snapshot list argument
+# Returns: list(of list(of str)) - zfs destroy commands without connection prefix
+#  . Snapshots of one dataset are combined into one argument: ds@a%c,e where a%c is a run of
+#    consecutive snapshots (in zfs list order) and e a single snapshot
+#  . Datasets are destroyed with zfs destroy -r. Snapshots below them are skipped
+def plan_destroys(operations, max_arg:int=ZFS_ARG_MAX) -> list:
+    snaps_by_ds = OrderedDict()
+    recursive = []
+    for op in operations:
+        item = op[-1] if isinstance(op, tuple) else op
+        if isinstance(item, Snapshot):
+            snaps_by_ds.setdefault(item.parent, set()).add(item.name)
+        else:
+            recursive.append(item)
+
+    def __covered(item):
+        p = item.parent
+        while p is not None:
+            if p in covered: return True
+            p = p.parent
+        return False
+    covered = set(recursive)
+
+    cmds = []
+    for ds in recursive:
+        if not __covered(ds):
+            cmds.append(['zfs', 'destroy', '-r', ds.path])
+
+    for (ds, names) in snaps_by_ds.items():
+        if ds in covered or __covered(ds): continue
+        # runs of consecutive snapshots to destroy
+        parts = []
+        run = []
+        for snap in ds.get_snapshots() + [None]:
+            if not snap is None and snap.name in names:
+                run.append(snap.name)
+                continue
+            if len(run) > 2:
+                parts.append(f"{run[0]}%{run[-1]}")
+            else:
+                parts.extend(run)
+            run = []
+
+        prefix = ds.path + '@'
+        arg = None
+        for part in parts:
+            if not arg is None and len(arg) + 1 + len(part) > max_arg:
+                cmds.append(['zfs', 'destroy', arg])
+                arg = None
+            arg = prefix + part if arg is None else arg + ',' + part
+        if not arg is None:
+            cmds.append(['zfs', 'destroy', arg])
+    return cmds
+
+
+class DestroyResult():
+    def __init__(self):
+        self.destroyed = [] # names reported by zfs destroy -v
+        self.reclaim = 0    # bytes
+        self.errors = []    # list(of tuple(of cmd, returncode, message))
+
+    ok = property(lambda self: not self.errors)
+
+    def __str__(self):
+        return "<DestroyResult: destroyed={} reclaim={} errors={}>".format(len(self.destroyed), self.reclaim, len(self.errors))
+    def __repr__(self):
+        return self.__str__()
+
+
+# run_destroys() - Run commands from plan_destroys() from one shell on the connection's host
+# dry_run - Only report what would be destroyed (zfs destroy -n)
+# Returns: DestroyResult - destroyed names and reclaimed (or reclaimable) bytes from zfs destroy -vp
+# All commands are run even if some fail. Check DestroyResult.errors
+# Unless dry_run, destroyed items are removed from the connection's loaded PoolSet
+def run_destroys(connection, commands:list, dry_run:bool=False, _test_command=None) -> DestroyResult:
+    result = DestroyResult()
+    if not commands: return result
+    flags = '-nvp' if dry_run else '-vp'
+    cmds = [ cmd[:2] + [flags] + cmd[2:] for cmd in commands ]
+    output = _runScript(connection, [ ' '.join(shlex.quote(a) for a in cmd) for cmd in cmds ], _test_command)
+
+    for (i, cmd) in enumerate(cmds):
+        if i >= len(output):
+            result.errors.append((cmd, None, 'not run'))
+            continue
+        (rc, lines) = output[i]
+        messages = []
+        for line in lines:
+            items = line.split('\t')
+            if len(items) == 2 and items[0] == 'destroy':
+                result.destroyed.append(items[1])
+            elif len(items) == 2 and items[0] == 'reclaim' and items[1].isdigit():
+                result.reclaim += int(items[1])
+            else:
+                messages.append(line)
+        if not rc == 0:
+            result.errors.append((cmd, rc, '\n'.join(messages)))
+
+    if not dry_run and connection._poolset:
+        for name in result.destroyed:
+            try:
+                item = connection._poolset.lookup(name)
+            except KeyError:
+                continue
+            if not item.parent is None: item.parent.remove(item)
+    return result
+
+
+# Runs commands from one shell (sh -s) on the connection's host
+# Returns: list(of tuple(of returncode, list(of output line))) - one per command. stderr is included in the output
+def _runScript(connection, commands:list, _test_command=None):
+    script = [ f"{cmd} 2>&1; printf '\\n_rc\\t%s\\n' $?" for cmd in commands ]
+    cmd = ['sh', '-s']
+    if _test_command: cmd = _test_command(cmd)
+    out = connection.run(cmd, input='\n'.join(script).encode('utf-8'))
+    results = []
+    lines = []
+    for line in out.decode('utf-8', 'surrogateescape').splitlines():
+        if line.startswith('_rc\t'):
+            results.append((int(line[4:]), [ l for l in lines if l ]))
+            lines = []
+        else:
+            lines.append(line)
+    return results
+
+''' END Snapshot Management '''
+
+
+
+''' Retention
+
+ Grandfather-father-son retention: for each period of a policy, the newest snapshot of each of
+ the most recent N periods that have snapshots is kept. Eg. {'hourly': 24, 'daily': 30, 'monthly': 12}
+'''
+
+# Retention periods. Each maps a creation datetime to its period
+RETENTION_PERIODS = OrderedDict([
+     ('hourly',  lambda dt: (dt.year, dt.month, dt.day, dt.hour))
+    ,('daily',   lambda dt: (dt.year, dt.month, dt.day))
+    ,('weekly',  lambda dt: tuple(dt.isocalendar()[:2]))
+    ,('monthly', lambda dt: (dt.year, dt.month))
+    ,('yearly',  lambda dt: dt.year)
+])
+
+
+class RetentionResult():
+    def __init__(self):
+        self.keep = []      # list(of Snapshot)
+        self.destroy = []   # list(of Snapshot) in dataset order, oldest first
+        self.reclaim = 0    # bytes. Sum of the used property of destroy (a lower bound, see evaluate_retention())
+        self.kept_by = {}   # Snapshot -> list(of rule names that keep it)
+
+    def __str__(self):
+        return "<RetentionResult: keep={} destroy={} reclaim={}>".format(len(self.keep), len(self.destroy), self.reclaim)
+    def __repr__(self):
+        return self.__str__()
+
+
+# evaluate_retention() - Decide which snapshots a retention policy keeps
+# target - PoolSet, Pool or Dataset
+# policy - dict of rule -> count. Rules are the keys of RETENTION_PERIODS plus
+#          'last' which keeps the most recent snapshots regardless of period
+# match - only consider snapshots whose name matches this wildcard (eg. 'zfs-auto-snap_*').
+#         Other snapshots are neither kept nor destroyed
+# recursive - for a Pool or Dataset, also evaluate the datasets below it
+# Returns: RetentionResult
+# Notes:
+# . Each dataset's snapshots are sorted by creation once and bucketed for all rules in one pass
+# . reclaim sums the used property of each snapshot to destroy (0 if not loaded). Destroying
+#   neighbouring snapshots frees more than that. Use run_destroys(dry_run=True) for an exact figure
+def evaluate_retention(target, policy:dict, match:str=None, recursive:bool=False) -> RetentionResult:
+    assert isinstance(policy, dict) and policy, "policy must be a non empty dict"
+    for (rule, count) in policy.items():
+        assert rule == 'last' or rule in RETENTION_PERIODS, f"Unknown retention rule '{rule}'. Must be one of: last, {', '.join(RETENTION_PERIODS)}"
+        assert isinstance(count, int) and count >= 0, f"Count of rule '{rule}' must be an int >= 0. Got: {count}"
+
+    if isinstance(target, PoolSet):
+        items = []
+        for pool in target:
+            items.append(pool)
+            items.extend(pool.get_all_datasets())
+    else:
+        assert isinstance(target, Snapable), f"target must be a PoolSet, Pool or Dataset. Got: {type(target)}"
+        items = [target] + (target.get_all_datasets() if recursive else [])
+
+    rules = [ (rule, RETENTION_PERIODS.get(rule), count) for (rule, count) in policy.items() if count > 0 ]
+    result = RetentionResult()
+    for item in items:
+        _evalRetention(item, rules, match, result)
+    return result
+
+
+def _evalRetention(item, rules, match, result):
+    snaps = item.get_snapshots()
+    if not match is None:
+        snaps = [ s for s in snaps if fnmatch.fnmatch(s.name, match) ]
+    if not snaps: return
+    snaps = sorted(snaps, key=_snapOrderKey(snaps), reverse=True)
+
+    remaining = [ count for (_, _, count) in rules ]
+    last_period = [ None ] * len(rules)
+    kept = set()
+    for snap in snaps:
+        if not any(remaining): break
+        dt = datetime.fromtimestamp(snap.get_property('creation'))
+        for i, (rule, period, _) in enumerate(rules):
+            if remaining[i] == 0: continue
+            p = None if period is None else period(dt)
+            if period is None or not p == last_period[i]:
+                # newest snapshot of a period not seen yet
+                last_period[i] = p
+                remaining[i] -= 1
+                result.kept_by.setdefault(snap, []).append(rule)
+                kept.add(snap)
+
+    for snap in reversed(snaps):
+        if snap in kept:
+            result.keep.append(snap)
+        else:
+            result.destroy.append(snap)
+            used = snap.get_property('used') if snap.has_property('used') else None
+            if not used is None: result.reclaim += int(used)
+
+''' END Retention '''
+
+
+''' History Catalog
+
+ Optional SQLite store of PoolSet loads and diff streams, for questions that outlive a process:
+ eg. when did a dataset start growing, which snapshots ever contained a path.
+ sqlite3 is imported on first use. The database is opened in WAL mode so readers do not block ingest.
+'''
+
+HISTORY_BATCH = 10000 # rows per executemany()
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS loads (
+     id INTEGER PRIMARY KEY
+    ,host TEXT NOT NULL
+    ,loaded REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+     id INTEGER PRIMARY KEY
+    ,host TEXT NOT NULL
+    ,dataset TEXT NOT NULL
+    ,name TEXT NOT NULL
+    ,creation INTEGER
+    ,guid TEXT
+    ,used INTEGER
+    ,first_seen INTEGER NOT NULL
+    ,last_seen INTEGER NOT NULL
+    ,UNIQUE (host, dataset, name, creation)
+);
+CREATE INDEX IF NOT EXISTS snapshots_dataset_creation ON snapshots (dataset, creation);
+CREATE INDEX IF NOT EXISTS snapshots_guid ON snapshots (guid);
+CREATE TABLE IF NOT EXISTS dataset_samples (
+     load_id INTEGER NOT NULL
+    ,host TEXT NOT NULL
+    ,dataset TEXT NOT NULL
+    ,used INTEGER
+    ,referenced INTEGER
+    ,available INTEGER
+    ,snapshots INTEGER
+);
+CREATE INDEX IF NOT EXISTS dataset_samples_dataset ON dataset_samples (dataset, load_id);
+CREATE TABLE IF NOT EXISTS diffs (
+     id INTEGER PRIMARY KEY
+    ,host TEXT NOT NULL
+    ,dataset TEXT NOT NULL
+    ,snap_left TEXT
+    ,snap_left_creation INTEGER
+    ,snap_right TEXT
+    ,snap_right_creation INTEGER
+    ,chg_ts TEXT
+    ,chg_type TEXT
+    ,file_type TEXT
+    ,path_full TEXT
+    ,path_full_new TEXT
+);
+CREATE INDEX IF NOT EXISTS diffs_path ON diffs (path_full);
+CREATE INDEX IF NOT EXISTS diffs_path_new ON diffs (path_full_new);
+CREATE INDEX IF NOT EXISTS diffs_pair ON diffs (snap_right, snap_left);
+"""
+
+_SNAPSHOT_RECORD_SQL = """
+SELECT s.host, s.dataset, s.name, s.creation, s.guid, s.used, lf.loaded, ll.loaded
+      ,s.last_seen = (SELECT max(id) FROM loads WHERE host = s.host)
+FROM snapshots s
+JOIN loads lf ON lf.id = s.first_seen
+JOIN loads ll ON ll.id = s.last_seen
+"""
+
+
+# A snapshot as recorded in a HistoryCatalog
+class SnapshotRecord():
+    def __init__(self, host, dataset, name, creation, guid, used, first_seen, last_seen, present):
+        self.host = host
+        self.dataset = dataset      # dataset path (str)
+        self.name = name
+        self._creation = creation
+        self.guid = guid            # str or None if guid was not loaded
+        self.used = used            # int or None if used was not loaded
+        self.first_seen = datetime.fromtimestamp(first_seen) # time of the first load that had it
+        self.last_seen = datetime.fromtimestamp(last_seen)   # time of the last load that had it
+        self.present = bool(present) # in the latest load of its host
+
+    path = property(lambda self: "{}@{}".format(self.dataset, self.name))
+    creation = property(lambda self: None if self._creation is None else datetime.fromtimestamp(self._creation))
+
+    def __str__(self):
+        return "<SnapshotRecord: {}:{}{}>".format(self.host, self.path, '' if self.present else ' (destroyed)')
+    def __repr__(self):
+        return self.__str__()
+
+
+# A Diff as recorded in a HistoryCatalog. Snapshots are referenced by path (str)
+class DiffRecord():
+    def __init__(self, host, dataset, snap_left, snap_left_creation, snap_right, snap_right_creation
+                ,chg_ts, chg_type, file_type, path_full, path_full_new):
+        self.host = host
+        self.dataset = dataset
+        self.snap_left = snap_left
+        self.snap_left_creation = snap_left_creation
+        self.snap_right = snap_right
+        self.snap_right_creation = snap_right_creation
+        self.chg_ts = chg_ts
+        self.chg_type = chg_type
+        self.file_type = file_type
+        self.path_full = path_full
+        self.path_full_new = path_full_new
+
+    chg_time = property(lambda self: datetime.fromtimestamp(int(self.chg_ts[:self.chg_ts.find('.')])))
+    file_type_full = property(lambda self: Diff.get_file_type(self.file_type))
+    chg_type_full = property(lambda self: Diff.get_change_type(self.chg_type))
+
+    def __str__(self):
+        return "<DiffRecord> {0} [{1}][{2}] {3}{4}".format(
+            self.snap_right, self.chg_type, self.file_type
+            ,self.path_full, ('' if not self.path_full_new else ' --> '+self.path_full_new))
+    def __repr__(self):
+        return self.__str__()
+
+
+# HistoryCatalog - SQLite catalog of snapshots, dataset space usage and diffs across runs
+# path - database file. Created if missing. ':memory:' for a throwaway catalog
+# eg:
+#   with zfs.HistoryCatalog('/var/lib/zfshist.db') as hist:
+#       hist.ingest_poolset(conn.load_poolset(zfs_props=['used', 'referenced', 'available', 'guid']))
+#       hist.ingest_diffs(ds.iter_diffs(snap_left, snap_right))
+#       hist.snapshots_containing('/dpool/home/joe/notes.txt')
+class HistoryCatalog():
+    def __init__(self, path:str):
+        try:
+            import sqlite3
+        except ImportError:
+            raise ImportError("HistoryCatalog requires the sqlite3 module of the Python standard library")
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA cache_size=-65536") # 64MB. Keeps index pages of large ingests in memory
+        self._db.executescript(_HISTORY_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+
+    # ingest_poolset() - Record the snapshots and dataset space usage of a loaded PoolSet
+    # host - name recorded for the PoolSet. Default: the host of its Connection
+    # Returns: int - id of the load
+    # Notes:
+    # . A snapshot is identified by (host, dataset, name, creation). Snapshots seen before only get
+    #   their last_seen, used and guid updated. Snapshots missing from a load are no longer present
+    # . used, referenced, available and guid are recorded when they were loaded (see load_poolset(zfs_props))
+    def ingest_poolset(self, poolset, host:str=None) -> int:
+        host = _historyHost(host, poolset.connection)
+        db = self._db
+        with db:
+            load_id = db.execute("INSERT INTO loads (host, loaded) VALUES (?, ?)", (host, time.time())).lastrowid
+            snaps = []
+            samples = []
+            for item in poolset.walk():
+                props = item._properties
+                if isinstance(item, Snapshot):
+                    snaps.append((host, item.parent.path, item.name, _intOrNone(props.get('creation'))
+                                  ,_strOrNone(props.get('guid')), _intOrNone(props.get('used')), load_id, load_id))
+                else:
+                    samples.append((load_id, host, item.path, _intOrNone(props.get('used'))
+                                    ,_intOrNone(props.get('referenced')), _intOrNone(props.get('available'))
+                                    ,sum(1 for c in item.children if isinstance(c, Snapshot))))
+                if len(snaps) >= HISTORY_BATCH: self._insert_snapshots(snaps); snaps = []
+                if len(samples) >= HISTORY_BATCH: self._insert_samples(samples); samples = []
+            self._insert_snapshots(snaps)
+            self._insert_samples(samples)
+        return load_id
+
+    def _insert_snapshots(self, rows):
+        self._db.executemany("""
+            INSERT INTO snapshots (host, dataset, name, creation, guid, used, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (host, dataset, name, creation) DO UPDATE SET
+                 last_seen = excluded.last_seen
+                ,used = coalesce(excluded.used, used)
+                ,guid = coalesce(excluded.guid, guid)""", rows)
+
+    def _insert_samples(self, rows):
+        self._db.executemany("INSERT INTO dataset_samples VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+    # ingest_diffs() - Record a stream of Diffs (eg. from <Dataset>.iter_diffs())
+    # host - Default: the host of the Connection of the first diff's snapshots
+    # Returns: int - number of diffs recorded
+    # Note: Re-ingesting a snapshot pair replaces the diffs recorded for it
+    def ingest_diffs(self, diffs, host:str=None) -> int:
+        db = self._db
+        pairs = set()
+        batch = []
+        count = 0
+        insert = "INSERT INTO diffs (host, {}) VALUES (?{})".format(", ".join(DIFF_EXPORT_FIELDS), ", ?" * len(DIFF_EXPORT_FIELDS))
+        diffs = iter(diffs)
+        first = next(diffs, None)
+        if first is None: return 0
+        if host is None:
+            snap = first.snap_right if first.snap_left is None else first.snap_left
+            host = _historyHost(None, snap.pool.connection)
+        with db:
+            for rec in _diffRecords(itertools.chain([first], diffs)):
+                pair = (rec[1], rec[3])
+                if not pair in pairs:
+                    pairs.add(pair)
+                    db.execute("DELETE FROM diffs WHERE snap_right = ? AND snap_left IS ? AND host = ?", (pair[1], pair[0], host))
+                batch.append((host,) + rec)
+                if len(batch) >= HISTORY_BATCH:
+                    db.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+            db.executemany(insert, batch)
+        return count + len(batch)
+
+
+    # snapshots() - Recorded snapshots ordered by dataset and creation
+    # dataset - dataset path. None for all
+    # host - None for all hosts
+    # since / until - datetime bounds on creation
+    # guid - only the snapshot(s) with this guid (eg. the same snapshot replicated to several hosts)
+    # present - True for snapshots in the latest load of their host, False for destroyed ones. None for both
+    # Returns: list(of SnapshotRecord)
+    def snapshots(self, dataset:str=None, host:str=None, since:datetime=None, until:datetime=None, guid=None, present:bool=None) -> list:
+        where = []
+        args = []
+        if not dataset is None: where.append("s.dataset = ?"); args.append(dataset)
+        if not host is None: where.append("s.host = ?"); args.append(host)
+        if not since is None: where.append("s.creation >= ?"); args.append(int(since.timestamp()))
+        if not until is None: where.append("s.creation <= ?"); args.append(int(until.timestamp()))
+        if not guid is None: where.append("s.guid = ?"); args.append(str(guid))
+        sql = _SNAPSHOT_RECORD_SQL
+        if where: sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY s.dataset, s.creation, s.host"
+        res = [ SnapshotRecord(*row) for row in self._db.execute(sql, args) ]
+        if not present is None:
+            res = [ r for r in res if r.present == present ]
+        return res
+
+
+    # dataset_history() - Space usage of a dataset over the recorded loads
+    # Returns: list(of tuple(datetime, dict(of used, referenced, available, snapshots))) oldest first
+    def dataset_history(self, dataset:str, host:str=None) -> list:
+        sql = """SELECT l.loaded, d.used, d.referenced, d.available, d.snapshots
+                 FROM dataset_samples d JOIN loads l ON l.id = d.load_id
+                 WHERE d.dataset = ?{} ORDER BY d.load_id""".format('' if host is None else ' AND d.host = ?')
+        args = [dataset] if host is None else [dataset, host]
+        return [ (datetime.fromtimestamp(loaded), {'used': used, 'referenced': referenced, 'available': available, 'snapshots': snapshots})
+                 for (loaded, used, referenced, available, snapshots) in self._db.execute(sql, args) ]
+
+
+    # diffs() - Recorded diffs touching a path, oldest first
+    # path - matched against the path and the new path of renames
+    # prefix - also match everything below path
+    # Returns: list(of DiffRecord)
+    def diffs(self, path:str, prefix:bool=False, dataset:str=None, host:str=None) -> list:
+        cols = "host, " + ", ".join(DIFF_EXPORT_FIELDS)
+        if prefix:
+            # Range on the index: path/ <= p < path0 ('0' follows '/')
+            p = path.rstrip('/')
+            cond = "(path_full = ? OR (path_full >= ? AND path_full < ?)) "
+            args = [p, p + '/', p + '0']
+            sql = "SELECT {0} FROM diffs WHERE {1} UNION SELECT {0} FROM diffs WHERE {2}".format(
+                cols, cond, cond.replace('path_full', 'path_full_new'))
+            args = args + args
+        else:
+            sql = "SELECT {0} FROM diffs WHERE path_full = ? UNION SELECT {0} FROM diffs WHERE path_full_new = ?".format(cols)
+            args = [path, path]
+        res = [ DiffRecord(*row) for row in self._db.execute(sql, args) ]
+        res = [ r for r in res if (dataset is None or r.dataset == dataset) and (host is None or r.host == host) ]
+        res.sort(key=lambda r: (r.snap_right_creation is None, r.snap_right_creation or 0, r.chg_ts))
+        return res
+
+
+    # snapshots_containing() - Recorded snapshots in which path existed
+    # Returns: list(of SnapshotRecord) ordered by dataset and creation
+    # Note: Derived from the recorded diffs of path. Assumes diffs were ingested for every pair of
+    #       consecutive snapshots over the period of interest. Without any diff of path, nothing is returned
+    def snapshots_containing(self, path:str, host:str=None) -> list:
+        by_ds = OrderedDict()
+        for d in self.diffs(path, host=host):
+            if d.snap_right == '(present)': continue
+            by_ds.setdefault((d.host, d.dataset), []).append(d)
+
+        res = []
+        for ((ds_host, dataset), diffs) in by_ds.items():
+            effects = {}
+            for d in diffs:
+                effects[d.snap_right] = _diffLeavesPath(d, path)
+            # Before its first change the path exists unless the change created it
+            first = diffs[0]
+            state = True if first.chg_type == 'M' else not _diffLeavesPath(first, path)
+            for snap in self.snapshots(dataset=dataset, host=ds_host):
+                state = effects.get(snap.path, state)
+                if state: res.append(snap)
+        return res
+
+
+# True if path exists after the change of d
+def _diffLeavesPath(d, path):
+    if d.chg_type in ('R', 'V'): return d.path_full_new == path
+    return not d.chg_type == '-'
+
+
+def _historyHost(host, connection):
+    if not host is None: return host
+    return connection.host or 'localhost'
+
+
+def _intOrNone(v):
+    if v is None: return None
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _strOrNone(v):
+    return None if v is None else str(v)
+
+''' END History Catalog '''
+
+
 
 ''' LEGACY DUCK PUNCHING'''
 
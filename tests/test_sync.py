@@ -3,6 +3,14 @@ Created on Mar 19, 2013
 
 @author: rudd-o
 '''
+import os
+import shutil
+import tempfile
+import struct
+import threading
+import time
+import warnings
+import zlib
 import unittest
 import zfslib as zfs
 from zfslib_test_tools import *
@@ -1083,6 +1091,207 @@ mathilda	249108103168	156426862592	92681240576	-	50	62	ONLINE
         real_coalesced_recursivized = sync.optimize_recursivize(real_coalesced)
         self.assertEqual(expected_coalesced_recursivized,real_coalesced_recursivized)
 
+    def test_pairs_snapshots_by_guid(self):
+        # Destination snapshot was renamed. guid still pairs it with its source
+        src = TestPoolSet()
+        dst = TestPoolSet()
+        src.parse_zfs_r_output(
+x('''karen   1359351119  1
+karen/plonezeo  1360136643  2
+karen/plonezeo@a     1363676402  100
+karen/plonezeo@b     1363686402  101
+'''), zpool_data=zpool_data, zfs_props=['name', 'creation', 'guid']
+        )
+        dst.parse_zfs_r_output(
+x('''target   1359351109  3
+target/karen   1359351119  4
+target/karen/plonezeo  1360136643  5
+target/karen/plonezeo@a-renamed     1363676402  100
+'''), zpool_data=zpool_data, zfs_props=['name', 'creation', 'guid']
+        )
+
+        result = zfs.recursive_replicate(src.lookup("karen"), dst.lookup("target/karen"))
+        self.assertEqual(
+            result,
+            [('incremental',
+              src.lookup("karen/plonezeo"),
+              dst.lookup("target/karen/plonezeo"),
+              src.lookup("karen/plonezeo@a"),
+              src.lookup("karen/plonezeo@b")
+            )]
+        )
+
+    def test_orders_snapshots_by_createtxg(self):
+        # Both snapshots were taken in the same second. createtxg, not the name, tells which came first
+        src = TestPoolSet()
+        dst = TestPoolSet()
+        src.parse_zfs_r_output(
+x('''karen   1359351119  1
+karen/plonezeo  1360136643  2
+karen/plonezeo@z     1363676402  10
+karen/plonezeo@a     1363676402  11
+'''), zpool_data=zpool_data, zfs_props=['name', 'creation', 'createtxg']
+        )
+        dst.parse_zfs_r_output(
+x('''target   1359351109  1
+target/karen   1359351119  2
+target/karen/plonezeo  1360136643  3
+target/karen/plonezeo@z     1363676402  4
+'''), zpool_data=zpool_data, zfs_props=['name', 'creation', 'createtxg']
+        )
+
+        result = zfs.recursive_replicate(src.lookup("karen/plonezeo"), dst.lookup("target/karen/plonezeo"))
+        self.assertEqual(
+            result,
+            [('incremental',
+              src.lookup("karen/plonezeo"),
+              dst.lookup("target/karen/plonezeo"),
+              src.lookup("karen/plonezeo@z"),
+              src.lookup("karen/plonezeo@a")
+            )]
+        )
+
+    def test_replicates_many_snapshots(self):
+        count = 5000
+        rows = ['karen   1359351119', 'karen/plonezeo  1360136643']
+        rows.extend([ 'karen/plonezeo@snap%05d  %d' % (i, 1363676402 + i) for i in range(count) ])
+        src = TestPoolSet()
+        src.parse_zfs_r_output(x('\n'.join(rows)), zpool_data=zpool_data)
+        dst = TestPoolSet()
+        dst.parse_zfs_r_output(x('\n'.join(['target   1359351109', 'target/karen   1359351119'] 
+            + [ 'target/' + r for r in rows[1:count // 2] ])), zpool_data=zpool_data)
+
+        result = zfs.recursive_replicate(src.lookup("karen"), dst.lookup("target/karen"))
+        self.assertEqual(len(result), count - (count // 2 - 2))
+        self.assertEqual(result[0][3].name, 'snap%05d' % (count // 2 - 3))
+        self.assertEqual(result[-1][4].name, 'snap%05d' % (count - 1))
+
+    def test_recursivizes_large_tree(self):
+        rows = ['karen   1359351119']
+        for i in range(10):
+            rows.append('karen/d%d  1360136643' % i)
+            for j in range(10):
+                rows.append('karen/d%d/e%d  1360136643' % (i, j))
+                for k in range(50):
+                    rows.append('karen/d%d/e%d/f%d  1360136643' % (i, j, k))
+        src = TestPoolSet()
+        src.parse_zfs_r_output(x('\n'.join(rows + [ r.split()[0] + '@1  1363676402' for r in rows ]
+                                                 + [ r.split()[0] + '@2  1363676403' for r in rows ])), zpool_data=zpool_data)
+        dst = TestPoolSet()
+        dst.parse_zfs_r_output(x('target   1359351109'), zpool_data=zpool_data)
+
+        sched = zfs.recursive_replicate(src.lookup("karen"), dst.lookup("target"))
+        self.assertEqual(len(sched), 2 * len(rows))
+        t = time.time()
+        result = sync.optimize(sched)
+        self.assertLess(time.time() - t, 5)
+        self.assertEqual([ (op[0], op[1].path) for op in result ],
+                         [ ('full_recursive', 'karen'), ('incremental_recursive', 'karen') ])
+        self.assertFalse(any(hasattr(ds, '_ops_schedule') for ds in [src.lookup("karen")] + src.lookup("karen").get_all_datasets()))
+
+        # a single divergent leaf keeps its branch from being recursivized
+        result = sync.optimize_recursivize([ op for op in sched if not (op[0] == 'incremental' and op[1].path == 'karen/d3/e4/f5') ])
+        self.assertIn(('full', 'karen/d3/e4'), [ (op[0], op[1].path) for op in result ])
+        self.assertIn(('full_recursive', 'karen/d3/e5'), [ (op[0], op[1].path) for op in result ])
+        self.assertNotIn('karen', [ op[1].path for op in result if op[0].endswith('_recursive') ])
+
+
+# Packs a dict as a native encoded nvlist and wraps it like a receive_resume_token
+def make_resume_token(fields):
+    def _align(n): return (n + 7) & ~7
+    def _body(d):
+        out = struct.pack('<ii', 0, 1)
+        for name, value in d.items():
+            name_b = name.encode('utf-8') + b'\0'
+            after = b''
+            if value is True:
+                (dtype, vb) = (1, b'')
+            elif isinstance(value, int):
+                (dtype, vb) = (8, struct.pack('<Q', value))
+            elif isinstance(value, str):
+                (dtype, vb) = (9, value.encode('utf-8') + b'\0')
+            else:
+                (dtype, vb, after) = (19, b'\0' * 24, _body(value))
+            voff = _align(16 + len(name_b))
+            size = _align(voff + len(vb))
+            pair = struct.pack('<ihhii', size, len(name_b), 0, 1 if dtype != 1 else 0, dtype) + name_b
+            pair = pair.ljust(voff, b'\0') + vb
+            out += pair.ljust(size, b'\0') + after
+        return out + struct.pack('<i', 0)
+    packed = bytes([0, 1, 0, 0]) + _body(fields)
+    compressed = zlib.compress(packed)
+    words = len(compressed) // 4
+    checksum = sum(struct.unpack('<%dI' % words, compressed[:words * 4])) & 0xFFFFFFFFFFFFFFFF
+    return '1-%x-%x-%s' % (checksum, len(packed), compressed.hex())
+
+
+class TestResumeReplication(unittest.TestCase):
+
+    fields = { 'fromguid': 11, 'object': 129, 'offset': 1 << 40, 'bytes': 5 << 40, 'toguid': 22
+              ,'toname': 'karen/a@2', 'embedok': True, 'crypt_keydata': { 'keyformat': 'raw' } }
+
+    def load(self, token):
+        src = TestPoolSet()
+        src.parse_zfs_r_output(x('''karen   1359351119
+karen/a  1360136643
+karen/a@1  1363676402
+karen/a@2  1363676403
+karen/a@3  1363676404
+'''), zpool_data=zpool_data)
+        dst = TestPoolSet()
+        dst.parse_zfs_r_output(x('''target   1359351109   -
+target/karen   1359351119   -
+target/karen/a  1360136643  %s
+target/karen/a@1  1363676402  -
+''' % token), zpool_data=zpool_data, zfs_props=['name', 'creation', 'receive_resume_token'])
+        return (src, dst)
+
+    def test_decode_resume_token(self):
+        token = make_resume_token(self.fields)
+        self.assertEqual(zfs.decode_resume_token(token), self.fields)
+        self.assertRaises(ValueError, zfs.decode_resume_token, token[:-8] + '00000000')
+        self.assertRaises(ValueError, zfs.decode_resume_token, 'garbage')
+
+    def test_plans_resume(self):
+        token = make_resume_token(self.fields)
+        (src, dst) = self.load(token)
+        result = zfs.recursive_replicate(src.lookup("karen"), dst.lookup("target/karen"))
+        self.assertEqual(result, [
+            ('resume', src.lookup("karen/a"), dst.lookup("target/karen/a"), None, src.lookup("karen/a@2")),
+            ('incremental', src.lookup("karen/a"), dst.lookup("target/karen/a"), src.lookup("karen/a@2"), src.lookup("karen/a@3")),
+        ])
+        self.assertEqual([ op[0] for op in zfs.optimize(result) ], ['resume', 'incremental'])
+
+        ex = zfs.ReplicationExecutor(src.connection, dst.connection, "karen", "target/karen", recv_args=['-F'])
+        self.assertEqual(ex.build_commands(result[0]),
+                         (['zfs', 'send', '-t', token], ['zfs', 'recv', '-s', '-F', 'target/karen/a']))
+
+        # a token for a snapshot the source no longer has is ignored
+        (src, dst) = self.load(make_resume_token(dict(self.fields, toname='karen/a@9')))
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            result = zfs.recursive_replicate(src.lookup("karen"), dst.lookup("target/karen"))
+        self.assertIn('zfs recv -A target/karen/a', str(w[0].message))
+        self.assertEqual([ (op[0], op[3].name, op[4].name) for op in result ], [('incremental', '1', '2'), ('incremental', '2', '3')])
+
+    def test_checkpoints(self):
+        (src, dst) = self.load('-')
+        sched = zfs.recursive_replicate(src.lookup("karen"), dst.lookup("target/karen"))
+        checkpoints = []
+        ex = zfs.ReplicationExecutor(src.connection, dst.connection, "karen", "target/karen"
+                                    ,checkpoint=lambda r: checkpoints.append((r.snap_to, r.bytes, r.returncode))
+                                    ,checkpoint_interval=0.05
+                                    ,_test_command=lambda kind, cmd: ['sh', '-c', 'cat > /dev/null'] if kind == 'recv' else
+                                                   ['sh', '-c', 'for i in 1 2 3 4; do head -c 1000 /dev/zero; sleep 0.1; done'])
+        ex.run(sched)
+        self.assertEqual(ex.progress.value, 8000)
+        for snap_to in ('2', '3'):
+            marks = [ c for c in checkpoints if c[0] == snap_to ]
+            self.assertGreater(len(marks), 2)
+            self.assertEqual(marks[-1], (snap_to, 4000, 0))
+            self.assertEqual([ c[2] for c in marks[:-1] ], [None] * (len(marks) - 1))
+            self.assertEqual(sorted(c[1] for c in marks), [ c[1] for c in marks ])
+
 
 class TestRecursiveClearObsolete(unittest.TestCase):
 
@@ -1277,6 +1486,228 @@ target/karen/plonezeo@zfs-auto-snap_hourly-2013-03-19-0000     1363676402
         )
 
 
+# Directory with a fake zfs that reports what zfs destroy -vp would print
+def make_fake_zfs(test):
+    tmp = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmp)
+    with open(os.path.join(tmp, 'zfs'), 'w') as f:
+        f.write('#!/bin/sh\n'
+                'echo "$*" >> "$(dirname "$0")/calls"\n'
+                'for last; do :; done\n'
+                'case "$last" in *busy*) echo "cannot destroy $last: dataset is busy" >&2; exit 1;; esac\n'
+                'ds=${last%%@*}\n'
+                'if [ "$ds" = "$last" ]; then printf "destroy\\t%s\\n" "$last"; else\n'
+                '  echo "${last#*@}" | tr "," "\\n" | while read s; do printf "destroy\\t%s@%s\\n" "$ds" "$s"; done; fi\n'
+                'printf "reclaim\\t1000\\n"\n')
+    os.chmod(os.path.join(tmp, 'zfs'), 0o755)
+    return (tmp, lambda cmd: ['env', 'PATH=%s:%s' % (tmp, os.environ['PATH'])] + cmd)
+
+
+class TestDestroyPlanning(unittest.TestCase):
+
+    def setUp(self):
+        rows = ['target   1359351109', 'target/karen   1359351119', 'target/karen/old   1359351119'
+               ,'target/karen/old@1   1359351119', 'target/karen/busy   1359351119']
+        rows += [ 'target/karen@s%02d  %d' % (i, 1363676402 + i) for i in range(12) ]
+        rows += [ 'target/karen/busy@s%02d  %d' % (i, 1363676402 + i) for i in range(2) ]
+        self.dst = TestPoolSet()
+        self.dst.parse_zfs_r_output(x('\n'.join(rows)), zpool_data=zpool_data)
+        self.dst.connection._poolset = self.dst
+        self.karen = self.dst.lookup("target/karen")
+
+    def snaps(self, *idx):
+        return [ ("destroy", self.karen.get_snapshot('s%02d' % i)) for i in idx ]
+
+    def test_plan_destroys(self):
+        ops = self.snaps(0, 1, 2, 3, 5, 7, 8, 10, 11) \
+            + [ ("destroy_recursively", self.dst.lookup("target/karen/old")), ("destroy", self.dst.lookup("target/karen/old@1")) ]
+        self.assertEqual(zfs.plan_destroys(ops), [
+            ['zfs', 'destroy', '-r', 'target/karen/old'],
+            ['zfs', 'destroy', 'target/karen@s00%s03,s05,s07,s08,s10,s11'],
+        ])
+        self.assertEqual(zfs.plan_destroys(ops, max_arg=30), [
+            ['zfs', 'destroy', '-r', 'target/karen/old'],
+            ['zfs', 'destroy', 'target/karen@s00%s03,s05,s07'],
+            ['zfs', 'destroy', 'target/karen@s08,s10,s11'],
+        ])
+        self.assertEqual(zfs.plan_destroys([]), [])
+
+    def test_run_destroys(self):
+        (tmp, _test_command) = make_fake_zfs(self)
+        ops = self.snaps(5, 7) + [ ("destroy", self.dst.lookup("target/karen/busy@s00")), ("destroy_recursively", self.dst.lookup("target/karen/old")) ]
+        cmds = zfs.plan_destroys(ops)
+
+        result = zfs.run_destroys(self.dst.connection, cmds, dry_run=True, _test_command=_test_command)
+        self.assertEqual(result.destroyed, ['target/karen/old', 'target/karen@s05', 'target/karen@s07'])
+        self.assertEqual(result.reclaim, 2000)
+        self.assertEqual([ (e[0][-1], e[1]) for e in result.errors ], [('target/karen/busy@s00', 1)])
+        self.assertIn('dataset is busy', result.errors[0][2])
+        self.assertEqual(len(self.karen.get_snapshots()), 12)
+
+        result = zfs.run_destroys(self.dst.connection, cmds, _test_command=_test_command)
+        self.assertEqual(len(result.destroyed), 3)
+        self.assertEqual([ s.name for s in self.karen.get_snapshots() ], [ 's%02d' % i for i in range(12) if not i in (5, 7) ])
+        self.assertRaises(KeyError, self.dst.lookup, "target/karen/old")
+        with open(os.path.join(tmp, 'calls')) as f:
+            self.assertEqual(f.read().splitlines()[:3], ['destroy -nvp -r target/karen/old', 'destroy -nvp target/karen@s05,s07', 'destroy -nvp target/karen/busy@s00'])
+
+
+class TestReplicationExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.src = TestPoolSet()
+        self.src.parse_zfs_r_output(x('''karen   1359351119
+karen@1  1363676402
+karen@2  1363676403
+karen/a  1360136643
+karen/a@1  1363676402
+karen/a@2  1363676403
+karen/a/x  1360136643
+karen/b  1360136643
+karen/b@1  1363676402
+karen/c  1360136643
+karen/c@1  1363676402
+karen/c@2  1363676403
+'''), zpool_data=zpool_data)
+        self.dst = TestPoolSet()
+        self.dst.parse_zfs_r_output(x('''target   1359351109
+target/karen   1359351119
+target/karen@1  1363676402
+target/karen/a  1360136643
+target/karen/a@1  1363676402
+'''), zpool_data=zpool_data)
+        self.sched = zfs.recursive_replicate(self.src.lookup("karen"), self.dst.lookup("target/karen"))
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def executor(self, fail=None, max_per_host=2):
+        def _test_command(kind, cmd):
+            with self.lock:
+                self.calls.append((time.monotonic(), kind, cmd))
+            if kind == 'send':
+                if cmd[-1] == fail:
+                    return ['sh', '-c', 'echo boom >&2; exit 3']
+                return ['sh', '-c', 'head -c 100000 /dev/zero; sleep 0.2']
+            return ['sh', '-c', 'cat > /dev/null']
+        return zfs.ReplicationExecutor(self.src.connection, self.dst.connection, "karen", "target/karen"
+                                       ,max_per_host=max_per_host, recv_args=['-F'], _test_command=_test_command)
+
+    def test_build_commands(self):
+        dst_conn = zfs.Connection(host='backup')
+        ex = zfs.ReplicationExecutor(self.src.connection, dst_conn, self.src.lookup("karen"), "target/karen")
+        karen_a = self.src.lookup("karen/a")
+        self.assertEqual(ex.build_commands(("incremental", karen_a, None, self.src.lookup("karen/a@1"), self.src.lookup("karen/a@2"))),
+                         (['zfs', 'send', '-I', 'karen/a@1', 'karen/a@2'], dst_conn.command + ['zfs', 'recv', '-s', 'target/karen/a']))
+        self.assertEqual(ex.build_commands(("full_recursive", karen_a, None, None, self.src.lookup("karen/a@1")))[0],
+                         ['zfs', 'send', '-R', 'karen/a@1'])
+        self.assertEqual(ex.build_commands(("create_stub", self.src.lookup("karen/a/x"), None, None, None)),
+                         (None, dst_conn.command + ['zfs', 'create', '-p', 'target/karen/a/x']))
+        self.assertRaises(KeyError, ex.dst_name, "other/a")
+
+    def test_runs_chains(self):
+        results = self.executor().run(self.sched)
+        self.assertEqual(sorted((r.op, r.src, r.dst, r.snap_from, r.snap_to) for r in results), sorted([
+            ('create_stub', 'karen/a/x', 'target/karen/a/x', None, None),
+            ('full', 'karen/b', 'target/karen/b', None, '1'),
+            ('full', 'karen/c', 'target/karen/c', None, '1'),
+            ('incremental', 'karen', 'target/karen', '1', '2'),
+            ('incremental', 'karen/a', 'target/karen/a', '1', '2'),
+            ('incremental', 'karen/c', 'target/karen/c', '1', '2'),
+        ]))
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual([ r.bytes for r in results if not r.op == 'create_stub' ], [100000] * 5)
+        self.assertTrue(all(r.throughput > 0 for r in results if not r.op == 'create_stub'))
+        self.assertIn(['zfs', 'recv', '-s', '-F', 'target/karen/c'], [ c[2] for c in self.calls ])
+
+        # children only start once their parent chain is done, and siblings run in parallel
+        started = { (c[1], c[2][-1]): c[0] for c in self.calls }
+        self.assertGreater(started[('send', 'karen/a@2')], started[('send', 'karen@2')] + 0.15)
+        self.assertGreater(started[('create', 'target/karen/a/x')], started[('send', 'karen/a@2')] + 0.15)
+        self.assertLess(abs(started[('send', 'karen/a@2')] - started[('send', 'karen/b@1')]), 0.15)
+        # ops within a chain stay in order
+        self.assertGreater(started[('send', 'karen/c@2')], started[('send', 'karen/c@1')] + 0.15)
+
+    def test_stops_on_failure(self):
+        with self.assertRaises(zfs.ReplicationError) as ctx:
+            self.executor(fail='karen/c@1', max_per_host=1).run(self.sched)
+        results = ctx.exception.results
+        failed = [ r for r in results if not r.ok ]
+        self.assertEqual([ (r.src, r.snap_to, r.returncode, r.error) for r in failed ], [('karen/c', '1', 3, 'boom')])
+        # the rest of the chain is not started
+        self.assertNotIn('karen/c@2', [ c[2][-1] for c in self.calls ])
+
+    def test_stops_on_exception(self):
+        ex = self.executor(max_per_host=1)
+        build_commands = ex.build_commands
+        def _build_commands(op):
+            if op[1].path == 'karen': raise KeyError('karen')
+            return build_commands(op)
+        ex.build_commands = _build_commands
+        with self.assertRaises(zfs.ReplicationError) as ctx:
+            ex.run(self.sched)
+        self.assertEqual([ (r.op, r.src, r.dst, r.snap_from, r.snap_to, r.returncode, r.error) for r in ctx.exception.results ],
+                         [('incremental', 'karen', None, '1', '2', -1, "KeyError: 'karen'")])
+        self.assertTrue(ex._stop.is_set())
+        # the failed root chain never released its children
+        self.assertEqual(self.calls, [])
+
+    def test_bytes_of_partial_stream(self):
+        # The receiver exits early: bytes relayed until then are still reported
+        def _test_command(kind, cmd):
+            if kind == 'send': return ['sh', '-c', 'head -c 20000000 /dev/zero']
+            return ['sh', '-c', 'head -c 300000 > /dev/null']
+        ex = zfs.ReplicationExecutor(self.src.connection, self.dst.connection, "karen", "target/karen"
+                                     ,max_per_host=1, _test_command=_test_command)
+        with self.assertRaises(zfs.ReplicationError) as ctx:
+            ex.run(self.sched)
+        (r,) = ctx.exception.results
+        self.assertFalse(r.ok)
+        self.assertGreaterEqual(r.bytes, 300000)
+        self.assertEqual(ex.progress.value, r.bytes)
+
+    def test_estimate(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with open(os.path.join(tmp, 'zfs'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'for last; do :; done\n'
+                    '[ "$last" = karen/b@1 ] && { echo "cannot open" >&2; exit 1; }\n'
+                    'echo "full\t$last\t1"\n'
+                    'echo "size\t$(printf %s "$last" | wc -c)000"\n')
+        os.chmod(os.path.join(tmp, 'zfs'), 0o755)
+        def _test_command(kind, cmd):
+            self.calls.append((kind, cmd))
+            return ['env', 'PATH=%s:%s' % (tmp, os.environ['PATH'])] + cmd
+        ex = zfs.ReplicationExecutor(self.src.connection, self.dst.connection, "karen", "target/karen", _test_command=_test_command)
+        result = ex.estimate(self.sched, max_workers=2)
+        self.assertEqual([ c[0] for c in self.calls ], ['estimate'])
+        self.assertEqual([ op[:5] for op in result ], self.sched)
+        self.assertEqual([ (op[0], op[1].path, op[5]) for op in result ], [
+            ('incremental', 'karen', 7000),
+            ('incremental', 'karen/a', 9000),
+            ('create_stub', 'karen/a/x', 0),
+            ('full', 'karen/b', None),
+            ('full', 'karen/c', 9000),
+            ('incremental', 'karen/c', 9000),
+        ])
+
+    def test_plan_lanes(self):
+        sizes = { 'karen': 10, 'karen/a': 50, 'karen/a/x': 0, 'karen/b': 30, 'karen/c': 40 }
+        sched = [ tuple(op) + (sizes[op[1].path],) for op in self.sched ]
+        (lanes, makespan) = zfs.plan_lanes(sched, 2)
+        self.assertEqual([ [ (op[1].path, op[0]) for op in lane ] for lane in lanes ], [
+            [('karen', 'incremental'), ('karen/a', 'incremental'), ('karen/b', 'full'), ('karen/a/x', 'create_stub')],
+            [('karen/c', 'full'), ('karen/c', 'incremental')],
+        ])
+        self.assertEqual(makespan, 10 + 50 + 30)
+        self.assertEqual(zfs.plan_lanes(sched, 1)[1], 10 + 50 + 30 + 80)
+
+        # the executor starts the largest ready chain first
+        self.executor(max_per_host=1).run(sched)
+        self.assertEqual([ c[2][-1] for c in self.calls if c[1] == 'send' ],
+                         ['karen@2', 'karen/c@1', 'karen/c@2', 'karen/a@2', 'karen/b@1'])
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -1,4 +1,11 @@
 import unittest
+import os
+import socket
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta, date as dt_date
 import zfslib as zfs
 from zfslib_test_tools import *
@@ -158,7 +165,7 @@ class PoolSetTests(unittest.TestCase):
 
             self.assertEqual(snap.name, snap_name)
             self.assertEqual(snap.path, snap_fullpath)
-            self.assertEqual(snap.get_property('creation'), cdate_c)
+            self.assertEqual(snap.get_property('creation'), int(cdate_c))
             
             # Lookup should fail unless full path to snapshot is specified
             with self.assertRaises(KeyError): poolset.lookup('BOOT/ubuntu_n2qr5q@autozsys_68frge')
@@ -178,7 +185,7 @@ class PoolSetTests(unittest.TestCase):
             self.assertEqual(pool.get_property('fragmentation'), 50)
             self.assertEqual(pool.get_property('capacity'), 62)
             self.assertEqual(pool.get_property('health'), 'OFFLINE')
-            self.assertEqual(pool.get_property('readonly'), 'off')
+            self.assertEqual(pool.get_property('readonly'), False)
 
             ds = pool.lookup('ROOT')
             self.assertIsInstance(ds, zfs.Dataset)
@@ -199,7 +206,7 @@ class PoolSetTests(unittest.TestCase):
             ds = poolset.lookup('dpool/other')
             self.assertIsInstance(ds, zfs.Dataset)
             s_ts='1608446351'
-            self.assertEqual(ds.get_property('creation'), s_ts)
+            self.assertEqual(ds.get_property('creation'), int(s_ts))
             self.assertEqual(ds.creation, dt_from_creation(s_ts))
             self.assertEqual(ds.get_property('used'), 280644734976)
             self.assertEqual(ds.get_property('available'), 3564051083264)
@@ -211,7 +218,7 @@ class PoolSetTests(unittest.TestCase):
 
             ds = poolset.lookup('bpool/BOOT')
             self.assertIsInstance(ds, zfs.Dataset)
-            self.assertEqual(ds.get_property('creation'), '1608154061')
+            self.assertEqual(ds.get_property('creation'), 1608154061)
             self.assertEqual(ds.get_property('used'), 190410752)
             self.assertEqual(ds.get_property('available'), 1686265856)
             self.assertEqual(ds.get_property('referenced'), 98304)
@@ -404,6 +411,36 @@ class PoolSetTests(unittest.TestCase):
                                       ,'tdelta': "1h"})
 
 
+    def test_find_dataset_for_path(self):
+        (ds, p_real, rel) = poolset.find_dataset_for_path('/home/jblogs/proj/main.py')
+        self.assertIs(ds, poolset.lookup('rpool/USERDATA/jbloggs_jb327m'))
+        self.assertEqual((p_real, rel), ('/home/jblogs/proj/main.py', '/proj/main.py'))
+
+        # Longest mountpoint wins
+        (ds, _, rel) = poolset.find_dataset_for_path('/var/lib/apt/lists/foo')
+        self.assertIs(ds, poolset.lookup('rpool/ROOT/ubuntu_n2qr5q/var/lib/apt'))
+        self.assertEqual(rel, '/lists/foo')
+        (ds, _, rel) = poolset.find_dataset_for_path('/var/lib/apt')
+        self.assertIs(ds, poolset.lookup('rpool/ROOT/ubuntu_n2qr5q/var/lib/apt'))
+        self.assertEqual(rel, '')
+
+        # Mountpoints only match on whole path components
+        (ds, _, rel) = poolset.find_dataset_for_path('/var/lib/aptitude/foo')
+        self.assertIs(ds, poolset.lookup('rpool/ROOT/ubuntu_n2qr5q/var/lib'))
+        self.assertEqual(rel, '/aptitude/foo')
+        (ds, _, _) = poolset.find_dataset_for_path('/dpool/vcmainx/foo')
+        self.assertIsNone(ds)
+
+        # Root (/) mountpoints are ignored
+        self.assertEqual(poolset.find_dataset_for_path('/nothere/foo'), (None, None, None))
+
+        paths = ['/home/jblogs/a', '/nothere/foo', '/var/lib/dpkg/status']
+        res = list(poolset.resolve_paths(paths))
+        self.assertEqual(res, [poolset.find_dataset_for_path(p) for p in paths])
+        self.assertEqual([r[0] and r[0].path for r in res]
+            ,['rpool/USERDATA/jbloggs_jb327m', None, 'rpool/ROOT/ubuntu_n2qr5q/var/lib/dpkg'])
+
+
     # tested against zfs_data_nomounts.tsv
     def test_no_mounts(self):
         pool = ps_nm.lookup('dpool')
@@ -425,7 +462,154 @@ class PoolSetTests(unittest.TestCase):
         with self.assertRaisesRegex(AssertionError, RE_HM): snap.snap_path
         with self.assertRaisesRegex(AssertionError, RE_HM): snap.resolve_snap_path('foo')
         with self.assertRaisesRegex(AssertionError, RE_HM): ps_nm.find_dataset_for_path('foo')
-        
+        with self.assertRaisesRegex(AssertionError, RE_HM): list(ps_nm.resolve_paths(['foo']))
+
+
+    def test_lookup_index(self):
+        from unittest import mock
+        items = list(poolset.walk())
+        with mock.patch.object(zfs.ZFSItem, 'get_child', side_effect=AssertionError):
+            for item in items:
+                self.assertIs(poolset.lookup(item.path), item)
+                if isinstance(item, zfs.Snapshot):
+                    self.assertIs(item.parent.get_snapshot(item.name), item)
+                elif isinstance(item, zfs.Dataset):
+                    self.assertIs(item.pool.get_dataset(item.dspath), item)
+                    self.assertIs(item.pool.lookup(item.dspath), item)
+        self.assertEqual(set(poolset._index), set(x.path for x in items))
+        self.assertRaises(KeyError, poolset.lookup, 'rpool/nope')
+        self.assertRaises(KeyError, poolset.lookup, 'nope')
+
+        rows = [ 'big\t1600000000' ]
+        for i in range(100):
+            rows.append('big/d%03d\t1600000000' % i)
+            rows.extend([ 'big/d%03d/e%03d\t1600000000' % (i, j) for j in range(100) ])
+            rows.extend([ 'big/d%03d@s%03d\t1600000000' % (i, j) for j in range(100) ])
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('\n'.join(rows), zpool_data='big\t1000\t10\t990\t-\t1\t1\tONLINE')
+        names = [ r.split('\t')[0] for r in rows ]
+        t = time.time()
+        for _ in range(10):
+            for name in names: ps.lookup(name)
+        self.assertLess(time.time() - t, 2)
+
+
+    def test_index_maintenance(self):
+        zpool_data = 'tank\t1000\t10\t990\t-\t1\t1\tONLINE'
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('tank\t1\ntank/a\t1\ntank/a/x\t1\ntank/a/x@s1\t1\ntank/b\t1\ntank@p\t1', zpool_data=zpool_data)
+        def _check():
+            self.assertEqual(sorted(ps._index), sorted(x.path for x in ps.walk()))
+        _check()
+        self.assertFalse(ps.lookup('tank@p').has_property('size'))
+        self.assertTrue(ps.lookup('tank').has_property('size'))
+        a = ps.lookup('tank/a')
+        x = ps.lookup('tank/a/x')
+        ps.lookup('tank').remove(a)
+        _check()
+        self.assertRaises(KeyError, ps.lookup, 'tank/a/x@s1')
+        self.assertTrue(x.invalidated)
+
+        # reload: tank/b is gone, tank/a and a new snapshot appear
+        ps.parse_zfs_r_output('tank\t1\ntank/a\t2\ntank/a@s2\t2\ntank@p\t1', zpool_data=zpool_data)
+        _check()
+        self.assertRaises(KeyError, ps.lookup, 'tank/b')
+        self.assertEqual(ps.lookup('tank/a@s2').get_property('creation'), 2)
+        self.assertIs(ps.get_pool('tank').poolset, ps)
+
+        ps.remove('tank')
+        self.assertEqual(ps._index, {})
+
+
+    def test_property_types(self):
+        zfs.declare_property_type('com.sun:auto-snapshot', 'bool')
+        zfs.declare_property_type('org.example:cap', 'size')
+        self.addCleanup(zfs.declare_property_type, 'com.sun:auto-snapshot', None)
+        self.addCleanup(zfs.declare_property_type, 'org.example:cap', None)
+        self.assertRaises(AssertionError, zfs.declare_property_type, 'org.example:x', 'float')
+        props = ['mounted', 'compressratio', 'type', 'used', 'com.sun:auto-snapshot', 'org.example:cap', 'org.example:note']
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('tank\t1\tyes\t1.50x\tfilesystem\t100\ttrue\t10G\tx\n'
+                              'tank/a\t2\tno\t2.00\tfilesystem\t-\tfalse\t512B\t-\n'
+                              'tank/a@s\t3\t-\t1.00x\tsnapshot\tabc\t-\t1.5K\t-'
+                              ,zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE', zfs_props=props)
+        (pool, ds, snap) = (ps.lookup('tank'), ps.lookup('tank/a'), ps.lookup('tank/a@s'))
+        self.assertEqual([pool.get_property(p) for p in props], [True, 1.5, 'filesystem', 100, True, 10 << 30, 'x'])
+        self.assertEqual([ds.get_property(p) for p in props], [False, 2.0, 'filesystem', None, False, 512, None])
+        # Values that do not decode are kept as str
+        self.assertEqual([snap.get_property(p) for p in props[2:6]], ['snapshot', 'abc', None, 1536])
+        self.assertEqual(snap.get_property('creation'), 3)
+        self.assertIs(pool.get_property('type'), ds.get_property('type'))
+        self.assertEqual([zfs.PROPERTY_DECODERS['size'](v) for v in ['512B', '1.5KB', '1.5KiB', '2M']], [512, 1536, 1536, 2 << 20])
+        self.assertRaises(ValueError, zfs.PROPERTY_DECODERS['size'], 'B')
+
+
+    def test_walk_options(self):
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('tank\t1\ntank@p\t1\ntank/a\t1\ntank/a/x\t1\ntank/a/x@s1\t1\ntank/b\t1'
+                              ,zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE')
+        pool = ps.lookup('tank')
+        paths = lambda it: [i.path for i in it]
+        self.assertEqual(paths(pool.walk()), ['tank', 'tank@p', 'tank/a', 'tank/a/x', 'tank/a/x@s1', 'tank/b'])
+        self.assertEqual(paths(pool.walk(order='post')), ['tank@p', 'tank/a/x@s1', 'tank/a/x', 'tank/a', 'tank/b', 'tank'])
+        self.assertEqual(paths(ps.walk(only=zfs.Dataset)), ['tank/a', 'tank/a/x', 'tank/b'])
+        self.assertEqual(paths(pool.walk(include_snapshots=False, max_depth=1)), ['tank', 'tank/a', 'tank/b'])
+        self.assertEqual([(d, i.path) for (d, i) in pool.walk(only=zfs.Snapshot, with_depth=True)], [(1, 'tank@p'), (3, 'tank/a/x@s1')])
+        self.assertEqual([(d, i.path) for (d, i) in pool.get_all_datasets(with_depth=True)], [(0, 'tank/a'), (1, 'tank/a/x'), (0, 'tank/b')])
+        self.assertRaises(AssertionError, lambda: list(pool.walk(order='in')))
+
+
+    def test_rename_and_move(self):
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('tank\t1\ntank/a\t1\ntank/a/x\t1\ntank/a/x@s1\t1\ntank/b\t1'
+                              ,zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE')
+        a = ps.lookup('tank/a')
+        x = ps.lookup('tank/a/x')
+        snap = ps.lookup('tank/a/x@s1')
+        self.assertEqual((x.path, x.dspath, snap.name_full), ('tank/a/x', 'a/x', 'a/x@s1'))
+
+        a.name = 'renamed'
+        self.assertEqual((x.path, x.dspath, snap.path, snap.name_full), ('tank/renamed/x', 'renamed/x', 'tank/renamed/x@s1', 'renamed/x@s1'))
+        self.assertIs(ps.lookup('tank/renamed/x@s1'), snap)
+        self.assertRaises(KeyError, ps.lookup, 'tank/a/x')
+
+        x.parent = ps.lookup('tank/b')
+        self.assertEqual(snap.path, 'tank/b/x@s1')
+        self.assertEqual(a.children, [])
+        self.assertIs(ps.lookup('tank/b').get_child('x'), x)
+        snap.name = 's2'
+        self.assertIs(x.get_snapshot('s2'), snap)
+        self.assertEqual(sorted(ps._index), sorted(i.path for i in ps.walk()))
+
+
+    def test_move_across_pools_and_detach(self):
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('tank\t1\ntank/a\t1\ntank/a/x\t1\ntank/a/x@s1\t1\ntank/b\t1\nzz\t1\nzz/q\t1'
+                              ,zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE\nzz\t1000\t10\t990\t-\t1\t1\tONLINE')
+        (x, snap, b, q) = (ps.lookup('tank/a/x'), ps.lookup('tank/a/x@s1'), ps.lookup('tank/b'), ps.lookup('zz/q'))
+
+        # Across pools: pool, dspath and name_full follow the new parent
+        x.parent = q
+        self.assertEqual((x.path, x.dspath, snap.name_full), ('zz/q/x', 'q/x', 'q/x@s1'))
+        self.assertIs(x.pool, ps.get_pool('zz'))
+        self.assertIs(snap.pool, ps.get_pool('zz'))
+        self.assertIs(ps.lookup('zz/q/x@s1'), snap)
+
+        # A moved snapshot gets its new dataset
+        snap.parent = b
+        self.assertIs(snap.dataset, b)
+        self.assertEqual((snap.path, snap.name_full), ('tank/b@s1', 'b@s1'))
+        self.assertIs(snap.pool, ps.get_pool('tank'))
+        self.assertRaises(KeyError, ps.lookup, 'zz/q/x@s1')
+
+        # Detaching drops the subtree from the index
+        b.parent = None
+        self.assertRaises(KeyError, ps.lookup, 'b')
+        self.assertRaises(KeyError, ps.lookup, 'tank/b')
+        self.assertRaises(KeyError, ps.lookup, 'tank/b@s1')
+        self.assertIs(b.get_snapshot('s1'), snap)
+        self.assertEqual(sorted(ps._index), sorted(i.path for i in ps.walk()))
+
 
 
 # Test General Utilities
@@ -489,6 +673,402 @@ class PoolSetTests(unittest.TestCase):
 
 
 
+diff_data = '\n'.join([
+     '1608233673.000000001\tM\t/\t/home/jblogs/proj'
+    ,'1608233673.000000002\tM\tF\t/home/jblogs/proj/main.py'
+    ,'1608233673.000000003\t+\tF\t/home/jblogs/proj/new\\0040file.txt'
+    ,'1608233673.000000004\t-\tF\t/home/jblogs/proj/old.js'
+    ,'1608233673.000000005\tR\tF\t/home/jblogs/proj/a.py\t/home/jblogs/proj/sub/a.py'
+    ,'1608233673.000000006\tR\tF\t/home/jblogs/proj/b.py\t/home/jblogs/proj/c.py'
+    ,''
+])
+
+class Diff_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.ds = poolset.lookup('rpool/USERDATA/jbloggs_jb327m')
+        snaps = self.ds.get_all_snapshots()
+        self.snap_left = snaps[0]
+        self.snap_right = snaps[1]
+
+
+    def test_iter_diffs(self):
+        diffs = self.ds.iter_diffs(self.snap_left, self.snap_right, _test_data_diff=diff_data)
+        self.assertNotIsInstance(diffs, list)
+        diffs = list(diffs)
+        self.assertEqual(len(diffs), 6)
+        self.assertEqual(diffs[2].file, 'new file.txt')
+
+        diffs2 = self.ds.get_diffs(self.snap_left, self.snap_right, _test_data_diff=diff_data)
+        self.assertEqual([str(d) for d in diffs], [str(d) for d in diffs2])
+
+        diffs = self.ds.get_diffs(self.snap_left, self.snap_right, chg_type='V', _test_data_diff=diff_data)
+        self.assertEqual([d.path_full for d in diffs], ['/home/jblogs/proj/a.py'])
+
+        diffs = self.ds.get_diffs(self.snap_left, self.snap_right, file_type='F', include=['*.py'], _test_data_diff=diff_data)
+        self.assertEqual(len(diffs), 3)
+
+        # Negative tests
+        with self.assertRaises(AssertionError): self.ds.iter_diffs(snap_from='foo')
+
+
+    def test_export_diffs(self):
+        import io, csv, json
+        diffs = self.ds.iter_diffs(self.snap_left, self.snap_right, get_move=True, _test_data_diff=diff_data)
+        buf = io.BytesIO()
+        self.assertEqual(zfs.export_diffs(diffs, buf, chunk_size=4), 6)
+        rows = [json.loads(l) for l in buf.getvalue().decode('utf-8').splitlines()]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(tuple(rows[0].keys()), zfs.DIFF_EXPORT_FIELDS)
+        self.assertEqual(rows[0]['dataset'], 'rpool/USERDATA/jbloggs_jb327m')
+        self.assertEqual(rows[0]['snap_left'], self.snap_left.path)
+        self.assertEqual(rows[0]['snap_right_creation'], int(self.snap_right.get_property('creation')))
+        self.assertEqual(rows[2]['path_full'], '/home/jblogs/proj/new file.txt')
+        self.assertEqual(rows[4]['chg_type'], 'V')
+        self.assertEqual(rows[5]['chg_type'], 'R')
+        self.assertEqual(rows[5]['path_full_new'], '/home/jblogs/proj/c.py')
+
+        diffs = self.ds.iter_diffs(self.snap_left, _test_data_diff=diff_data)
+        buf = io.BytesIO()
+        self.assertEqual(zfs.export_diffs(diffs, buf, fmt='csv', chunk_size=4), 6)
+        rows = list(csv.reader(io.StringIO(buf.getvalue().decode('utf-8'))))
+        self.assertEqual(tuple(rows[0]), zfs.DIFF_EXPORT_FIELDS)
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[1][3], '(present)')
+
+        # Negative tests
+        with self.assertRaises(AssertionError): zfs.export_diffs([], buf, fmt='xml')
+        with self.assertRaises(AssertionError): zfs.export_diffs([], buf, chunk_size=0)
+
+
+
+    def test_unescapeDiffPath(self):
+        self.assertEqual(zfs.unescapeDiffPath('/a/b c'), '/a/b c')
+        self.assertEqual(zfs.unescapeDiffPath('/a/new\\0040file'), '/a/new file')
+        self.assertEqual(zfs.unescapeDiffPath(b'/a/new\\0040file'), '/a/new file')
+        self.assertEqual(zfs.unescapeDiffPath('/a/back\\0134slash\\0011tab'), '/a/back\\slash\ttab')
+        self.assertEqual(zfs.unescapeDiffPath('/a/caf\\0303\\0251'), '/a/caf\u00e9')
+        self.assertEqual(zfs.unescapeDiffPath('/a/\\0303\\0251\\0003'), '/a/\u00e9\x03')
+        # Invalid utf-8 is preserved
+        self.assertEqual(zfs.unescapeDiffPath('/a/\\0377').encode('utf-8', 'surrogateescape'), b'/a/\xff')
+
+        diffs = self.ds.get_diffs(self.snap_left, self.snap_right
+            ,_test_data_diff='1608233673.000000001\tR\tF\t/home/jblogs/caf\\0303\\0251\\0040x\t/home/jblogs/y\\0134z')
+        self.assertEqual(diffs[0].file, 'caf\u00e9 x')
+        self.assertEqual(diffs[0].path_full_new, '/home/jblogs/y\\z')
+
+
+    def test_compare_diff_contents(self):
+        import tempfile, shutil
+        class _Diff(zfs.Diff):
+            snap_path_left = None
+            snap_path_right = None
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        def _write(name, data, mtime):
+            path = os.path.join(tmp, name)
+            with open(path, 'wb') as f: f.write(data)
+            os.utime(path, (mtime, mtime))
+            return path
+
+        cases = [
+             (b'a\nb\nc\n', b'a\nB\nc\nd\n', 100, 200) # changed text
+            ,(b'same\n', b'same\n', 100, 200)              # same content, touched
+            ,(b'x\0y', b'x\0z', 100, 200)                  # binary
+            ,(b'a\n', b'b\n', 100, 100)                    # same size and mtime
+            ,(b'a  b\n\n', b'a b\n', 100, 200)             # whitespace only
+        ]
+        diffs = []
+        for i, (l, r, mt_l, mt_r) in enumerate(cases):
+            d = _Diff(['1608233673.0', 'M', 'F', f'/home/jblogs/f{i}'], self.snap_left, self.snap_right)
+            d.snap_path_left = _write(f'l{i}', l, mt_l)
+            d.snap_path_right = _write(f'r{i}', r, mt_r)
+            diffs.append(d)
+        missing = _Diff(['1608233673.0', 'M', 'F', '/home/jblogs/missing'], self.snap_left, self.snap_right)
+        missing.snap_path_left = missing.snap_path_right = os.path.join(tmp, 'missing')
+        diffs.append(missing)
+
+        for max_workers in (0, 2):
+            res = list(zfs.compare_diff_contents(diffs, max_workers=max_workers))
+            self.assertEqual([r.diff for r in res], diffs)
+            self.assertEqual([r.changed for r in res], [True, False, True, False, True, None])
+            self.assertEqual([r.method for r in res], ['size', 'content', 'content', 'stat', 'size', None])
+            self.assertEqual((res[0].adds, res[0].rems, res[0].is_text), (2, 1, True))
+            self.assertEqual((res[2].adds, res[2].rems, res[2].is_text), (0, 0, False))
+            self.assertEqual((res[4].adds, res[4].rems), (0, 0))
+            self.assertIsNotNone(res[5].error)
+
+        res = list(zfs.compare_diff_contents(diffs[3:4], max_workers=0, quick=False))
+        self.assertEqual((res[0].changed, res[0].adds, res[0].rems), (True, 1, 1))
+
+        # Negative tests
+        d = zfs.Diff(['1608233673.0', '+', 'F', '/home/jblogs/f'], self.snap_left, self.snap_right)
+        with self.assertRaises(AssertionError): list(zfs.compare_diff_contents([d], max_workers=0))
+
+
+
+# Builds a PoolSet with one dataset mounted in a temp dir and `count` snapshots
+# whose .zfs/snapshot directories are plain folders
+def make_snapshot_tree(count):
+    import tempfile, shutil
+    tmp = os.path.realpath(tempfile.mkdtemp())
+    rows = ['tpool\t1600000000\t-\tno', f'tpool/data\t1600000000\t{tmp}\tyes']
+    for i in range(count):
+        rows.append(f'tpool/data@snap{i:03d}\t{1600000001 + i}\t-\t-')
+        os.makedirs(os.path.join(tmp, '.zfs', 'snapshot', f'snap{i:03d}'))
+    ps = TestPoolSet()
+    ps.parse_zfs_r_output(zfs_data='\n'.join(rows), zpool_data='tpool\t1\t1\t1\t-\t1\t1\tONLINE'
+        ,zfs_props=['name', 'creation', 'mountpoint', 'mounted'])
+    return (ps, ps.lookup('tpool/data'), tmp, lambda: shutil.rmtree(tmp))
+
+
+class Snapshot_Path_Tests(unittest.TestCase):
+
+    def setUp(self):
+        (self.ps, self.ds, self.tmp, cleanup) = make_snapshot_tree(50)
+        self.addCleanup(cleanup)
+
+    def _snapfile(self, idx):
+        return os.path.join(self.tmp, '.zfs', 'snapshot', f'snap{idx:03d}', 'doc.txt')
+
+    def test_file_history(self):
+        from unittest import mock
+        # Version A in snapshots 10-24 and B in 25-39. Unchanged files are hard links like in a snapshot
+        for (lo, hi, data, mtime) in [(10, 24, b'A', 1000000000), (25, 39, b'BB', 2000000000)]:
+            with open(self._snapfile(lo), 'wb') as f: f.write(data)
+            os.utime(self._snapfile(lo), ns=(mtime, mtime))
+            for i in range(lo + 1, hi + 1):
+                os.link(self._snapfile(lo), self._snapfile(i))
+
+        calls = []
+        _stat = os.stat
+        def _count(p, *a, **k):
+            calls.append(p)
+            return _stat(p, *a, **k)
+
+        with mock.patch('os.stat', side_effect=_count):
+            hist = self.ds.file_history(os.path.join(self.tmp, 'doc.txt'))
+
+        self.assertEqual(len(hist), 2)
+        self.assertEqual((hist[0].first.name, hist[0].last.name, len(hist[0].snapshots)), ('snap010', 'snap024', 15))
+        self.assertEqual((hist[1].first.name, hist[1].last.name, len(hist[1].snapshots)), ('snap025', 'snap039', 15))
+        self.assertEqual((hist[0].size, hist[1].size), (1, 2))
+        self.assertTrue(os.path.isfile(hist[1].snap_path))
+        self.assertLess(len(set(calls)), 20)
+
+        self.assertEqual(self.ds.file_history(os.path.join(self.tmp, 'other.txt')), [])
+
+
+    def test_snap_path_cache(self):
+        snap = self.ds.get_snapshots()[0]
+        self.assertEqual(snap.snap_path, os.path.join(self.tmp, '.zfs/snapshot', snap.name))
+        self.assertIs(snap.snap_path, snap.snap_path)
+        snap.name = 'renamed'
+        self.assertEqual(snap.snap_path, os.path.join(self.tmp, '.zfs/snapshot/renamed'))
+        self.assertIs(self.ps.lookup('tpool/data@renamed'), snap)
+
+
+    def test_find_snapshots_contains(self):
+        for i in range(5, 15):
+            open(self._snapfile(i), 'wb').close()
+        doc = os.path.join(self.tmp, 'doc.txt')
+
+        for max_workers in (None, 1, 8):
+            snaps = self.ds.find_snapshots({'contains': doc, 'max_workers': max_workers} if max_workers else {'contains': doc})
+            self.assertEqual([x.name for x in snaps], [f'snap{i:03d}' for i in range(5, 15)])
+
+        snaps = self.ds.find_snapshots({'contains': doc, 'name': 'snap01*', 'index': True, 'max_workers': 4})
+        self.assertEqual([(i, x.name) for (i, x) in snaps], [(i, f'snap{i:03d}') for i in range(10, 15)])
+
+        all_snaps = self.ds.get_all_snapshots()
+        res = zfs.Snapshot.resolve_snap_paths(all_snaps, doc, max_workers=8)
+        self.assertEqual(res, [snap.resolve_snap_path(doc) for snap in all_snaps])
+        self.assertEqual([ok for (ok, _) in res], [(5 <= i < 15) for i in range(50)])
+        self.assertEqual(res[5], (True, self._snapfile(5)))
+        self.assertEqual(res[0], (False, all_snaps[0].snap_path))
+
+        # Remote probe: `sh -c` stands in for ssh, which runs its last argument in a shell
+        import sys
+        fs = zfs.RemoteProbe(['sh', '-c'], python=sys.executable)
+        self.addCleanup(fs.close)
+        paths = [snap.snap_path + '/doc.txt' for snap in all_snaps]
+        self.assertEqual(fs.exists(paths), zfs.LocalProbe().exists(paths))
+        self.assertEqual(fs.stat(paths, max_workers=4), zfs.LocalProbe().stat(paths))
+        self.assertEqual(fs.stat(['/' + 'x' * 5000]), zfs.LocalProbe().stat(['/' + 'x' * 5000])) # ENAMETOOLONG
+        self.assertEqual(fs.realpath(['~', doc]), zfs.LocalProbe().realpath(['~', doc]))
+        self.assertEqual(len(fs.exists(paths * 20)), 1000) # spans several batches
+
+        # Path queries go through the connection's probe
+        self.ps.connection._fs = fs
+        self.assertEqual([x.name for x in self.ds.find_snapshots({'contains': doc, 'name': 'snap01*'})]
+            ,[f'snap{i:03d}' for i in range(10, 15)])
+        self.assertEqual(self.ds.get_rel_path(doc), '/doc.txt')
+
+        # Negative tests
+        with self.assertRaises(AssertionError): self.ds.find_snapshots({'contains': doc, 'max_workers': '4'})
+        with self.assertRaises(AssertionError): zfs.Snapshot.resolve_snap_paths(all_snaps, None)
+
+
+
+class Snapshot_Create_Tests(unittest.TestCase):
+
+    def setUp(self):
+        names = ['tank', 'tank/a', 'tank/a/x', 'tank/a/y', 'tank/b', 'tank/b/z']
+        self.ps = TestPoolSet()
+        self.ps.parse_zfs_r_output('\n'.join('%s\t1600000000' % n for n in names + ['tank/a@old']),
+                                   zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE')
+        self.calls = []
+        def _run(cmd, input=None):
+            self.calls.append(cmd)
+            if cmd[:2] == ['zfs', 'list']:
+                return '\n'.join('%s\t1700000000' % n for n in cmd[7:]).encode('utf-8')
+            return b''
+        self.ps.connection.run = _run
+
+    def test_create_subtree(self):
+        snaps = self.ps.create_snapshots(['tank/a', 'tank/a/x', 'tank/a/y'], 'daily')
+        self.assertEqual(self.calls[0], ['zfs', 'snapshot', '-r', 'tank/a@daily'])
+        self.assertEqual(self.calls[1], ['zfs', 'list', '-Hp', '-o', 'name,creation', '-t', 'snapshot', 'tank/a@daily', 'tank/a/x@daily', 'tank/a/y@daily'])
+        self.assertEqual([ s.path for s in snaps ], ['tank/a@daily', 'tank/a/x@daily', 'tank/a/y@daily'])
+        self.assertIs(self.ps.lookup('tank/a/x@daily'), snaps[1])
+        self.assertEqual(snaps[1].get_property('creation'), 1700000000)
+        self.assertEqual([ s.name for s in self.ps.lookup('tank/a').get_snapshots() ], ['old', 'daily'])
+
+    def test_create_partial(self):
+        pool = self.ps.get_pool('tank')
+        snaps = self.ps.create_snapshots([pool, 'tank/a', 'tank/b/z', 'tank/a'], 'hourly')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.calls[0], ['zfs', 'snapshot', 'tank@hourly', 'tank/a@hourly', 'tank/b/z@hourly'])
+        self.assertEqual([ s.path for s in snaps ], ['tank@hourly', 'tank/a@hourly', 'tank/b/z@hourly'])
+        self.assertEqual(self.ps.create_snapshots([], 'x'), [])
+        self.assertRaises(AssertionError, self.ps.create_snapshots, ['tank/a'], 'bad@name')
+
+    def test_create_many(self):
+        rows = [ 'big\t1600000000' ]
+        for i in range(40):
+            rows.append('big/group-with-a-long-name-%03d\t1600000000' % i)
+            rows.extend([ 'big/group-with-a-long-name-%03d/member-dataset-%03d\t1600000000' % (i, j) for j in range(60) ])
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('\n'.join(rows), zpool_data='big\t1000\t10\t990\t-\t1\t1\tONLINE')
+        ps.connection.run = self.ps.connection.run
+        datasets = [ r.split('\t')[0] for r in rows[1:] ]
+
+        # too long for one command: whole subtrees go with -r
+        snaps = ps.create_snapshots(datasets[:-1], 'weekly')
+        snap_cmds = [ c for c in self.calls if c[1] == 'snapshot' ]
+        self.assertEqual([ c[2] == '-r' for c in snap_cmds ], [True, False])
+        self.assertEqual(len(snap_cmds[0]), 3 + 39)
+        self.assertEqual(len(snap_cmds[1]), 2 + 60)
+        self.assertTrue(all(sum(len(a) + 1 for a in c) < zfs.ZFS_ARG_MAX for c in self.calls))
+        self.assertEqual(len(snaps), len(datasets) - 1)
+
+
+class Retention_Tests(unittest.TestCase):
+
+    def setUp(self):
+        t0 = int(datetime(2024, 1, 1, 0, 30).timestamp())
+        rows = [ 'tank\t%d\t0' % t0, 'tank/d\t%d\t0' % t0, 'tank/d/child\t%d\t0' % t0 ]
+        rows += [ 'tank/d@auto-%03d\t%d\t100' % (h, t0 + h * 3600) for h in range(72) ]
+        rows += [ 'tank/d@manual\t%d\t5000' % (t0 + 10) ]
+        rows += [ 'tank/d/child@auto-%03d\t%d\t1' % (h, t0 + h * 3600) for h in range(0, 72, 12) ]
+        self.ps = TestPoolSet()
+        self.ps.parse_zfs_r_output('\n'.join(rows), zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE'
+                                   ,zfs_props=['name', 'creation', 'used'])
+        self.ds = self.ps.lookup('tank/d')
+
+    def names(self, snaps):
+        return [ s.name for s in snaps ]
+
+    def test_gfs(self):
+        result = zfs.evaluate_retention(self.ds, {'hourly': 24, 'daily': 7}, match='auto-*')
+        expected = [ 'auto-%03d' % h for h in [23, 47] + list(range(48, 72)) ]
+        self.assertEqual(self.names(result.keep), expected)
+        self.assertEqual(len(result.destroy), 72 - len(expected))
+        self.assertNotIn('manual', self.names(result.keep + result.destroy))
+        self.assertEqual(result.reclaim, 100 * len(result.destroy))
+        self.assertEqual(result.kept_by[self.ds.get_snapshot('auto-071')], ['hourly', 'daily'])
+        self.assertEqual(result.kept_by[self.ds.get_snapshot('auto-023')], ['daily'])
+
+        result = zfs.evaluate_retention(self.ds, {'last': 3, 'monthly': 0})
+        self.assertEqual(self.names(result.keep), ['auto-069', 'auto-070', 'auto-071'])
+        self.assertIn('manual', self.names(result.destroy))
+        self.assertEqual(self.names(result.destroy)[:2], ['auto-000', 'manual'])
+
+        self.assertRaises(AssertionError, zfs.evaluate_retention, self.ds, {'fortnightly': 2})
+        self.assertRaises(AssertionError, zfs.evaluate_retention, self.ds, {'daily': -1})
+
+    def test_poolset(self):
+        result = zfs.evaluate_retention(self.ps, {'daily': 2}, match='auto-*')
+        self.assertEqual([ s.path for s in result.keep ], ['tank/d@auto-047', 'tank/d@auto-071', 'tank/d/child@auto-036', 'tank/d/child@auto-060'])
+        self.assertEqual(result.reclaim, 70 * 100 + 4 * 1)
+        self.assertEqual(len(zfs.evaluate_retention(self.ds, {'daily': 2}, recursive=True).keep), 4)
+
+    def test_many_snapshots(self):
+        t0 = int(datetime(2024, 1, 1).timestamp())
+        rows = [ 'big\t%d\t0' % t0 ]
+        for g in range(20):
+            rows.append('big/g%02d\t%d\t0' % (g, t0))
+            for d in range(25):
+                rows.append('big/g%02d/d%02d\t%d\t0' % (g, d, t0))
+                rows.extend([ 'big/g%02d/d%02d@s%04d\t%d\t10' % (g, d, i, t0 + i * 3600 * 7) for i in range(100) ])
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('\n'.join(rows), zpool_data='big\t1000\t10\t990\t-\t1\t1\tONLINE', zfs_props=['name', 'creation', 'used'])
+        t = time.time()
+        result = zfs.evaluate_retention(ps, {'hourly': 24, 'daily': 30, 'weekly': 8, 'monthly': 12})
+        self.assertLess(time.time() - t, 5)
+        self.assertEqual(len(result.keep) + len(result.destroy), 50000)
+        self.assertEqual(result.reclaim, 10 * len(result.destroy))
+
+
+class Relay_Tests(unittest.TestCase):
+
+    def _relay(self, r, w, data, **kwargs):
+        out = []
+        def _write():
+            with os.fdopen(w_src, 'wb') as f: f.write(data)
+        def _read():
+            with os.fdopen(r_dst, 'rb') as f: out.append(f.read())
+        (r_src, w_src) = r
+        (r_dst, w_dst) = w
+        threads = [ threading.Thread(target=_write), threading.Thread(target=_read) ]
+        for t in threads: t.start()
+        try:
+            n = zfs.relay_stream(r_src, w_dst, **kwargs)
+        finally:
+            os.close(r_src)
+            os.close(w_dst)
+        for t in threads: t.join()
+        self.assertEqual(n, len(data))
+        self.assertEqual(out[0], data)
+
+    def test_relay_pipes(self):
+        data = os.urandom(1 << 20) * 32
+        counter = zfs.ByteCounter()
+        self._relay(os.pipe(), os.pipe(), data, counter=counter)
+        self.assertEqual(counter.value, len(data))
+
+    def test_relay_fallbacks(self):
+        # neither splice nor sendfile take a socket as input
+        data = os.urandom(300000)
+        (a, b) = socket.socketpair()
+        (c, d) = socket.socketpair()
+        self._relay((a.detach(), b.detach()), (c.detach(), d.detach()), data)
+
+        with tempfile.TemporaryFile() as f_in, tempfile.TemporaryFile() as f_out:
+            f_in.write(data)
+            f_in.flush()
+            f_in.seek(0)
+            self.assertEqual(zfs.relay_stream(f_in, f_out), len(data))
+            f_out.seek(0)
+            self.assertEqual(f_out.read(), data)
+
+    def test_relay_rate_limit(self):
+        t = time.monotonic()
+        self._relay(os.pipe(), os.pipe(), b'x' * 200000, rate_limit=1000000)
+        self.assertGreater(time.monotonic() - t, 0.15)
+
+
 class Simplify_Tests(unittest.TestCase):
 
     def test_simple(self):
@@ -536,6 +1116,60 @@ class Simplify_Tests(unittest.TestCase):
         self.assertEqual(r1, r2)        
 
 
+    def test_out_of_order(self):
+        # successor listed before its predecessor
+        m = [
+        (2,3,"two"),
+        (3,4,"three"),
+        (1,2,"one"),
+        ]
+        self.assertEqual(zfs.coalesceChains(m), [[1, 4, 'one']])
+
+    def test_branches(self):
+        m = [
+        (1,2,"one"),
+        (2,3,"two"),
+        (2,4,"other"),
+        (0,3,"zero"),
+        (3,5,"three"),
+        ]
+        # first unjoined link continues a chain, other branches start their own
+        r1 = zfs.coalesceChains(m)
+        r2 = [[1, 5, 'one'], (2, 4, 'other'), (0, 3, 'zero')]
+        self.assertEqual(r1, r2)
+        self.assertEqual(zfs.coalesceChains(list(m)), r1)
+
+    def test_cycles(self):
+        self.assertEqual(zfs.coalesceChains([(1,2,"a"), (2,1,"b")]), [[1, 1, 'a']])
+        self.assertEqual(zfs.coalesceChains([(3,3,"a"), (3,4,"b")]), [[3, 4, 'a']])
+        self.assertEqual(zfs.coalesceChains([(5,6,"x"), (1,2,"a"), (2,3,"b"), (3,1,"c")]), [(5, 6, 'x'), [1, 1, 'a']])
+
+    # Benchmark: 100k links in random order coalesce into one chain in linear time
+    def test_long_chain(self):
+        import random, time
+        count = 100000
+        m = [ (i, i + 1, i) for i in range(count) ]
+        random.Random(1).shuffle(m)
+        t = time.perf_counter()
+        r1 = zfs.coalesceChains(m)
+        elapsed = time.perf_counter() - t
+        self.assertEqual(r1, [[0, count, 0]])
+        self.assertLess(elapsed, 5.0, f"Coalescing {count} links took {elapsed:.2f}s")
+
+    # Benchmark: 100k links sharing one start, each joined to one of 100k links ending there
+    def test_shared_start(self):
+        import time
+        count = 100000
+        m = [ (0, 1, i) for i in range(count) ] + [ (i, 0, -i) for i in range(2, count + 2) ]
+        t = time.perf_counter()
+        r1 = zfs.coalesceChains(m)
+        elapsed = time.perf_counter() - t
+        self.assertEqual(r1, [ [i, 1, -i] for i in range(2, count + 2) ])
+        self.assertLess(elapsed, 5.0, f"Coalescing {count * 2} links took {elapsed:.2f}s")
+        # self loops on a shared start
+        self.assertEqual(zfs.coalesceChains([(3,3,"a"), (3,3,"b"), (3,4,"c"), (1,3,"d")]), [[3, 3, 'a'], [1, 4, 'd']])
+
+
 class Uniq_Tests(unittest.TestCase):
     
     def test_identity(self):
@@ -565,6 +1199,290 @@ class Uniq_Tests(unittest.TestCase):
 
 
 
+class Catalog_Tests(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.cache = os.path.join(tmp, 'poolset.cat')
+        self.zfs = {'tank': 'tank\t1600000000\ntank/a\t1600000000\ntank/a@s1\t1600000001\n',
+                    'backup': 'backup\t1600000000\nbackup/t\t1600000000\n'}
+        self.zpool = {'tank': 'tank\t1000\t10\t990\t-\t1\t1\tONLINE', 'backup': 'backup\t2000\t20\t1980\t-\t1\t1\tONLINE'}
+        self.unmounted = set()
+        self.calls = []
+
+    def _run(self, cmd, input=None):
+        self.calls.append(cmd)
+        if cmd[0] == 'zpool':
+            return '\n'.join(self.zpool.values()).encode('utf-8')
+        pools = cmd[7:] or list(self.zfs)
+        lines = []
+        for line in ''.join(self.zfs[p] for p in pools).splitlines():
+            (name, creation) = line.split('\t')
+            snap = '@' in name
+            if snap and cmd[6] == 'filesystem,volume': continue
+            cols = {'name': name, 'creation': creation, 'receive_resume_token': '-'
+                   ,'mountpoint': '-' if snap else '/' + name
+                   ,'mounted': '-' if snap else 'no' if name in self.unmounted else 'yes'}
+            lines.append('\t'.join(cols[c] for c in cmd[4].split(',')))
+        return ''.join(s + '\n' for s in lines).encode('utf-8')
+
+    def _load(self, **kwargs):
+        conn = TestConnection()
+        conn._poolset = zfs.PoolSet(conn)
+        conn.run = self._run
+        self.calls.clear()
+        kwargs.setdefault('get_mounts', False)
+        return conn.load_poolset(cache=self.cache, **kwargs)
+
+    def test_warm_start(self):
+        ps = self._load()
+        self.assertEqual(len(self.calls), 2)
+        self.assertTrue(os.path.isfile(self.cache))
+        ps2 = self._load(max_age=3600)
+        self.assertEqual(self.calls, [])
+        self.assertEqual([i.path for i in ps2.walk()], [i.path for i in ps.walk()])
+        self.assertEqual(ps2.lookup('tank/a@s1').get_property('creation'), 1600000001)
+        self.assertEqual(ps2.get_pool('backup').get_property('free'), 1980)
+
+    def test_revalidate(self):
+        self._load()
+        mtime = os.path.getmtime(self.cache)
+        time.sleep(0.01)
+        ps = self._load()
+        self.assertEqual(self.calls[1], ['zfs', 'list', '-Hpr', '-o', 'name', '-t', 'filesystem,volume', 'tank', 'backup'])
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(list(ps.walk())), 5)
+        self.assertGreater(os.path.getmtime(self.cache), mtime)
+
+        # Only the pool whose space accounting changed is listed again
+        self.zfs['backup'] += 'backup/t@new\t1700000000\n'
+        self.zpool['backup'] = 'backup\t2000\t21\t1979\t-\t1\t1\tONLINE'
+        ps = self._load(max_age=0)
+        self.assertEqual(self.calls[1:], [['zfs', 'list', '-Hpr', '-o', 'name', '-t', 'filesystem,volume', 'tank']
+                                         ,['zfs', 'list', '-Hpr', '-o', 'name,creation', '-t', 'all', 'backup']])
+        self.assertEqual([i.path for i in ps.walk()], ['tank', 'tank/a', 'tank/a@s1', 'backup', 'backup/t', 'backup/t@new'])
+        ps = self._load(max_age=3600)
+        self.assertEqual(self.calls, [])
+        self.assertIn('backup/t@new', ps._index)
+
+    def test_revalidate_names_and_mounts(self):
+        ps = self._load(get_mounts=True)
+        self.assertTrue(ps.lookup('tank/a').mounted)
+
+        # A mount change leaves space untouched but is refreshed from the narrow listing
+        self.unmounted.add('tank/a')
+        ps = self._load(get_mounts=True)
+        self.assertEqual([c[4] for c in self.calls[1:]], ['name,mounted'])
+        self.assertFalse(ps.lookup('tank/a').mounted)
+        ps = self._load(get_mounts=True, max_age=3600)
+        self.assertFalse(ps.lookup('tank/a').mounted)
+
+        # Snapshot renames leave dataset names and space unchanged and are not detected
+        self.zfs['tank'] = self.zfs['tank'].replace('@s1', '@s9')
+        ps = self._load(get_mounts=True)
+        self.assertEqual(len(self.calls), 2)
+        self.assertIn('tank/a@s1', ps._index)
+
+        # A dataset rename is picked up even when the fingerprint did not change
+        self.zfs['tank'] = self.zfs['tank'].replace('tank/a', 'tank/b')
+        ps = self._load(get_mounts=True)
+        self.assertEqual(self.calls[2], ['zfs', 'list', '-Hpr', '-o', 'name,creation,mountpoint,mounted', '-t', 'all', 'tank'])
+        self.assertEqual([i.path for i in ps.walk()], ['tank', 'tank/b', 'tank/b@s9', 'backup', 'backup/t'])
+
+    def test_corrupt_or_mismatched(self):
+        self._load()
+        with open(self.cache, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\x00')
+        self._load(max_age=3600)
+        self.assertEqual(len(self.calls), 2)
+        # Other properties than the catalog was written with force a full load
+        ps = self._load(max_age=3600, get_resume_tokens=True)
+        self.assertEqual(self.calls[1][:5], ['zfs', 'list', '-Hpr', '-o', 'name,creation,receive_resume_token'])
+        self.assertIsNone(ps.lookup('backup/t').get_property('receive_resume_token'))
+
+    def test_save_catalog(self):
+        ps = self._load()
+        ps.lookup('tank/a').name = 'b'
+        ps.save_catalog(self.cache)
+        ps2 = self._load(max_age=3600)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(ps2.lookup('tank/b@s1').get_property('creation'), 1600000001)
+
+
+
+class HistoryCatalog_Tests(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.hist = zfs.HistoryCatalog(os.path.join(tmp, 'hist.db'))
+        self.addCleanup(self.hist.close)
+
+    def _poolset(self, snaps, used):
+        rows = ['tank\t900\t%d\t1' % used, 'tank/a\t900\t%d\t2' % used]
+        rows.extend('tank/a@%s\t%d\t10\t%d' % (s, c, c) for (s, c) in snaps)
+        ps = TestPoolSet()
+        ps.parse_zfs_r_output('\n'.join(rows), zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE', zfs_props=['used', 'guid'])
+        return ps
+
+    def test_snapshots(self):
+        snaps = [('s1', 1000), ('s2', 2000), ('s3', 3000)]
+        self.hist.ingest_poolset(self._poolset(snaps, 100))
+        self.hist.ingest_poolset(self._poolset(snaps[1:], 250))
+        recs = self.hist.snapshots(dataset='tank/a')
+        self.assertEqual([(r.path, r.present) for r in recs], [('tank/a@s1', False), ('tank/a@s2', True), ('tank/a@s3', True)])
+        self.assertEqual(recs[0].host, 'localhost')
+        self.assertEqual(self.hist.snapshots(guid=2000)[0].path, 'tank/a@s2')
+        self.assertEqual([r.name for r in self.hist.snapshots(since=datetime.fromtimestamp(1500), present=True)], ['s2', 's3'])
+        self.assertEqual(self.hist.snapshots(host='other'), [])
+        self.assertEqual([h['used'] for (_, h) in self.hist.dataset_history('tank/a')], [100, 250])
+        self.assertEqual(self.hist.dataset_history('tank/a')[0][1]['snapshots'], 3)
+
+    def test_diffs(self):
+        ps = self._poolset([('s1', 1000), ('s2', 2000), ('s3', 3000), ('s4', 4000)], 100)
+        self.hist.ingest_poolset(ps)
+        (s1, s2, s3, s4) = ps.lookup('tank/a').get_snapshots()
+        diffs = [ zfs.Diff(['1500.0', '+', 'F', '/mnt/a/f'], s1, s2)
+                 ,zfs.Diff(['2500.0', 'R', 'F', '/mnt/a/f', '/mnt/a/g'], s2, s3)
+                 ,zfs.Diff(['3500.0', 'M', 'F', '/mnt/a/g'], s3, s4)
+                 ,zfs.Diff(['3500.0', '+', 'F', '/mnt/a/sub/h'], s3, s4) ]
+        self.assertEqual(self.hist.ingest_diffs(diffs), 4)
+        # Re-ingesting a pair replaces its rows
+        self.assertEqual(self.hist.ingest_diffs(diffs[1:2]), 1)
+        self.assertEqual(self.hist.ingest_diffs([]), 0)
+
+        recs = self.hist.diffs('/mnt/a/g')
+        self.assertEqual([(r.chg_type, r.snap_right) for r in recs], [('R', 'tank/a@s3'), ('M', 'tank/a@s4')])
+        self.assertEqual(recs[0].chg_time, datetime.fromtimestamp(2500))
+        self.assertEqual(len(self.hist.diffs('/mnt/a', prefix=True)), 4)
+        self.assertEqual([s.name for s in self.hist.snapshots_containing('/mnt/a/f')], ['s2'])
+        self.assertEqual([s.name for s in self.hist.snapshots_containing('/mnt/a/g')], ['s3', 's4'])
+        self.assertEqual(self.hist.snapshots_containing('/mnt/none'), [])
+
+
+
+class Lazy_Property_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.ps = TestPoolSet()
+        self.ps.parse_zfs_r_output('tank\t1\ntank/a\t1\ntank/a@s1\t1\ntank/a@s2\t2\ntank/b\t1'
+                                   ,zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE')
+        self.values = {('tank/a@s1', 'used'): '100', ('tank/a@s2', 'used'): '200', ('tank/a', 'compressratio'): '1.50x'
+                      ,('tank', 'written'): '5', ('tank/a', 'written'): '6', ('tank/a@s1', 'written'): '7'}
+        self.calls = []
+        self.down = False
+        def _run(cmd, input=None):
+            self.calls.append(cmd)
+            i = [ k for (k, a) in enumerate(cmd) if a.startswith('tank') ][0]
+            (props, names) = (cmd[i-1].split(','), cmd[i:])
+            if 'bogus' in props:
+                raise subprocess.CalledProcessError(2, cmd, stderr=b"bad property list: invalid property 'bogus'\n")
+            if self.down:
+                raise subprocess.CalledProcessError(255, cmd, stderr=b"ssh: connect to host backup port 22: Connection refused\n")
+            rows = []
+            for ((name, prop), v) in self.values.items():
+                if '-t' in cmd: match = '@' in name and name.split('@')[0] in names
+                elif '-r' in cmd: match = any(name == n or name.startswith((n + '/', n + '@')) for n in names)
+                else: match = name in names
+                if match and prop in props: rows.append('%s\t%s\t%s' % (name, prop, v))
+            return '\n'.join(rows).encode('utf-8')
+        self.ps.connection.run = _run
+
+    def test_sibling_snapshots(self):
+        (s1, s2) = self.ps.lookup('tank/a').get_snapshots()
+        self.assertEqual(s1.get_property('used'), 100)
+        self.assertEqual(self.calls, [['zfs', 'get', '-Hp', '-o', 'name,property,value', '-d', '1', '-t', 'snapshot', 'used', 'tank/a']])
+        self.assertEqual(s2.get_property('used'), 200)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.ps.lookup('tank/a').get_property('compressratio'), 1.5)
+        self.assertEqual(self.calls[1], ['zfs', 'get', '-Hp', '-o', 'name,property,value', 'compressratio', 'tank/a'])
+
+    def test_fetch_properties(self):
+        n = self.ps.fetch_properties(['tank'], ['written', 'org.example:x'], recursive=True)
+        self.assertEqual(n, 3)
+        self.assertEqual(self.calls, [['zfs', 'get', '-Hp', '-o', 'name,property,value', '-r', 'written,org.example:x', 'tank']])
+        self.assertEqual(self.ps.lookup('tank/a@s1').get_property('written'), 7)
+        self.assertFalse(self.ps.lookup('tank/b').has_property('written'))
+        # Not reported by zfs get: remembered as missing
+        self.assertRaises(KeyError, self.ps.lookup('tank/b').get_property, 'written')
+        self.assertRaises(KeyError, self.ps.lookup('tank/a').get_property, 'org.example:x')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_failures(self):
+        ds = self.ps.lookup('tank/b')
+        with self.assertRaisesRegex(KeyError, 'invalid property'):
+            ds.get_property('bogus')
+        self.assertRaises(KeyError, ds.get_property, 'bogus')
+        self.assertEqual(len(self.calls), 1)
+        # A reload clears the negative cache
+        self.ps.parse_zfs_r_output('tank\t1\ntank/b\t1', zpool_data='tank\t1000\t10\t990\t-\t1\t1\tONLINE')
+        self.assertRaises(KeyError, ds.get_property, 'bogus')
+        self.assertEqual(len(self.calls), 2)
+
+        # Only the rejected property is remembered as missing
+        self.assertRaises(KeyError, self.ps.fetch_properties, [ds], ['used', 'bogus'])
+        self.assertRaises(KeyError, ds.get_property, 'bogus')
+        self.assertEqual(len(self.calls), 3)
+
+        # Transient failures are not remembered
+        self.down = True
+        with self.assertRaisesRegex(KeyError, 'Connection refused'):
+            ds.get_property('used')
+        self.down = False
+        self.values[('tank/b', 'used')] = '50'
+        self.assertEqual(ds.get_property('used'), 50)
+        self.assertEqual(len(self.calls), 5)
+
+
+
+class Delta_Load_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+             'tank':      {'creation': '1', 'used': '300', 'mountpoint': '/tank', 'mounted': 'yes'}
+            ,'tank/a':    {'creation': '2', 'used': '200', 'mountpoint': '/tank/a', 'mounted': 'yes'}
+            ,'tank/a@s1': {'creation': '3', 'used': '10', 'mountpoint': '-', 'mounted': '-'} }
+        self.calls = []
+        self.conn = TestConnection()
+        self.conn._poolset = zfs.PoolSet(self.conn)
+        self.conn.run = self._run
+
+    def _run(self, cmd, input=None):
+        self.calls.append(cmd)
+        if cmd[0] == 'zpool':
+            return b'tank\t1000\t10\t990\t-\t1\t1\tONLINE'
+        cols = cmd[4].split(',')[1:]
+        return '\n'.join('\t'.join([name] + [props[c] for c in cols]) for (name, props) in self.data.items()).encode('utf-8')
+
+    def test_add_columns(self):
+        ps = self.conn.load_poolset(get_mounts=False)
+        self.assertEqual(len(self.calls), 2)
+        a = ps.lookup('tank/a')
+        self.calls.clear()
+
+        self.assertIs(self.conn.load_poolset(zfs_props=['used'], get_mounts=False), ps)
+        self.assertEqual(self.calls, [['zfs', 'list', '-Hpr', '-o', 'name,used', '-t', 'all']])
+        self.assertIs(ps.lookup('tank/a'), a)
+        self.assertEqual((a.get_property('used'), ps.lookup('tank/a@s1').get_property('used')), (200, 10))
+
+        # Adding the mount columns turns mount information on
+        self.calls.clear()
+        self.conn.load_poolset(zfs_props=['used'])
+        self.assertEqual(self.calls, [['zfs', 'list', '-Hpr', '-o', 'name,mountpoint,mounted', '-t', 'all']])
+        self.assertEqual((a.mountpoint, a.mounted), ('/tank/a', True))
+        self.assertIs(ps.find_dataset_for_path('/tank/a/x/y')[0], a)
+
+        # Same properties: nothing to do. Fewer properties: full reload
+        self.calls.clear()
+        self.conn.load_poolset(zfs_props=['used'])
+        self.assertEqual(self.calls, [])
+        self.conn.load_poolset(get_mounts=False)
+        self.assertEqual([c[0] for c in self.calls], ['zfs', 'zpool'])
+
+
+
 if __name__ == "__main__":
     unittest.main()
     sys.exit(0)